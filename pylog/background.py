@@ -0,0 +1,230 @@
+"""Event loggers that move event construction and I/O off the traced thread
+
+The recorders hand these loggers compact raw tuples (see
+debugger.EventRecorder) which are queued and turned into events by a writer
+thread (BackgroundEventLogger) or a writer process (ProcessEventLogger).
+
+The queues are bounded. What happens when the writer falls behind depends on
+the backpressure policy:
+* "block": the traced thread waits for the writer to catch up
+* "drop_lines": line events are dropped while the queue is full. Calls,
+    returns and exceptions still block, so the call tree stays intact
+* "sample": once the queue is half full, only every sample_every-th line
+    event is kept. Other events block when the queue is full"""
+import atexit
+import collections
+import multiprocessing
+import sys
+import threading
+import time
+
+from six.moves import queue
+
+from pylog import events
+from pylog.debugger import open_event_logger
+
+BACKPRESSURE_POLICIES = ("block", "drop_lines", "sample")
+
+class Backpressure(object):
+    """Applies a backpressure policy; shared by the thread and process loggers"""
+
+    def __init__(self, policy="block", sample_every=10):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: {0}".format(policy))
+        self.policy = policy
+        self.sample_every = sample_every
+        self.lines_seen = 0
+        self.events_dropped = 0
+
+    def keep_line(self, congested, full):
+        """Whether a line event should be queued
+        congested: the queue is at least half full
+        full: the queue is full"""
+        if self.policy == "drop_lines" and full:
+            self.events_dropped += 1
+            return False
+        if self.policy == "sample" and congested:
+            self.lines_seen += 1
+            if self.lines_seen % self.sample_every:
+                self.events_dropped += 1
+                return False
+        return True
+
+class BackgroundEventLogger(object):
+    """Queues raw events for a writer thread, which passes them on to event_logger
+
+    The queue is a deque: with a single producer and a single consumer,
+    append and popleft need no extra locking. Events event_logger fails to
+    write are counted (events_failed) and skipped. If the writer thread
+    stops anyway, events that don't fit in the queue are dropped rather
+    than waited for."""
+
+    def __init__(self, event_logger, capacity=65536, backpressure="block", sample_every=10, poll_interval=0.001):
+        """event_logger: where the writer thread sends the events
+            (e.g. debugger.BufferedJsonFileEventLogger)
+        capacity: max number of queued events"""
+        self.event_logger = event_logger
+        self.capacity = capacity
+        self.backpressure = Backpressure(backpressure, sample_every)
+        self.poll_interval = poll_interval
+        self.queue = collections.deque()
+        self.events_queued = 0
+        self.events_written = 0
+        #events event_logger failed to write, and the first exception it raised
+        self.events_failed = 0
+        self.write_error = None
+        #held by the writer while it's handing a batch to event_logger
+        self.write_lock = threading.Lock()
+        self.closing = False
+        self.writer = threading.Thread(target=self.write_loop, name="pylog-writer")
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def log_raw(self, raw):
+        if len(self.queue) >= self.capacity // 2 and not self.make_room(raw[0] == "line"):
+            return
+        self.queue.append(raw)
+        self.events_queued += 1
+
+    def log_event(self, event):
+        """Events that were already built are written as they are"""
+        if len(self.queue) >= self.capacity // 2 and not self.make_room(event.event_type == "line"):
+            return
+        self.queue.append(event)
+        self.events_queued += 1
+
+    def make_room(self, line):
+        """Apply the backpressure policy to an event arriving while the queue is congested.
+        Returns whether to queue it"""
+        if line and not self.backpressure.keep_line(True, len(self.queue) >= self.capacity):
+            return False
+        while len(self.queue) >= self.capacity:
+            if not self.writer.is_alive():
+                #nothing will empty the queue: don't hang the traced program
+                self.backpressure.events_dropped += 1
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def write_loop(self):
+        popleft = self.queue.popleft
+        while True:
+            if not self.queue:
+                if self.closing:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            with self.write_lock:
+                written = 0
+                while written < 4096:
+                    try:
+                        raw = popleft()
+                    except IndexError:
+                        break
+                    try:
+                        event = events.event_from_raw(raw) if isinstance(raw, tuple) else raw
+                        self.event_logger.log_event(event)
+                    except Exception as error:
+                        #e.g. a full disk: carry on with the next events rather than let the queue fill up
+                        self.events_failed += 1
+                        if self.write_error is None:
+                            self.write_error = error
+                    written += 1
+                self.events_written += written
+
+    def flush(self):
+        """Wait for the writer to catch up, then flush event_logger"""
+        while self.events_written < self.events_queued and self.writer.is_alive():
+            time.sleep(self.poll_interval)
+        with self.write_lock:
+            flush = getattr(self.event_logger, "flush", None)
+            if flush is not None:
+                flush()
+
+    def close(self):
+        """Drain the queue and stop the writer"""
+        if self.closing:
+            return
+        self.closing = True
+        self.writer.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            "events_queued": self.events_queued,
+            "events_written": self.events_written,
+            "events_dropped": self.backpressure.events_dropped,
+            "events_failed": self.events_failed,
+            "queue_size": len(self.queue),
+        }
+
+def write_process(batches, log_path, log_format):
+    """Writer process: turns batches of raw events into a log file"""
+    #a forked writer inherits the hooks of the thread that started it
+    sys.settrace(None)
+    sys.setprofile(None)
+    event_logger = open_event_logger(log_path, log_format)
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        for raw in batch:
+            event_logger.log_event(events.event_from_raw(raw))
+    event_logger.close()
+
+class ProcessEventLogger(object):
+    """Like BackgroundEventLogger, but the events are built and written by a
+    separate process, so they don't compete with the traced program for the GIL
+
+    Raw events are sent in batches of batch_size to cut pickling overhead."""
+
+    def __init__(self, log_path, capacity=65536, backpressure="block", sample_every=10, batch_size=1024, log_format="json"):
+        self.batch_size = batch_size
+        self.backpressure = Backpressure(backpressure, sample_every)
+        self.batch = []
+        self.batches = multiprocessing.Queue(maxsize=max(capacity // batch_size, 1))
+        self.events_queued = 0
+        self.writer = multiprocessing.Process(target=write_process, args=(self.batches, log_path, log_format), name="pylog-writer")
+        self.writer.daemon = True
+        self.writer.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def log_raw(self, raw):
+        self.batch.append(raw)
+        if len(self.batch) >= self.batch_size:
+            self.send_batch()
+
+    def send_batch(self):
+        batch, self.batch = self.batch, []
+        try:
+            self.batches.put_nowait(batch)
+        except queue.Full:
+            if self.backpressure.policy != "block":
+                batch = [
+                    raw for raw in batch
+                    if raw[0] != "line" or self.backpressure.keep_line(congested=True, full=True)
+                ]
+            self.batches.put(batch)
+        self.events_queued += len(batch)
+
+    def flush(self):
+        """Send the partial batch. The writer process flushes on its own"""
+        if self.batch:
+            self.send_batch()
+
+    def close(self):
+        """Send everything that's left and wait for the writer to finish"""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+
+    def stats(self):
+        return {
+            "events_queued": self.events_queued,
+            "events_dropped": self.backpressure.events_dropped,
+        }
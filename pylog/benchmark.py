@@ -0,0 +1,73 @@
+"""Measure how much each recorder slows a program down
+
+Runs a small recursive workload untraced and then under every recorder,
+with and without line logging, and prints the overhead per logged event.
+Events are counted and dropped rather than written, so the numbers cover
+dispatch and event construction but not serialization or disk I/O."""
+import timeit
+
+from pylog import debugger, tracer
+
+RECORDERS = (
+    ("bdb", debugger.LoggingDebugger),
+    ("trace", tracer.LoggingTracer),
+)
+
+class CountingEventLogger(object):
+    """An event logger that just counts events"""
+    def __init__(self):
+        self.count = 0
+
+    def log_event(self, event):
+        self.count += 1
+
+def workload(n):
+    if n < 3:
+        return 1
+    return workload(n - 1) + workload(n - 2)
+
+def time_untraced(n, repeat):
+    return min(timeit.repeat(lambda: workload(n), number=1, repeat=repeat))
+
+def time_recorder(recorder_class, options, n, repeat):
+    """returns (best time in seconds, events logged per run)"""
+    best = None
+    count = 0
+    for _ in range(repeat):
+        event_logger = CountingEventLogger()
+        recorder = recorder_class(event_logger, options=options)
+        start = timeit.default_timer()
+        recorder.set_trace()
+        workload(n)
+        recorder.set_quit()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        count = event_logger.count
+    return best, count
+
+def run(n=18, repeat=3):
+    """yields a result dict for each (recorder, log_lines) combination"""
+    baseline = time_untraced(n, repeat)
+    for log_lines in (False, True):
+        options = debugger.Options(log_lines=log_lines, log_args=True, log_retval=True)
+        for name, recorder_class in RECORDERS:
+            elapsed, count = time_recorder(recorder_class, options, n, repeat)
+            yield {
+                "recorder": name,
+                "log_lines": log_lines,
+                "events": count,
+                "seconds": elapsed,
+                "baseline_seconds": baseline,
+                "usec_per_event": (elapsed - baseline) / max(count, 1) * 1e6,
+            }
+
+def main(n=18, repeat=3):
+    row = "{recorder:<10}{log_lines:<8}{events:>10}{seconds:>10.3f}{usec_per_event:>14.2f}"
+    print("{0:<10}{1:<8}{2:>10}{3:>10}{4:>14}".format("recorder", "lines", "events", "seconds", "usec/event"))
+    for result in run(n, repeat):
+        result["log_lines"] = "yes" if result["log_lines"] else "no"
+        print(row.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Constants and helpers for the binary log format
+
+A binary log starts with MAGIC, followed by records. Each record starts
+with a one byte tag:
+* TAG_HEADER: the log header (see events.make_log_header). Body: varint
+    byte length, utf-8 JSON
+* TAG_STRING: adds a string to the string table. The string gets the next
+    id (starting at 0). Body: varint byte length, utf-8 bytes
+* TAG_THREAD: the events after it happened in another thread. Body: varint
+    thread id + 1 (0 means None). Events before the first one have no thread
+* TAG_PROCESS: the events after it happened in another process (in logs
+    merged from several, see processes.merge_shards). Body: varint process
+    id + 1 (0 means None). Events before the first one have no process
+* TAG_TASK: the events after it happened in another asyncio task. Body:
+    varint task id + 1 (0 means None). Events before the first one have no task
+* one of EVENT_TAGS: an event. Body:
+    * zigzag varint: nanoseconds since the previous event's timestamp
+        (the first event is relative to 0)
+    * varint: file name string id + 1 (0 means None)
+    * varint: line number + 1 (0 means None)
+    * function events only: varint function name string id + 1
+    * call, return, resume and suspend events only: the args/retval as a value
+    * sample events only: varint interval in ns, varint frame count, then for each frame (outermost first) varint function
+        name string id + 1, varint file name string id + 1 and varint
+        line number + 1
+A value is a varint kind (VALUE_NONE, VALUE_TEXT, VALUE_JSON), followed for
+the last two by a varint byte length and the utf-8 bytes.
+
+Strings are defined the first time they're used, so a log can be written
+and read as a stream.
+
+debugger.BinaryFileEventLogger writes this format and
+logreader.BinaryFileEventReader reads it."""
+MAGIC = b"\x89PYLOG\x01\n"
+
+TAG_STRING = 0x01
+TAG_HEADER = 0x02
+TAG_THREAD = 0x03
+TAG_PROCESS = 0x04
+TAG_TASK = 0x05
+EVENT_TAGS = {
+    "event": 0x10,
+    "line": 0x11,
+    "function": 0x12,
+    "call": 0x13,
+    "return": 0x14,
+    "exception": 0x15,
+    "sample": 0x16,
+    "resume": 0x17,
+    "suspend": 0x18,
+}
+TAG_EVENT_TYPES = dict((tag, event_type) for event_type, tag in EVENT_TAGS.items())
+FUNCTION_TAGS = frozenset(EVENT_TAGS[event_type] for event_type in ("function", "call", "return", "exception", "resume", "suspend"))
+VALUE_TAGS = frozenset(EVENT_TAGS[event_type] for event_type in ("call", "return", "resume", "suspend"))
+
+VALUE_NONE = 0
+VALUE_TEXT = 1
+VALUE_JSON = 2
+
+def encode_varint(value, out):
+    """append an unsigned varint to the bytearray out"""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def zigzag(value):
+    """map a signed int to an unsigned one so small magnitudes stay small"""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
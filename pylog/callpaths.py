@@ -0,0 +1,142 @@
+"""Call path aggregation, for classic (merged) flame graphs
+
+A CallPathTree merges every call made along the same call path (the same
+stack of Function.keys, from the outermost call down) into one node with
+summed counts and times. A loop calling a helper 100k times gives one node
+for the helper instead of 100k.
+
+The tree is built in one pass over the events, so memory grows with the
+number of distinct call paths, not with the number of events. It can be
+exported as nested JSON, or in the collapsed stack text format used by
+Brendan Gregg's flamegraph.pl and compatible tools: one line per call path,
+"frame;frame;frame value", where value is the exclusive time in ns."""
+from six import iteritems, itervalues
+
+from pylog.events import NS_PER_SECOND
+
+class CallPath(object):
+    """A node in a CallPathTree: every call made along one call path"""
+
+    def __init__(self, key=None):
+        #Function.key: (name, file name, line number). None for the root
+        self.key = key
+        #Function.key -> CallPath
+        self.children = {}
+        self.count = 0
+        #times in ns
+        self.inclusive = 0
+        self.exclusive = 0
+
+    def child(self, key):
+        try:
+            return self.children[key]
+        except KeyError:
+            child = self.children[key] = CallPath(key)
+            return child
+
+    def merge(self, other):
+        #(path, path of other to add to it). Not recursive: call paths can be deeper than the recursion limit
+        pending = [(self, other)]
+        while pending:
+            path, other_path = pending.pop()
+            path.count += other_path.count
+            path.inclusive += other_path.inclusive
+            path.exclusive += other_path.exclusive
+            pending.extend((path.child(key), child) for key, child in iteritems(other_path.children))
+
+    def frame_name(self):
+        name, file_name, line_number = self.key
+        #; separates frames in the collapsed format
+        return "{0} ({1}:{2})".format(name, file_name, line_number).replace(";", ",")
+
+    def to_data(self):
+        result = []
+        #(path, the list its data goes in), the children of a path pushed so they're popped the longest first
+        pending = [(self, result)]
+        while pending:
+            path, siblings = pending.pop()
+            name, file_name, line_number = path.key if path.key else ("all", None, None)
+            data = {
+                "name": name,
+                "file_name": file_name,
+                "line_number": line_number,
+                "calls": path.count,
+                "inclusive": float(path.inclusive) / NS_PER_SECOND,
+                "exclusive": float(path.exclusive) / NS_PER_SECOND,
+                "children": [],
+            }
+            siblings.append(data)
+            children = sorted(itervalues(path.children), key=lambda child: child.inclusive, reverse=True)
+            pending.extend((child, data["children"]) for child in reversed(children))
+        return result[0]
+
+class CallPathTree(object):
+    def __init__(self):
+        self.root = CallPath()
+        #(process id, thread id) -> [CallPath, start time, time spent in callees, whether it's a new call]
+        #for each running call. The call paths of all the threads are merged. Resumed generators and
+        #coroutines add their time to the path they're resumed on, but aren't counted as calls again
+        self.call_stacks = {}
+        self.stop_time = None
+
+    @classmethod
+    def from_events(cls, events):
+        result = cls()
+        result.add_events(events)
+        result.finish()
+        return result
+
+    def add_events(self, events):
+        """Add the calls that end in events. Calls still running are added by finish"""
+        call_stacks = self.call_stacks
+        for event in events:
+            timestamp = event.timestamp
+            if self.stop_time is None or timestamp > self.stop_time:
+                self.stop_time = timestamp
+            if event.stack_change > 0:
+                call_stack = call_stacks.setdefault((event.process_id, event.thread_id), [])
+                parent = call_stack[-1][0] if call_stack else self.root
+                key = (event.function_name, event.file_name, event.line_number)
+                call_stack.append([parent.child(key), timestamp, 0, event.event_type != "resume"])
+            elif event.stack_change < 0:
+                call_stack = call_stacks.get((event.process_id, event.thread_id))
+                if call_stack:
+                    self.end_call(call_stack, timestamp)
+
+    def finish(self):
+        """End the calls that haven't returned at the last event"""
+        for call_stack in itervalues(self.call_stacks):
+            while call_stack:
+                self.end_call(call_stack, self.stop_time)
+
+    def end_call(self, call_stack, timestamp):
+        path, start, callee_time, counted = call_stack.pop()
+        duration = timestamp - start
+        path.count += counted
+        path.inclusive += duration
+        path.exclusive += duration - callee_time
+        if call_stack:
+            call_stack[-1][2] += duration
+        else:
+            self.root.count += counted
+            self.root.inclusive += duration
+
+    def merge(self, other):
+        self.root.merge(other.root)
+
+    def to_data(self):
+        return self.root.to_data()
+
+    def iter_collapsed(self):
+        """Yields the lines of the collapsed stack format"""
+        #(path, frames above it)
+        pending = [(child, ()) for child in itervalues(self.root.children)]
+        while pending:
+            path, frames = pending.pop()
+            frames += (path.frame_name(),)
+            if path.exclusive > 0:
+                yield "{0} {1}\n".format(";".join(frames), path.exclusive)
+            pending.extend((child, frames) for child in itervalues(path.children))
+
+    def to_collapsed(self):
+        return "".join(sorted(self.iter_collapsed()))
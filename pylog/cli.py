@@ -1,21 +1,62 @@
 """Execution logger
 
 Usage:
-  pylog <command> [<program> [<args>...]] [--output=FILE]
+  pylog <command> [<program> [<args>...]] [--output=FILE] [--recorder=NAME] [--writer=MODE] [--backpressure=POLICY] [--format=FORMAT] [--sample-hz=HZ] [--processes] [--index] [--sort=COLUMN] [--limit=N] [--json] [--pstats=FILE] [--jobs=N] [--collector=SOCKET]
 
 Options:
   -o FILE --output=FILE  output file [default: log.txt]
+  --recorder=NAME        bdb (LoggingDebugger) or trace (LoggingTracer) [default: bdb]
+  --writer=MODE          where events are serialized: inline, thread or process [default: inline]
+  --backpressure=POLICY  when a thread/process writer falls behind: block, drop_lines or sample [default: block]
+  --format=FORMAT        log format to write: json or binary [default: json]
+  --sample-hz=HZ         record: sample the stacks HZ times a second instead of tracing every call
+  --processes            record: also record the processes the program forks or spawns, one shard (<output>.<pid>)
+                         per process, and merge the shards into --output at the end. Shards are written inline
+  --index                also write a sidecar index (<output>.idx) after recording, or collect: after collecting
+                         each log
+  --collector=SOCKET     record: send the events to the `pylog collect` listening on SOCKET instead of writing them
+                         to --output
+  --sort=COLUMN          stats: calls, inclusive, active, exclusive, max or name [default: inclusive]
+  --limit=N              stats: how many functions to show [default: 30]
+  --json                 stats: print JSON instead of a table
+  --pstats=FILE          stats: also save the stats in pstats format
+  --jobs=N               stats: analyse the log in N processes [default: 1]
 
 Commands:
   test: run the tests
   record: log an execution
+  bench: compare the overhead of the recorders
+  convert: convert the log <program> to --format, writing it to --output
+  index: write a sidecar index (<program>.idx) for the log <program>
+  merge: merge the logs <program> <args>... (default: the shards of --output) into --output, in time order
+  stats: show per-function call counts and times for the log <program>
+  collect: write the logs of the programs recorded with --collector=<program>, one binary log per process
+           (<output>.<pid>, compressed if --output ends with .gz, .zst or .lz4), until interrupted
 
 """
 import docopt
+import os
 import subprocess
 import sys
 
-from pylog import test_pylog, debugger
+from pylog import test_pylog, debugger, tracer, benchmark, background, logreader, logindex, sampler, processes, parallel, collector
+
+RECORDERS = {
+    "bdb": debugger.LoggingDebugger,
+    "trace": tracer.LoggingTracer,
+}
+
+def make_event_logger(options):
+    if options["--collector"]:
+        event_logger = collector.SocketEventLogger(options["--collector"])
+    elif options["--writer"] == "process":
+        return background.ProcessEventLogger(
+            options["--output"], backpressure=options["--backpressure"], log_format=options["--format"])
+    else:
+        event_logger = debugger.open_event_logger(options["--output"], options["--format"])
+    if options["--writer"] == "thread":
+        return background.BackgroundEventLogger(event_logger, backpressure=options["--backpressure"])
+    return event_logger
 
 def main():
     options = docopt.docopt(__doc__)
@@ -23,10 +64,63 @@ def main():
     if options["<command>"] == "test":
         print "testing"
     elif options["<command>"] == "record":
-        log_file = open(options["--output"], "w")
-        event_logger = debugger.JsonFileEventLogger(log_file)
-        debug_options = debugger.Options(log_lines=True, log_args=True, log_retval=True)
-        dbg = debugger.LoggingDebugger(event_logger, options=debug_options)
+        debug_options = dict(log_lines=True, log_args=True, log_retval=True, trace_threads=True, trace_tasks=True)
         program = options["<program>"]
         sys.argv = [program] + options["<args>"]
-        dbg.run("execfile('{0}')".format(program))
+        cmd = "execfile('{0}')".format(program)
+        if options["--processes"]:
+            pid = os.getpid()
+            recording = processes.ShardedRecording(
+                options["--output"], RECORDERS[options["--recorder"]], options["--format"], debug_options,
+                collector=options["--collector"])
+            recording.run(cmd)
+            if os.getpid() != pid:
+                #a forked child that ran to the end of the program
+                return
+            if not options["--collector"]:
+                processes.merge_recording(options["--output"], options["--format"])
+        else:
+            event_logger = make_event_logger(options)
+            if options["--sample-hz"]:
+                dbg = sampler.SamplingRecorder(event_logger, hz=float(options["--sample-hz"]))
+            else:
+                dbg = RECORDERS[options["--recorder"]](event_logger, options=debugger.Options(**debug_options))
+            dbg.run(cmd)
+            event_logger.close()
+        if options["--index"] and not options["--collector"]:
+            logindex.LogIndex.build(options["--output"]).save(logindex.index_path(options["--output"]))
+    elif options["<command>"] == "bench":
+        benchmark.main()
+    elif options["<command>"] == "convert":
+        event_logger = debugger.open_event_logger(options["--output"], options["--format"])
+        with open(options["<program>"], "rb") as log_file:
+            for event in logreader.get_reader(log_file).iter_events():
+                event_logger.log_event(event)
+        event_logger.close()
+    elif options["<command>"] == "merge":
+        if options["<program>"]:
+            log_paths = [options["<program>"]] + options["<args>"]
+        else:
+            log_paths = processes.find_shards(options["--output"])
+        event_logger = debugger.open_event_logger(options["--output"], options["--format"])
+        processes.merge_shards(log_paths, event_logger)
+        event_logger.close()
+    elif options["<command>"] == "index":
+        log_path = options["<program>"]
+        logindex.LogIndex.build(log_path).save(logindex.index_path(log_path))
+    elif options["<command>"] == "stats":
+        profile = parallel.profile_stats(options["<program>"], jobs=int(options["--jobs"]))
+        if options["--pstats"]:
+            profile.dump_pstats(options["--pstats"])
+        if options["--json"]:
+            print profile.to_json(options["--sort"])
+        else:
+            print profile.format_table(options["--sort"], int(options["--limit"]))
+    elif options["<command>"] == "collect":
+        log_collector = collector.Collector(options["<program>"], options["--output"], index=options["--index"])
+        try:
+            log_collector.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log_collector.close()
@@ -0,0 +1,79 @@
+"""Decides what gets logged for a piece of code
+
+Whether a frame should be logged only depends on its code object (and the
+module it runs in), so the decision is made once per code object and cached
+instead of being redone for every call, line and return event.
+
+Decisions are keyed by the identity of the code object. Reloading a module
+creates new code objects, so reloaded code gets a fresh decision; call
+CodeFilter.invalidate to also drop the decisions for the old code."""
+import collections
+import fnmatch
+import os
+
+FilterDecision = collections.namedtuple("FilterDecision", ["trace", "log_lines", "log_args"])
+UNTRACED = FilterDecision(trace=False, log_lines=False, log_args=False)
+
+def strip_extension(file_name):
+    """foo.pyc and foo.py belong to the same module"""
+    return os.path.splitext(os.path.abspath(file_name))[0]
+
+class CodeFilter(object):
+    def __init__(self, options, skip=None):
+        """options: a debugger.Options
+        skip: glob patterns of module names to ignore, like bdb.Bdb's skip"""
+        self.options = options
+        self.skip = set(skip) if skip else None
+        #id(code) -> FilterDecision
+        self.decisions = {}
+        #id(code) -> code. Keeps the code objects alive so that ids aren't reused
+        self.codes = {}
+
+    def decide(self, frame):
+        """Return the FilterDecision for the code running in frame"""
+        try:
+            return self.decisions[id(frame.f_code)]
+        except KeyError:
+            decision = self.make_decision(frame)
+            self.decisions[id(frame.f_code)] = decision
+            self.codes[id(frame.f_code)] = frame.f_code
+            return decision
+
+    def make_decision(self, frame):
+        if self.is_skipped_module(frame.f_globals.get("__name__")):
+            return UNTRACED
+        if self.options["explicit_only"] and not self.is_explicitly_logged(frame):
+            return UNTRACED
+        return FilterDecision(
+            trace=True,
+            log_lines=self.options["log_lines"],
+            log_args=self.options["log_args"],
+        )
+
+    def is_skipped_module(self, module_name):
+        if not self.skip:
+            return False
+        for pattern in self.skip:
+            if fnmatch.fnmatch(module_name or "", pattern):
+                return True
+        return False
+
+    def is_explicitly_logged(self, frame):
+        """True if the function was decorated with debugger.log_function"""
+        function = frame.f_globals.get(frame.f_code.co_name)
+        return getattr(function, "__log_call", False)
+
+    def invalidate(self, module=None):
+        """Forget cached decisions
+
+        module: if given, only forget decisions for code from this module
+            (e.g. after reloading it)"""
+        if module is None:
+            self.decisions.clear()
+            self.codes.clear()
+            return
+        module_file = strip_extension(module.__file__)
+        for code_id, code in list(self.codes.items()):
+            if strip_extension(code.co_filename) == module_file:
+                del self.decisions[code_id]
+                del self.codes[code_id]
@@ -0,0 +1,175 @@
+"""Recording to a collector process instead of to a file
+
+SocketEventLogger is an event logger (like the ones
+debugger.open_event_logger returns) that sends the events to a collector
+over a Unix domain socket instead of writing them. It encodes them in the
+binary format (see binformat) and sends what it has buffered as one frame
+(a 4 byte little endian length, then complete records) every flush_bytes
+bytes, on flush()/close() and at exit.
+
+Collector (`pylog collect <socket> --output=log.bin`) serves any number of
+connections from one thread and writes each to its own binary log at
+processes.shard_path(output, pid), pid being the one in the connection's log
+header. So a `pylog record --processes --collector=<socket>` recording is
+collected as shards, which `pylog merge --output=log.bin` merges. The
+collector compresses the logs when output's extension names a codec
+(log.bin.gz: gzip, see compression), and can also index each log (see
+logindex) once its connection closes. The traced processes only encode their events: all the disk I/O
+happens in the collector, which doesn't decode them either.
+
+A frame cut off by a connection that breaks is dropped, so collected logs
+end with a complete record. If the collector goes away, the events the
+traced process still sends are dropped."""
+import json
+import os
+import select
+import socket
+import struct
+
+from pylog import binformat, debugger, logindex, logreader, processes
+from pylog.compression import CompressedWriter, codec_for_path
+
+FRAME_HEADER = struct.Struct("<I")
+RECEIVE_BYTES = 1 << 16
+
+def connect(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+class FrameWriter(object):
+    """A binary stream over a socket that sends every write as one frame"""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data):
+        self.sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+class SocketEventLogger(debugger.BinaryFileEventLogger):
+    """Sends events to a Collector listening at address"""
+
+    def __init__(self, address, flush_bytes=1 << 16):
+        super(SocketEventLogger, self).__init__(FrameWriter(connect(address)), flush_bytes)
+        self.frames_dropped = 0
+
+    def flush(self):
+        try:
+            super(SocketEventLogger, self).flush()
+        except (IOError, OSError):
+            #the collector went away
+            self.frames_dropped += 1
+            del self.buffer[:]
+
+def read_header(frame):
+    """The log header at the start of a connection's first frame"""
+    if frame[:len(binformat.MAGIC)] != binformat.MAGIC or frame[len(binformat.MAGIC)] != binformat.TAG_HEADER:
+        raise ValueError("Not a binary pylog log")
+    header, _ = logreader.decode_bytes(frame, len(binformat.MAGIC) + 1)
+    return json.loads(header.decode("utf-8"))
+
+class Connection(object):
+    """A traced process sending its events to a Collector"""
+
+    def __init__(self, collector, sock):
+        self.collector = collector
+        self.sock = sock
+        #what's been received of the frames that haven't been written
+        self.buffer = bytearray()
+        self.log_path = None
+        self.log_file = None
+
+    def receive(self):
+        """Write the frames that have arrived. Returns False once the process has disconnected"""
+        data = self.sock.recv(RECEIVE_BYTES)
+        if not data:
+            return False
+        buf = self.buffer
+        buf.extend(data)
+        pos = 0
+        while len(buf) - pos >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(buf, pos)
+            end = pos + FRAME_HEADER.size + length
+            if end > len(buf):
+                break
+            self.write_frame(buf[pos + FRAME_HEADER.size:end])
+            pos = end
+        del buf[:pos]
+        return True
+
+    def write_frame(self, frame):
+        if self.log_file is None:
+            self.log_path = processes.shard_path(self.collector.output, read_header(frame).get("pid"))
+            self.log_file = open(self.log_path, "wb")
+            if self.collector.compression is not None:
+                self.log_file = CompressedWriter(self.log_file, self.collector.compression)
+            self.collector.log_paths.append(self.log_path)
+        self.log_file.write(frame)
+
+    def close(self):
+        self.sock.close()
+        if self.log_file is None:
+            return
+        self.log_file.close()
+        if self.collector.index:
+            logindex.LogIndex.build(self.log_path).save(logindex.index_path(self.log_path))
+
+class Collector(object):
+    """Writes the logs of the processes that connect to a Unix domain socket"""
+
+    def __init__(self, address, output, index=False, compression=None):
+        """address: the path of the socket. A file already there is replaced
+        output: each process's log is written to processes.shard_path(output, pid)
+        index: index each log once its process disconnects
+        compression: a codec from compression.CODECS to compress the logs with. Default: the one output's extension
+            names, if any"""
+        self.address = address
+        self.output = output
+        self.index = index
+        self.compression = compression or codec_for_path(output)
+        #the logs written, in the order the processes connected
+        self.log_paths = []
+        #socket -> Connection
+        self.connections = {}
+        if os.path.exists(address):
+            os.remove(address)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(64)
+
+    def serve(self, timeout=None):
+        """Handle the connections and data that arrive within timeout seconds"""
+        readable, _, _ = select.select([self.server] + list(self.connections), [], [], timeout)
+        for sock in readable:
+            if sock is self.server:
+                client, _ = self.server.accept()
+                self.connections[client] = Connection(self, client)
+                continue
+            connection = self.connections[sock]
+            try:
+                connected = connection.receive()
+            except (IOError, OSError, ValueError):
+                #a broken connection or something that isn't a pylog log
+                connected = False
+            if not connected:
+                del self.connections[sock]
+                connection.close()
+
+    def serve_forever(self, poll_seconds=1.0):
+        while True:
+            self.serve(poll_seconds)
+
+    def close(self):
+        """Close the connections (dropping frames they were cut off in) and stop listening"""
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.connections = {}
+        self.server.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
@@ -0,0 +1,260 @@
+"""Compressed logs, in blocks that can be decompressed on their own
+
+CompressedWriter compresses what's written to it in blocks of about
+block_size (1MB) uncompressed bytes. Each block is a complete frame of its
+codec, so the standard tools decompress a whole log (`zcat log.txt.gz`):
+* gzip: a gzip member whose header has an extra field ("PL", 4 bytes: the
+    size of the whole member), like the blocks of bgzip
+* zstd, lz4 (need the zstandard and lz4 packages): a skippable frame (8
+    bytes: the compressed and the uncompressed size of the block) followed
+    by a frame with the block
+so the blocks of a log are found from their headers, without decompressing
+anything. BlockReader reads a log through its blocks: seeking to an
+uncompressed offset (e.g. a logindex checkpoint, or a parallel chunk)
+only decompresses the block it's in, so indexed access and splitting a log
+between processes work on compressed logs too.
+
+Blocks end when they're full and when the log is closed (or at exit), not on
+flush, so a recording that's killed loses up to a block of events: readers
+skip a block that's cut off.
+
+open_compressed gives a reader for any log file, compressed or not (plain
+gzip files are read in sequence). debugger.open_event_logger compresses
+logs whose names end with one of EXTENSIONS."""
+import atexit
+import bisect
+import gzip
+import io
+import struct
+import zlib
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_LEVEL = 6
+CODECS = ("gzip", "zstd", "lz4")
+EXTENSIONS = {".gz": "gzip", ".zst": "zstd", ".lz4": "lz4"}
+
+GZIP_MAGIC = b"\x1f\x8b"
+#ID1 ID2, deflate, FEXTRA, no mtime, no extra flags, unknown OS, XLEN, "PL" subfield of 4 bytes
+GZIP_HEADER = struct.Struct("<2sBBIBBH2sHI")
+GZIP_TRAILER = struct.Struct("<II")
+GZIP_SUBFIELD = b"PL"
+#zstd and lz4 skip frames with this magic number (little endian)
+SKIPPABLE_MAGIC = 0x184D2A50
+SKIPPABLE_FRAME = struct.Struct("<IIII")
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+LZ4_MAGIC = b"\x04\x22\x4d\x18"
+
+def codec_for_path(path):
+    """The codec the extension of path names, None if it doesn't name one"""
+    for extension, codec in EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+def import_codec(codec):
+    """The module that compresses with a codec that needs an optional package"""
+    try:
+        if codec == "zstd":
+            import zstandard
+            return zstandard
+        import lz4.frame
+        return lz4.frame
+    except ImportError:
+        raise ValueError("Compressing with {0} needs the {1} package".format(
+            codec, "zstandard" if codec == "zstd" else "lz4"))
+
+def compress_block(codec, data, level=DEFAULT_LEVEL):
+    """A block of a compressed log, holding data"""
+    if codec == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        size = GZIP_HEADER.size + len(deflated) + GZIP_TRAILER.size
+        return b"".join([
+            GZIP_HEADER.pack(GZIP_MAGIC, 8, 4, 0, 0, 255, 8, GZIP_SUBFIELD, 4, size),
+            deflated,
+            GZIP_TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff),
+        ])
+    if codec == "zstd":
+        frame = import_codec(codec).ZstdCompressor(level=level).compress(data)
+    elif codec == "lz4":
+        frame = import_codec(codec).compress(data, compression_level=level)
+    else:
+        raise ValueError("Unknown compression: {0}".format(codec))
+    return SKIPPABLE_FRAME.pack(SKIPPABLE_MAGIC, 8, len(frame), len(data)) + frame
+
+def decompress_block(codec, block):
+    """The data of a block from compress_block"""
+    if codec == "gzip":
+        return zlib.decompress(block, 16 + zlib.MAX_WBITS)
+    frame = block[SKIPPABLE_FRAME.size:]
+    if codec == "zstd":
+        return import_codec(codec).ZstdDecompressor().decompress(frame)
+    return import_codec(codec).decompress(frame)
+
+def detect(start):
+    """The codec of a log from its first bytes: gzip, zstd or lz4 for blocked logs, "gzip_stream" for other gzip
+    files, None if it isn't compressed"""
+    if start[:2] == GZIP_MAGIC:
+        if len(start) >= GZIP_HEADER.size:
+            header = GZIP_HEADER.unpack(start[:GZIP_HEADER.size])
+            if header[2] == 4 and header[6] == 8 and header[7] == GZIP_SUBFIELD:
+                return "gzip"
+        return "gzip_stream"
+    if len(start) >= SKIPPABLE_FRAME.size + 4 and struct.unpack("<I", start[:4])[0] == SKIPPABLE_MAGIC:
+        frame_magic = start[SKIPPABLE_FRAME.size:SKIPPABLE_FRAME.size + 4]
+        if frame_magic == ZSTD_MAGIC:
+            return "zstd"
+        if frame_magic == LZ4_MAGIC:
+            return "lz4"
+    return None
+
+def scan_blocks(raw_file, codec):
+    """(offset, size, uncompressed size) of every block of a log, read from their headers. Stops at a block that's
+    cut off (the last one a killed recording was writing)"""
+    raw_file.seek(0, io.SEEK_END)
+    file_size = raw_file.tell()
+    blocks = []
+    offset = 0
+    while True:
+        raw_file.seek(offset)
+        if codec == "gzip":
+            header = raw_file.read(GZIP_HEADER.size)
+            if len(header) < GZIP_HEADER.size:
+                break
+            size = GZIP_HEADER.unpack(header)[-1]
+            if offset + size > file_size:
+                break
+            raw_file.seek(offset + size - 4)
+            uncompressed_size, = struct.unpack("<I", raw_file.read(4))
+        else:
+            header = raw_file.read(SKIPPABLE_FRAME.size)
+            if len(header) < SKIPPABLE_FRAME.size:
+                break
+            _, _, frame_size, uncompressed_size = SKIPPABLE_FRAME.unpack(header)
+            size = SKIPPABLE_FRAME.size + frame_size
+            if offset + size > file_size:
+                break
+        blocks.append((offset, size, uncompressed_size))
+        offset += size
+    return blocks
+
+class CompressedWriter(object):
+    """A binary stream that compresses what's written to it, in blocks. Text is written as utf-8
+
+    Blocks only end between writes, which the event loggers make of whole
+    records, so the blocks left of a log that's cut off hold whole events"""
+
+    def __init__(self, raw_file, codec="gzip", block_size=DEFAULT_BLOCK_SIZE, level=DEFAULT_LEVEL):
+        """raw_file: a stream opened in binary mode"""
+        if codec not in CODECS:
+            raise ValueError("Unknown compression: {0}".format(codec))
+        if codec != "gzip":
+            import_codec(codec)
+        self.raw_file = raw_file
+        self.codec = codec
+        self.block_size = block_size
+        self.level = level
+        self.buffer = bytearray()
+        atexit.register(self.end_block)
+
+    def write(self, data):
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode("utf-8")
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.block_size:
+            self.end_block()
+
+    def end_block(self):
+        """Write what's buffered as a block, however small"""
+        if self.buffer and not self.raw_file.closed:
+            self.raw_file.write(compress_block(self.codec, bytes(self.buffer), self.level))
+            del self.buffer[:]
+            self.raw_file.flush()
+
+    def flush(self):
+        #doesn't end the block: a block per flush would compress badly
+        self.raw_file.flush()
+
+    @property
+    def closed(self):
+        return self.raw_file.closed
+
+    def close(self):
+        if self.raw_file.closed:
+            return
+        self.end_block()
+        self.raw_file.close()
+
+class BlockReader(io.RawIOBase):
+    """The decompressed bytes of a blocked log, seekable. Only the block being read is kept decompressed.
+    Closing it leaves raw_file open, like gzip.GzipFile"""
+
+    def __init__(self, raw_file, codec):
+        self.raw_file = raw_file
+        self.codec = codec
+        blocks = scan_blocks(raw_file, codec)
+        self.offsets = [offset for offset, _, _ in blocks]
+        self.sizes = [size for _, size, _ in blocks]
+        #uncompressed offset of the start of each block, and of the end of the log
+        self.starts = [0]
+        for _, _, uncompressed_size in blocks:
+            self.starts.append(self.starts[-1] + uncompressed_size)
+        self.position = 0
+        #(number, data) of the block last decompressed
+        self.block = (None, b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.starts[-1]
+        if offset < 0:
+            raise ValueError("Negative seek position {0}".format(offset))
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def get_block(self, number):
+        if self.block[0] != number:
+            self.raw_file.seek(self.offsets[number])
+            self.block = (number, decompress_block(self.codec, self.raw_file.read(self.sizes[number])))
+        return self.block[1]
+
+    def readinto(self, buf):
+        if self.position >= self.starts[-1]:
+            return 0
+        number = bisect.bisect_right(self.starts, self.position) - 1
+        data = self.get_block(number)
+        start = self.position - self.starts[number]
+        chunk = data[start:start + len(buf)]
+        buf[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+def open_compressed(log_file):
+    """log_file if it isn't compressed, else a binary stream of its decompressed contents
+
+    log_file: a log opened in binary mode. Streams that can't seek (and
+    text streams) are returned as they are"""
+    try:
+        position = log_file.tell()
+        start = log_file.read(max(GZIP_HEADER.size, SKIPPABLE_FRAME.size + 4))
+        log_file.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        return log_file
+    if not isinstance(start, bytes):
+        return log_file
+    codec = detect(start)
+    if codec is None:
+        return log_file
+    if codec == "gzip_stream":
+        return gzip.GzipFile(fileobj=log_file, mode="rb")
+    return io.BufferedReader(BlockReader(log_file, codec), buffer_size=1 << 16)
@@ -8,18 +8,57 @@ Commands:
   test: run the tests
 
 """
+import atexit
 import bdb
 import collections
+import dis
 import inspect
 import json
 import os
-from events import LineEvent, CallEvent, ReturnEvent, ExceptionEvent, FunctionSet, FunctionCall
+import sys
+import threading
+import timeit
+
+import six
+from six.moves import _thread
+
+from pylog import binformat
+from pylog.compression import CompressedWriter, codec_for_path
+from pylog.codefilter import CodeFilter
+from pylog.events import (LineEvent, CallEvent, ReturnEvent, ResumeEvent, SuspendEvent, ExceptionEvent,
+    FunctionSet, FunctionCall, make_log_header, now_ns, event_from_raw)
+
+get_thread_id = _thread.get_ident
+
+def get_task_id():
+    """id of the asyncio task running in this thread, None outside of tasks"""
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return None
+    task = asyncio.current_task(loop)
+    return None if task is None else id(task)
+
+#co_flags of generators, coroutines and async generators
+GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200
+#StopIterations raised in generator frames are how yield from and await get their result, not errors
+PROTOCOL_EXCEPTIONS = (StopIteration, getattr(six.moves.builtins, "StopAsyncIteration", StopIteration))
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+#python 3.3 to 3.10: f_lasti of a frame suspended in a yield from is moved back so it runs YIELD_FROM again
+YIELD_FROM = dis.opmap.get("YIELD_FROM")
+#python 3.11+: generator frames start with RESUME 0, and each yield is followed by a RESUME whose oparg's
+#low bits aren't 0. In 3.13, a suspended frame's f_lasti is already on that RESUME
+RESUME = dis.opmap.get("RESUME")
 
 class ProgramState(object):
-    def __init__(self, file_name, line_number, function_name):
+    def __init__(self, file_name, line_number, function_name, thread_id=None, task_id=None):
         self.file_name = file_name
         self.line_number = line_number
         self.function_name = function_name
+        self.thread_id = thread_id
+        self.task_id = task_id
 
     def to_data(self):
         return [self.file_name, self.line_number, self.function_name]
@@ -29,15 +68,17 @@ class ProgramState(object):
         return cls(*data)
 
     @classmethod
-    def from_frame(cls, frame):
+    def from_frame(cls, frame, task_id=None):
         return cls(
             file_name=os.path.abspath(frame.f_code.co_filename),
             line_number=frame.f_lineno,
             function_name=frame.f_code.co_name,
+            thread_id=get_thread_id(),
+            task_id=task_id,
         )
 
-State = collections.namedtuple("State", ["file_name", "line_number", "function_name", "args", "retval", "exception"])
-def get_state(frame, args=None, retval=None, exception=None):
+State = collections.namedtuple("State", ["file_name", "line_number", "function_name", "args", "retval", "exception", "thread_id", "task_id"])
+def get_state(frame, args=None, retval=None, exception=None, task_id=None):
     return State(
         file_name=os.path.abspath(frame.f_code.co_filename),
         line_number=frame.f_lineno,
@@ -45,6 +86,8 @@ def get_state(frame, args=None, retval=None, exception=None):
         args=args,
         retval=retval,
         exception=exception,
+        thread_id=get_thread_id(),
+        task_id=task_id,
     )
 
 def log_function(f):
@@ -56,10 +99,283 @@ class JsonFileEventLogger(object):
     def __init__(self, log_file):
         """log_file: an apen stream to write to"""
         self.log_file = log_file
+        self.log_file.write(json.dumps(make_log_header()) + "\n")
 
     def log_event(self, event):
         self.log_file.write(json.dumps(event.to_data()) + "\n")
 
+    def flush(self):
+        self.log_file.flush()
+
+FlushPolicy = collections.namedtuple("FlushPolicy", ["max_events", "max_seconds"])
+DEFAULT_FLUSH_POLICY = FlushPolicy(max_events=4096, max_seconds=1.0)
+
+class BufferedJsonFileEventLogger(object):
+    """Writes the same format as JsonFileEventLogger, but in batches
+
+    Events are kept in a preallocated ring buffer and serialized together
+    with one reused encoder, so there's one write per batch instead of one
+    per event. The buffer is flushed when it holds flush_policy.max_events
+    events, when flush_policy.max_seconds have passed since the last flush,
+    on flush()/close() (the recorders flush on set_quit) and at exit."""
+
+    def __init__(self, log_file, flush_policy=DEFAULT_FLUSH_POLICY):
+        """log_file: an open stream to write to"""
+        self.log_file = log_file
+        self.log_file.write(json.dumps(make_log_header()) + "\n")
+        self.flush_policy = flush_policy
+        self.buffer = [None] * flush_policy.max_events
+        self.buffered = 0
+        self.encoder = json.JSONEncoder()
+        self.last_flush_time = timeit.default_timer()
+        self.events_written = 0
+        self.events_dropped = 0
+        self.flush_count = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        atexit.register(self.flush)
+
+    def log_event(self, event):
+        self.buffer[self.buffered] = event
+        self.buffered += 1
+        if (self.buffered == self.flush_policy.max_events or
+                timeit.default_timer() - self.last_flush_time >= self.flush_policy.max_seconds):
+            self.flush()
+
+    def flush(self):
+        start = timeit.default_timer()
+        count = self.buffered
+        if count:
+            encode = self.encoder.encode
+            chunk = "\n".join([encode(event.to_data()) for event in self.buffer[:count]]) + "\n"
+            for i in range(count):
+                self.buffer[i] = None
+            self.buffered = 0
+            try:
+                self.log_file.write(chunk)
+                self.log_file.flush()
+            except (IOError, OSError, ValueError):
+                #ValueError: the file was already closed
+                self.events_dropped += count
+            else:
+                self.events_written += count
+        self.last_flush_time = timeit.default_timer()
+        if count:
+            elapsed = self.last_flush_time - start
+            self.flush_count += 1
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def close(self):
+        self.flush()
+        self.log_file.close()
+
+    def stats(self):
+        """counters describing how the logger has performed so far"""
+        return {
+            "events_written": self.events_written,
+            "events_dropped": self.events_dropped,
+            "events_buffered": self.buffered,
+            "flush_count": self.flush_count,
+            "flush_seconds": self.flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
+
+class BinaryFileEventLogger(object):
+    """Writes events in the compact binary format described in binformat
+
+    Records are collected in a bytearray and written once it holds
+    flush_bytes bytes, on flush()/close() and at exit."""
+
+    def __init__(self, log_file, flush_bytes=1 << 16):
+        """log_file: a stream opened in binary mode"""
+        self.log_file = log_file
+        self.flush_bytes = flush_bytes
+        self.buffer = bytearray(binformat.MAGIC)
+        header = json.dumps(make_log_header()).encode("utf-8")
+        self.buffer.append(binformat.TAG_HEADER)
+        binformat.encode_varint(len(header), self.buffer)
+        self.buffer.extend(header)
+        #string -> id
+        self.strings = {}
+        self.last_timestamp = 0
+        self.last_thread_id = None
+        self.last_process_id = None
+        self.last_task_id = None
+        atexit.register(self.flush)
+
+    def string_id(self, string):
+        """id + 1 of the string, defining it first if it's new. 0 for None"""
+        if string is None:
+            return 0
+        try:
+            return self.strings[string] + 1
+        except KeyError:
+            string_id = self.strings[string] = len(self.strings)
+            encoded = string.encode("utf-8")
+            self.buffer.append(binformat.TAG_STRING)
+            binformat.encode_varint(len(encoded), self.buffer)
+            self.buffer.extend(encoded)
+            return string_id + 1
+
+    def encode_value(self, value):
+        if value is None:
+            self.buffer.append(binformat.VALUE_NONE)
+            return
+        if isinstance(value, six.string_types):
+            kind = binformat.VALUE_TEXT
+            encoded = value.encode("utf-8")
+        else:
+            kind = binformat.VALUE_JSON
+            encoded = json.dumps(value).encode("utf-8")
+        self.buffer.append(kind)
+        binformat.encode_varint(len(encoded), self.buffer)
+        self.buffer.extend(encoded)
+
+    def log_event(self, event):
+        tag = binformat.EVENT_TAGS[event.event_type]
+        file_id = self.string_id(event.file_name)
+        function_id = self.string_id(event.function_name) if tag in binformat.FUNCTION_TAGS else None
+        if tag == binformat.EVENT_TAGS["sample"]:
+            frames = [
+                (self.string_id(function_name), self.string_id(file_name), line_number)
+                for function_name, file_name, line_number in event.stack
+            ]
+        timestamp = event.timestamp
+        out = self.buffer
+        if event.thread_id != self.last_thread_id:
+            out.append(binformat.TAG_THREAD)
+            binformat.encode_varint(0 if event.thread_id is None else event.thread_id + 1, out)
+            self.last_thread_id = event.thread_id
+        if event.process_id != self.last_process_id:
+            out.append(binformat.TAG_PROCESS)
+            binformat.encode_varint(0 if event.process_id is None else event.process_id + 1, out)
+            self.last_process_id = event.process_id
+        if event.task_id != self.last_task_id:
+            out.append(binformat.TAG_TASK)
+            binformat.encode_varint(0 if event.task_id is None else event.task_id + 1, out)
+            self.last_task_id = event.task_id
+        out.append(tag)
+        binformat.encode_varint(binformat.zigzag(timestamp - self.last_timestamp), out)
+        self.last_timestamp = timestamp
+        binformat.encode_varint(file_id, out)
+        binformat.encode_varint(0 if event.line_number is None else event.line_number + 1, out)
+        if function_id is not None:
+            binformat.encode_varint(function_id, out)
+        if tag == binformat.EVENT_TAGS["call"] or tag == binformat.EVENT_TAGS["resume"]:
+            self.encode_value(event.args)
+        elif tag == binformat.EVENT_TAGS["return"] or tag == binformat.EVENT_TAGS["suspend"]:
+            self.encode_value(event.retval)
+        elif tag == binformat.EVENT_TAGS["sample"]:
+            binformat.encode_varint(event.interval, out)
+            binformat.encode_varint(len(frames), out)
+            for function_id, frame_file_id, line_number in frames:
+                binformat.encode_varint(function_id, out)
+                binformat.encode_varint(frame_file_id, out)
+                binformat.encode_varint(0 if line_number is None else line_number + 1, out)
+        if len(out) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            try:
+                self.log_file.write(bytes(self.buffer))
+                self.log_file.flush()
+            except ValueError:
+                #the file was already closed
+                return
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.log_file.close()
+
+class ThreadBufferedEventLogger(object):
+    """Lets several threads log to an event logger that isn't thread safe
+
+    Each thread appends its events to its own buffer, without locking. A
+    full buffer is handed to event_logger as one batch while holding a lock,
+    so the lock is taken once per batch_size events instead of once per
+    event. Events of one thread stay in order, but batches of different
+    threads are interleaved, so the log isn't in time order across threads.
+
+    Like background.BackgroundEventLogger, it takes raw tuples (see
+    EventRecorder) as well as events. Raw tuples are passed on as they are
+    if event_logger takes them too (has a log_raw method)."""
+
+    def __init__(self, event_logger, batch_size=1024):
+        self.event_logger = event_logger
+        self.batch_size = batch_size
+        self.local = threading.local()
+        #every thread's buffer, so flush() can empty them all
+        self.buffers = []
+        self.lock = threading.Lock()
+
+    def get_buffer(self):
+        try:
+            return self.local.buffer
+        except AttributeError:
+            buffer = self.local.buffer = []
+            with self.lock:
+                self.buffers.append(buffer)
+            return buffer
+
+    def log_raw(self, raw):
+        buffer = self.get_buffer()
+        buffer.append(raw)
+        if len(buffer) >= self.batch_size:
+            with self.lock:
+                self.write(buffer)
+
+    def log_event(self, event):
+        self.log_raw(event)
+
+    def write(self, buffer):
+        """Hand a buffer's events to event_logger. Needs the lock"""
+        #the owner may keep appending while another thread flushes its buffer
+        batch = buffer[:]
+        del buffer[:len(batch)]
+        log_raw = getattr(self.event_logger, "log_raw", None)
+        log_event = getattr(self.event_logger, "log_event", None)
+        for raw in batch:
+            if not isinstance(raw, tuple):
+                log_event(raw)
+            elif log_raw is not None:
+                #building the event is left to it, e.g. to a writer thread or process
+                log_raw(raw)
+            else:
+                log_event(event_from_raw(raw))
+
+    def flush(self):
+        with self.lock:
+            for buffer in self.buffers:
+                self.write(buffer)
+            flush = getattr(self.event_logger, "flush", None)
+            if flush is not None:
+                flush()
+
+    def close(self):
+        self.flush()
+        self.event_logger.close()
+
+LOG_FORMATS = ("json", "binary")
+
+def open_event_logger(log_path, log_format="json", compression=None):
+    """Open log_path for writing and return an event logger for log_format
+
+    compression: a codec from compression.CODECS to compress the log with. Default: the one its extension names
+        (log.txt.gz: gzip), if any"""
+    if log_format not in LOG_FORMATS:
+        raise ValueError("Unknown log format: {0}".format(log_format))
+    compression = compression or codec_for_path(log_path)
+    if compression is not None:
+        log_file = CompressedWriter(open(log_path, "wb"), compression)
+    else:
+        log_file = open(log_path, "wb" if log_format == "binary" else "w")
+    if log_format == "binary":
+        return BinaryFileEventLogger(log_file)
+    return BufferedJsonFileEventLogger(log_file)
+
 Option = collections.namedtuple("Option", ["name", "description", "default"])
 class Options(object):
     options = [
@@ -83,6 +399,16 @@ class Options(object):
             description="If true, only log functions with @log_function decorator",
             default=False,
         ),
+        Option(
+            name="trace_threads",
+            description="Whether to also log the other threads (see EventRecorder.thread_hook)",
+            default=False,
+        ),
+        Option(
+            name="trace_tasks",
+            description="Whether to record which asyncio task each event happened in",
+            default=False,
+        ),
             
     ]
 
@@ -95,40 +421,174 @@ class Options(object):
     def __getitem__(self, key):
         return self._data[key]
 
-class LoggingDebugger(bdb.Bdb):
+class EventRecorder(object):
+    """Turns frames into events and hands them to an event logger
+
+    The recorders (LoggingDebugger, tracer.LoggingTracer) only differ in how
+    they hook into the interpreter; they all call these user_* methods.
+    The log_* methods skip the filter check, for callers that already know
+    the frame should be logged.
+
+    If the event logger has a log_raw method (e.g. background.BackgroundEventLogger),
+    it's passed compact tuples instead of events:
+    (event_type, timestamp, file_name, line_number, function_name, args or retval, thread_id, process_id, task_id)
+    and building the events is left to the logger.
+
+    With the trace_threads option, the event logger is wrapped in a
+    ThreadBufferedEventLogger so the threads don't garble each other's events.
+
+    Generators and coroutines log a resume event instead of a call when
+    they're resumed, and a suspend event instead of a return when they yield
+    or await. With the trace_tasks option, events also get the id of the
+    asyncio task they happened in, so analyses can put a task's calls back
+    together across its awaits."""
     def __init__(self, event_logger, skip=None, options=None):
-        bdb.Bdb.__init__(self, skip)
-        self.event_logger = event_logger
         self.options = options or Options()
+        self.code_filter = CodeFilter(self.options, skip)
         if self.options["log_lines"]:
             self.user_line = self.user_line_func
+        if self.options["trace_tasks"]:
+            self.get_task_id = get_task_id
+        #co_filename -> absolute path
+        self.file_names = {}
+        #code object -> its bytecode, for generators and coroutines
+        self.code_bytes = {}
+        self.set_event_logger(event_logger)
+
+    def set_event_logger(self, event_logger):
+        """Log to event_logger from now on, e.g. to a new shard after a fork (see processes.py)"""
+        if self.options["trace_threads"]:
+            event_logger = ThreadBufferedEventLogger(event_logger)
+        self.event_logger = event_logger
+        self.log_raw = getattr(event_logger, "log_raw", None)
+        for name in ("log_call", "log_line", "log_return", "log_exception"):
+            if self.log_raw is not None:
+                setattr(self, name, getattr(self, name + "_raw"))
+            else:
+                self.__dict__.pop(name, None)
 
     def user_call(self, frame, args):
-        if self.should_log(frame):
-            arg_string = None
-            if self.options["log_args"]:
-                arg_string = self.format_args(inspect.getargvalues(frame))
+        decision = self.code_filter.decide(frame)
+        if decision.trace:
+            self.log_call(frame, decision)
 
-            state = get_state(frame, args=arg_string)
+    def log_call(self, frame, decision):
+        arg_string = None
+        if decision.log_args:
+            arg_string = self.format_args(inspect.getargvalues(frame))
+
+        state = get_state(frame, args=arg_string, task_id=self.get_task_id())
+        if frame.f_code.co_flags & GENERATOR_FLAGS and self.is_resumed(frame):
+            call_event = ResumeEvent.from_state(state)
+        else:
             call_event = CallEvent.from_state(state)
-            self.event_logger.log_event(call_event)
+        self.event_logger.log_event(call_event)
+
+    def user_line(self, frame):
+        pass
 
     def user_line_func(self, frame):
-        if self.should_log(frame):
-            line_event = LineEvent.from_state(ProgramState.from_frame(frame))
-            self.event_logger.log_event(line_event)
+        if self.code_filter.decide(frame).log_lines:
+            self.log_line(frame)
+
+    def log_line(self, frame):
+        line_event = LineEvent.from_state(ProgramState.from_frame(frame, self.get_task_id()))
+        self.event_logger.log_event(line_event)
 
     def user_return(self, frame, retval):
         if self.should_log(frame):
-            retval_string = self.format_retval(retval) if self.options["log_retval"] else None
-            state = get_state(frame, retval=retval_string)
+            self.log_return(frame, retval)
+
+    def log_return(self, frame, retval):
+        retval_string = self.format_retval(retval) if self.options["log_retval"] else None
+        state = get_state(frame, retval=retval_string, task_id=self.get_task_id())
+        if frame.f_code.co_flags & GENERATOR_FLAGS and self.is_suspended(frame):
+            return_event = SuspendEvent.from_state(state)
+        else:
             return_event = ReturnEvent.from_state(state)
-            self.event_logger.log_event(return_event)
+        self.event_logger.log_event(return_event)
 
     def user_exception(self, frame, exc_stuff):
-        if self.should_log(frame):
-            exception_event = ExceptionEvent.from_state(ProgramState.from_frame(frame))
-            self.event_logger.log_event(exception_event)
+        if self.should_log(frame) and not self.is_protocol_exception(frame, exc_stuff):
+            self.log_exception(frame, exc_stuff)
+
+    def log_exception(self, frame, exc_stuff):
+        exception_event = ExceptionEvent.from_state(ProgramState.from_frame(frame, self.get_task_id()))
+        self.event_logger.log_event(exception_event)
+
+    def get_task_id(self):
+        """Replaced by the module's get_task_id with the trace_tasks option"""
+        return None
+
+    def get_code_bytes(self, code):
+        try:
+            return self.code_bytes[code]
+        except KeyError:
+            code_bytes = self.code_bytes[code] = bytearray(code.co_code)
+            return code_bytes
+
+    def is_resumed(self, frame):
+        """Whether the call event of a generator frame resumes it rather than starting it"""
+        if RESUME is None:
+            return frame.f_lasti >= 0
+        code_bytes = self.get_code_bytes(frame.f_code)
+        lasti = frame.f_lasti
+        return code_bytes[lasti] == RESUME and code_bytes[lasti + 1] & 3 != 0
+
+    def is_suspended(self, frame):
+        """Whether the return event of a generator frame suspends it rather than ending it"""
+        code_bytes = self.get_code_bytes(frame.f_code)
+        lasti = frame.f_lasti
+        opcode = code_bytes[lasti]
+        if opcode == YIELD_VALUE:
+            return True
+        if opcode == RESUME:
+            return code_bytes[lasti + 1] & 3 != 0
+        return YIELD_FROM is not None and lasti + 2 < len(code_bytes) and code_bytes[lasti + 2] == YIELD_FROM
+
+    def is_protocol_exception(self, frame, exc_stuff):
+        return bool(frame.f_code.co_flags & GENERATOR_FLAGS) and issubclass(exc_stuff[0], PROTOCOL_EXCEPTIONS)
+
+    def get_file_name(self, code):
+        try:
+            return self.file_names[code.co_filename]
+        except KeyError:
+            file_name = self.file_names[code.co_filename] = os.path.abspath(code.co_filename)
+            return file_name
+
+    def log_call_raw(self, frame, decision):
+        arg_string = None
+        if decision.log_args:
+            arg_string = self.format_args(inspect.getargvalues(frame))
+        code = frame.f_code
+        event_type = "resume" if code.co_flags & GENERATOR_FLAGS and self.is_resumed(frame) else "call"
+        self.log_raw((
+            event_type, now_ns(), self.get_file_name(code), frame.f_lineno, code.co_name, arg_string, get_thread_id(),
+            None, self.get_task_id(),
+        ))
+
+    def log_line_raw(self, frame):
+        code = frame.f_code
+        self.log_raw((
+            "line", now_ns(), self.get_file_name(code), frame.f_lineno, None, None, get_thread_id(),
+            None, self.get_task_id(),
+        ))
+
+    def log_return_raw(self, frame, retval):
+        retval_string = self.format_retval(retval) if self.options["log_retval"] else None
+        code = frame.f_code
+        event_type = "suspend" if code.co_flags & GENERATOR_FLAGS and self.is_suspended(frame) else "return"
+        self.log_raw((
+            event_type, now_ns(), self.get_file_name(code), frame.f_lineno, code.co_name, retval_string, get_thread_id(),
+            None, self.get_task_id(),
+        ))
+
+    def log_exception_raw(self, frame, exc_stuff):
+        code = frame.f_code
+        self.log_raw((
+            "exception", now_ns(), self.get_file_name(code), frame.f_lineno, code.co_name, None, get_thread_id(),
+            None, self.get_task_id(),
+        ))
 
     def format_args(self, args):
         """Format the arguments"""
@@ -149,4 +609,88 @@ class LoggingDebugger(bdb.Bdb):
         pass
 
     def should_log(self, frame):
-        return (not self.options["explicit_only"]) or getattr(frame.f_globals[frame.f_code.co_name], "__log_call", False)
+        return self.code_filter.decide(frame).trace
+
+    def thread_hook(self, hook):
+        """hook, for threads other than the one that starts logging
+
+        Threads that are already running when logging starts only get
+        hooked on Pythons that have threading.settrace_all_threads (3.12+).
+        pylog's own threads (named "pylog-...", like the writer thread of
+        background.BackgroundEventLogger) aren't logged."""
+        own_threads = set(thread.ident for thread in threading.enumerate() if thread.name.startswith("pylog-"))
+        if not own_threads:
+            return hook
+        def thread_hook(frame, event, arg):
+            if get_thread_id() in own_threads:
+                return None
+            return hook(frame, event, arg)
+        return thread_hook
+
+    def start_threads(self, hook, profile=False):
+        """With the trace_threads option, install hook (wrapped by thread_hook)
+        as the trace function (or the profile function) of the other threads.
+        Call it before hooking the current thread: on 3.12+ it hooks every thread"""
+        if not self.options["trace_threads"]:
+            return
+        hook = self.thread_hook(hook)
+        if profile:
+            threading.setprofile(hook)
+            if hasattr(threading, "setprofile_all_threads"):
+                threading.setprofile_all_threads(hook)
+        else:
+            threading.settrace(hook)
+            if hasattr(threading, "settrace_all_threads"):
+                threading.settrace_all_threads(hook)
+
+    def stop_threads(self):
+        if not self.options["trace_threads"]:
+            return
+        threading.settrace(None)
+        threading.setprofile(None)
+        if hasattr(threading, "settrace_all_threads"):
+            threading.settrace_all_threads(None)
+            threading.setprofile_all_threads(None)
+
+    def flush_events(self):
+        """Flush buffered events, if the event logger buffers them"""
+        flush = getattr(self.event_logger, "flush", None)
+        if flush is not None:
+            flush()
+
+class LoggingDebugger(EventRecorder, bdb.Bdb):
+    def __init__(self, event_logger, skip=None, options=None):
+        #skipped modules are handled by the code filter, so bdb doesn't glob match them on every event
+        bdb.Bdb.__init__(self)
+        EventRecorder.__init__(self, event_logger, skip=skip, options=options)
+
+    def dispatch_call(self, frame, arg):
+        #don't trace the lines and returns of code that isn't logged
+        if self.botframe is not None and not self.should_log(frame):
+            return None
+        return bdb.Bdb.dispatch_call(self, frame, arg)
+
+    def stop_here(self, frame):
+        #python 2's bdb only stops in frames below botframe, which the frames of other threads aren't
+        if self.stopframe is None:
+            return True
+        return bdb.Bdb.stop_here(self, frame)
+
+    def set_trace(self, frame=None):
+        if frame is None:
+            frame = sys._getframe().f_back
+        self.start_threads(self.trace_dispatch)
+        bdb.Bdb.set_trace(self, frame)
+
+    def set_quit(self):
+        bdb.Bdb.set_quit(self)
+        self.stop_threads()
+        self.flush_events()
+
+    def run(self, cmd, globals=None, locals=None):
+        self.start_threads(self.trace_dispatch)
+        try:
+            bdb.Bdb.run(self, cmd, globals, locals)
+        finally:
+            self.stop_threads()
+            self.flush_events()
@@ -1,36 +1,141 @@
 """Events represent things happening during a program exection. They include:
 Function call/return
+Generator or coroutine resume/suspend
 Line of code executed
 Exception raised"""
-from datetime import datetime
+from array import array
+from datetime import datetime, timedelta
 import itertools
 import json
-from six import itervalues, string_types
+import os
+import time
+import timeit
+from six import integer_types, itervalues, string_types
+from six.moves import map, zip
 
+from pylog.compression import open_compressed
+from pylog.mapped import iter_json
+
+#format of timestamps in version 1 logs, which are still readable
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+EPOCH = datetime(1970, 1, 1)
+NS_PER_SECOND = 1000000000
+
+LOG_HEADER_TYPE = "header"
+LOG_VERSION = 2
+
+def datetime_to_ns(timestamp):
+    """nanoseconds since EPOCH (in the same timezone as timestamp)"""
+    delta = timestamp - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+def ns_to_datetime(ns):
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+def format_timestamp(ns):
+    """TIME_FORMAT string for a timestamp, for display"""
+    return ns_to_datetime(ns).strftime(TIME_FORMAT)
+
+#date part of a TIME_FORMAT string -> ns at midnight. Logs only span a few days
+_DAY_NS = {}
+def parse_timestamp(timestamp):
+    """Convert a TIME_FORMAT string to ns without going through strptime"""
+    try:
+        day_ns = _DAY_NS[timestamp[:10]]
+    except KeyError:
+        day_ns = _DAY_NS[timestamp[:10]] = datetime_to_ns(datetime.strptime(timestamp[:10], "%Y-%m-%d"))
+    seconds = (int(timestamp[11:13]) * 60 + int(timestamp[14:16])) * 60 + int(timestamp[17:19])
+    return day_ns + seconds * NS_PER_SECOND + int(timestamp[20:26]) * 1000
+
+def timestamp_to_ns(timestamp):
+    """An event timestamp from a datetime, TIME_FORMAT string or ns. None is now"""
+    if timestamp is None:
+        return now_ns()
+    elif isinstance(timestamp, string_types):
+        return parse_timestamp(timestamp)
+    elif isinstance(timestamp, datetime):
+        return datetime_to_ns(timestamp)
+    return timestamp
+
+if hasattr(time, "perf_counter_ns"):
+    perf_counter_ns = time.perf_counter_ns
+else:
+    #python 2 has no monotonic clock
+    def perf_counter_ns():
+        return int(timeit.default_timer() * NS_PER_SECOND)
+
+#Timestamps come from the monotonic clock, shifted by one reading of the
+#(local) wall clock so they line up with version 1 logs and with each other
+WALL_ANCHOR_NS = datetime_to_ns(datetime.now())
+CLOCK_ANCHOR_NS = perf_counter_ns()
+CLOCK_OFFSET_NS = WALL_ANCHOR_NS - CLOCK_ANCHOR_NS
+
+def now_ns():
+    """The current time as an event timestamp"""
+    return perf_counter_ns() + CLOCK_OFFSET_NS
+
+def use_clock_anchor(wall_time_ns, clock_ns):
+    """Base timestamps on another process's clock anchor (the wall_time_ns
+    and clock_ns of its log header). The monotonic clock is system wide, so
+    the timestamps of both processes line up exactly"""
+    global WALL_ANCHOR_NS, CLOCK_ANCHOR_NS, CLOCK_OFFSET_NS
+    WALL_ANCHOR_NS = wall_time_ns
+    CLOCK_ANCHOR_NS = clock_ns
+    CLOCK_OFFSET_NS = wall_time_ns - clock_ns
+
+def make_log_header():
+    """The first record of a log. Records the clock anchor its timestamps are
+    based on and the process that wrote it"""
+    return {
+        "type": LOG_HEADER_TYPE,
+        "version": LOG_VERSION,
+        "wall_time": format_timestamp(WALL_ANCHOR_NS),
+        "wall_time_ns": WALL_ANCHOR_NS,
+        "clock_ns": CLOCK_ANCHOR_NS,
+        "pid": os.getpid(),
+        "parent_pid": os.getppid() if hasattr(os, "getppid") else None,
+    }
 
 class Event(object):
     """The base class for anything that happens that should be logged
-    timestamp: datetime.datetime of when it happened, default:now"""
+    timestamp: when it happened, in integer nanoseconds (see now_ns), default:now.
+        datetimes and TIME_FORMAT strings are converted
+    thread_id: the thread it happened in (thread.get_ident). None in logs of
+        a single thread that don't record it
+    process_id: the process it happened in. Only set in logs merged from
+        several processes (see processes.merge_shards); other logs record
+        their pid in the header
+    task_id: the asyncio task it happened in (id of the task), with the
+        trace_tasks option. None outside of tasks"""
     #event_type: string specifying what kind of event it is
     event_type = "event"
     stack_change = 0
+    #the attributes other than timestamp, which are the keys of their to_data() (see event_from_data)
+    fields = ("file_name", "line_number", "thread_id", "process_id", "task_id")
 
-    def __init__(self, timestamp=None, file_name=None, line_number=None):
-        if timestamp and isinstance(timestamp, string_types):
-            timestamp = datetime.strptime(timestamp, TIME_FORMAT)
+    def __init__(self, timestamp=None, file_name=None, line_number=None, thread_id=None, process_id=None, task_id=None):
         self.file_name = file_name
         self.line_number = line_number
-        self.timestamp = timestamp or datetime.now()
+        self.timestamp = timestamp_to_ns(timestamp)
+        self.thread_id = thread_id
+        self.process_id = process_id
+        self.task_id = task_id
 
     def to_data(self):
         """return json-serializable version of the event"""
-        return {
+        data = {
             "type": self.event_type,
-            "timestamp": self.timestamp.strftime(TIME_FORMAT),
+            "timestamp": self.timestamp,
             "file_name": self.file_name,
             "line_number": self.line_number,
         }
+        if self.thread_id is not None:
+            data["thread_id"] = self.thread_id
+        if self.process_id is not None:
+            data["process_id"] = self.process_id
+        if self.task_id is not None:
+            data["task_id"] = self.task_id
+        return data
 
     @classmethod
     def get_attributes_from_data(cls, data):
@@ -39,6 +144,9 @@ class Event(object):
             "timestamp": data.get("timestamp"),
             "file_name": data.get("file_name"),
             "line_number": data.get("line_number"),
+            "thread_id": data.get("thread_id"),
+            "process_id": data.get("process_id"),
+            "task_id": data.get("task_id"),
         }
 
     @classmethod
@@ -51,6 +159,8 @@ class Event(object):
         attributes = {
             "file_name": state.file_name,
             "line_number": state.line_number,
+            "thread_id": getattr(state, "thread_id", None),
+            "task_id": getattr(state, "task_id", None),
         }
         return attributes
 
@@ -66,6 +176,7 @@ class LineEvent(Event):
 class FunctionEvent(Event):
     """Base class for events related to functions (call, return, exception)"""
     event_type = "function"
+    fields = Event.fields + ("function_name",)
     def __init__(self, function_name, **kwargs):
         super(FunctionEvent, self).__init__(**kwargs)
         self.function_name = function_name
@@ -96,6 +207,7 @@ class CallEvent(FunctionEvent):
     """Function call event"""
     event_type = "call"
     stack_change = 1
+    fields = FunctionEvent.fields + ("args",)
     def __init__(self, args=None, **kwargs):
         super(CallEvent, self).__init__(**kwargs)
         self.args = args
@@ -124,6 +236,7 @@ class ReturnEvent(FunctionEvent):
     """When a function returns"""
     event_type = "return"
     stack_change = -1
+    fields = FunctionEvent.fields + ("retval",)
     def __init__(self, retval=None, **kwargs):
         super(ReturnEvent, self).__init__(**kwargs)
         self.retval = retval
@@ -147,6 +260,16 @@ class ReturnEvent(FunctionEvent):
         attributes["retval"] = state.retval
         return attributes
 
+class ResumeEvent(CallEvent):
+    """A generator or coroutine carrying on after a yield or await. Like a
+    call for the thread's stack, but part of the call it resumes"""
+    event_type = "resume"
+
+class SuspendEvent(ReturnEvent):
+    """A generator or coroutine stopping at a yield or await. Like a return
+    for the thread's stack, but the call goes on when it's resumed"""
+    event_type = "suspend"
+
 class ExceptionEvent(FunctionEvent):
     """Event representing an exception being raised
     There will be a separate event for each level of the stack
@@ -154,18 +277,481 @@ class ExceptionEvent(FunctionEvent):
     event_type = "exception"
     stack_change = -1
 
+class SampleEvent(Event):
+    """The stack of a thread, captured by a sampling recorder (see sampler.py)
+    stack: (function_name, file_name, line_number) for each frame, outermost
+        first. line_number is the function's first line, like a call event's
+    interval: how much time (in ns) the sample stands for
+    file_name and line_number are where the innermost frame was"""
+    event_type = "sample"
+    fields = Event.fields + ("interval", "stack")
+
+    def __init__(self, interval=None, stack=(), **kwargs):
+        super(SampleEvent, self).__init__(**kwargs)
+        self.interval = interval
+        self.stack = [tuple(frame) for frame in stack]
+
+    def to_data(self):
+        data = super(SampleEvent, self).to_data()
+        data.update({
+            "interval": self.interval,
+            "stack": [list(frame) for frame in self.stack],
+        })
+        return data
+
+    @classmethod
+    def get_attributes_from_data(cls, data):
+        attributes = super(SampleEvent, cls).get_attributes_from_data(data)
+        attributes["interval"] = data.get("interval")
+        attributes["stack"] = data.get("stack", ())
+        return attributes
+
 #A list of all valid event classes
-EVENT_CLASSES = (Event, LineEvent, FunctionEvent, CallEvent, ReturnEvent, ExceptionEvent)
+EVENT_CLASSES = (Event, LineEvent, FunctionEvent, CallEvent, ReturnEvent, ExceptionEvent, SampleEvent, ResumeEvent, SuspendEvent)
 EVENT_LOOKUP = {event.event_type: event for event in EVENT_CLASSES}
 
+#where each field is in the raw tuples of event_from_raw
+RAW_POSITIONS = {
+    "file_name": 2, "line_number": 3, "function_name": 4, "args": 5, "retval": 5, "thread_id": 6, "process_id": 7,
+    "task_id": 8,
+}
+
+DECODER_TEMPLATE = """def decode({argument}):
+    {setup}
+    event = new(event_class)
+    event.__dict__ = {{
+        "timestamp": timestamp if type(timestamp) in integer_types else timestamp_to_ns(timestamp),
+        {attributes}
+    }}
+    return event
+"""
+
+def compile_decoder(event_class, argument, setup, values):
+    """Generate a function that builds an event_class from argument without calling its __init__ (and its base
+    classes'): it sets the event's __dict__ to a dict literal of values, the code for the value of each field"""
+    source = DECODER_TEMPLATE.format(
+        argument=argument,
+        setup=setup,
+        attributes="\n        ".join("{0!r}: {1},".format(field, value) for field, value in values),
+    )
+    namespace = {
+        "new": object.__new__,
+        "event_class": event_class,
+        "integer_types": integer_types,
+        "timestamp_to_ns": timestamp_to_ns,
+    }
+    exec(compile(source, "<{0} decoder>".format(event_class.__name__), "exec"), namespace)
+    return namespace["decode"]
+
+def make_data_decoder(event_class):
+    """A function that builds an event_class from its to_data() dict, like event_class.from_data does but several
+    times faster: it's generated from event_class.fields, and skips the get_attributes_from_data and __init__
+    chains"""
+    decode = compile_decoder(
+        event_class, "data", 'get = data.get\n    timestamp = get("timestamp")',
+        [(field, "get({0!r})".format(field)) for field in event_class.fields],
+    )
+    if "stack" not in event_class.fields:
+        return decode
+    def decode_sample(data):
+        event = decode(data)
+        event.stack = [tuple(frame) for frame in event.stack or ()]
+        return event
+    return decode_sample
+
+def make_raw_decoder(event_class):
+    """Like make_data_decoder, for the raw tuples of event_from_raw. Not for samples"""
+    values = []
+    for field in event_class.fields:
+        position = RAW_POSITIONS[field]
+        if position < 6:
+            values.append((field, "raw[{0}]".format(position)))
+        else:
+            values.append((field, "raw[{0}] if length > {0} else None".format(position)))
+    return compile_decoder(event_class, "raw", "length = len(raw)\n    timestamp = raw[1]", values)
+
+#event type -> decoder, for event_from_data and event_from_raw
+DATA_DECODERS = dict((event_type, make_data_decoder(event_class)) for event_type, event_class in EVENT_LOOKUP.items())
+RAW_DECODERS = dict(
+    (event_type, make_raw_decoder(event_class))
+    for event_type, event_class in EVENT_LOOKUP.items() if event_type != "sample"
+)
+
 def event_from_data(data, event_lookup=EVENT_LOOKUP):
-    """Convert a python dict to an Event class"""
+    """Convert a python dict to an Event class. The types of EVENT_LOOKUP are built by their DATA_DECODERS"""
+    if event_lookup is EVENT_LOOKUP:
+        return DATA_DECODERS[data["type"]](data)
     event_class = event_lookup[data["type"]]
     return event_class.from_data(data)
 
+def event_from_raw(raw):
+    """Build an Event from a raw tuple:
+    (event_type, timestamp, file_name, line_number, function_name, args or retval, thread_id, process_id, task_id)
+    as made by debugger.EventRecorder and logreader.BinaryFileEventReader.
+    For samples, args or retval is (interval, stack). thread_id, process_id
+    and task_id can be left out"""
+    if raw[0] != "sample":
+        return RAW_DECODERS[raw[0]](raw)
+    _, timestamp, file_name, line_number, _, (interval, stack) = raw[:6]
+    return SampleEvent(
+        interval=interval,
+        stack=stack,
+        timestamp=timestamp,
+        file_name=file_name,
+        line_number=line_number,
+        thread_id=raw[6] if len(raw) > 6 else None,
+        process_id=raw[7] if len(raw) > 7 else None,
+        task_id=raw[8] if len(raw) > 8 else None,
+    )
+
+class SampleExpander(object):
+    """Turns the samples of one thread into the calls and returns they imply
+
+    Consecutive samples that share the outer part of their stacks are
+    assumed to be inside the same calls. When the stacks differ, the frames
+    that are gone return and the new ones are called, at the time of the
+    sample. So the usual analyses (FunctionSet, stats, flame charts) work on
+    sampled logs, with times accurate to about a sample interval."""
+
+    def __init__(self, thread_id=None, process_id=None):
+        self.thread_id = thread_id
+        self.process_id = process_id
+        self.stack = []
+        self.last_timestamp = None
+        self.interval = 0
+
+    def add(self, timestamp, interval, stack):
+        """The raw events (see event_from_raw) implied by a sample"""
+        self.last_timestamp = timestamp
+        self.interval = interval or 0
+        common = 0
+        for old_frame, new_frame in zip(self.stack, stack):
+            if tuple(old_frame) != tuple(new_frame):
+                break
+            common += 1
+        raws = self.returns(timestamp, common)
+        for function_name, file_name, line_number in stack[common:]:
+            raws.append(("call", timestamp, file_name, line_number, function_name, None, self.thread_id, self.process_id))
+        self.stack = list(stack)
+        return raws
+
+    def returns(self, timestamp, depth):
+        """Return from the frames deeper than depth"""
+        raws = []
+        while len(self.stack) > depth:
+            function_name, file_name, line_number = self.stack.pop()
+            raws.append(("return", timestamp, file_name, line_number, function_name, None, self.thread_id, self.process_id))
+        return raws
+
+    def finish(self):
+        """Returns for the frames of the last sample, one interval after it"""
+        if self.last_timestamp is None:
+            return []
+        return self.returns(self.last_timestamp + self.interval, 0)
+
+def get_expander(expanders, thread_id, process_id):
+    try:
+        return expanders[process_id, thread_id]
+    except KeyError:
+        expander = expanders[process_id, thread_id] = SampleExpander(thread_id, process_id)
+        return expander
+
+def expand_samples(events):
+    """Replace sample events with calls and returns (see SampleExpander)"""
+    #(process id, thread id) -> SampleExpander
+    expanders = {}
+    for event in events:
+        if event.event_type == "sample":
+            expander = get_expander(expanders, event.thread_id, event.process_id)
+            for raw in expander.add(event.timestamp, event.interval, event.stack):
+                yield event_from_raw(raw)
+        else:
+            yield event
+    for expander in itervalues(expanders):
+        for raw in expander.finish():
+            yield event_from_raw(raw)
+
+def expand_samples_raw(raws):
+    """expand_samples for raw tuples"""
+    expanders = {}
+    for raw in raws:
+        if raw[0] == "sample":
+            interval, stack = raw[5]
+            expander = get_expander(expanders, raw[6] if len(raw) > 6 else None, raw[7] if len(raw) > 7 else None)
+            for expanded in expander.add(raw[1], interval, stack):
+                yield expanded
+        else:
+            yield raw
+    for expander in itervalues(expanders):
+        for expanded in expander.finish():
+            yield expanded
+
+def iter_events_from_file(f):
+    """Lazily parse the events of a JSON lines log. A compressed log has to be opened in binary mode"""
+    for data in iter_json(open_compressed(f)):
+        if data["type"] != LOG_HEADER_TYPE:
+            yield event_from_data(data)
+
 def events_from_file(f):
-    evts = [event_from_data(json.loads(line.strip())) for line in f]
-    return evts
+    return list(iter_events_from_file(f))
+
+def _typecode(preferred, fallback):
+    try:
+        array(preferred)
+        return preferred
+    except ValueError:
+        #python 2 has no "q"; its "l" is 64 bits on the platforms pylog supports
+        return fallback
+
+TIMESTAMP_TYPECODE = _typecode("q", "l")
+EVENT_TYPE_CODES = dict((event_class.event_type, code) for code, event_class in enumerate(EVENT_CLASSES))
+STACK_CHANGES = tuple(event_class.stack_change for event_class in EVENT_CLASSES)
+CALL_CODE = EVENT_TYPE_CODES["call"]
+RETURN_CODE = EVENT_TYPE_CODES["return"]
+SAMPLE_CODE = EVENT_TYPE_CODES["sample"]
+RESUME_CODE = EVENT_TYPE_CODES["resume"]
+SUSPEND_CODE = EVENT_TYPE_CODES["suspend"]
+
+class EventStore(object):
+    """A compact in-memory list of events
+
+    Instead of one Event object per event, events are kept in parallel
+    array columns (type, timestamp, file id, function id, line number,
+    thread id, process id, task id and call depth), with file and function
+    names interned in a string table.
+    Args and return values are kept in a dict by event index since most
+    events don't have one.
+
+    Indexing a store returns an EventView, which reads its attributes from
+    the columns. ExecutionTree.from_events and FunctionSet.from_events read
+    the columns directly."""
+
+    def __init__(self):
+        #index into EVENT_CLASSES
+        self.types = array("b")
+        self.timestamps = array(TIMESTAMP_TYPECODE)
+        #string ids. -1 means None
+        self.file_ids = array("i")
+        self.function_ids = array("i")
+        #-1 means None
+        self.line_numbers = array("i")
+        #-1 means None
+        self.thread_ids = array(TIMESTAMP_TYPECODE)
+        #-1 means None
+        self.process_ids = array("i")
+        #-1 means None
+        self.task_ids = array(TIMESTAMP_TYPECODE)
+        #depth of the thread's call stack at each event, counting the frame a call/return is for
+        self.depths = array("i")
+        #event index -> args or retval
+        self.values = {}
+        self.strings = []
+        self.string_ids = {}
+        #(process id, thread id) -> current depth
+        self.thread_depths = {}
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.types)
+        if not 0 <= index < len(self.types):
+            raise IndexError("event index out of range")
+        return EventView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.types)):
+            yield EventView(self, index)
+
+    def intern(self, string):
+        if string is None:
+            return -1
+        try:
+            return self.string_ids[string]
+        except KeyError:
+            string_id = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            return string_id
+
+    def get_string(self, string_id):
+        return None if string_id < 0 else self.strings[string_id]
+
+    def append_raw(self, raw):
+        """Add an event from a raw tuple (see event_from_raw)"""
+        event_type, timestamp, file_name, line_number, function_name, value = raw[:6]
+        thread_id = raw[6] if len(raw) > 6 else None
+        process_id = raw[7] if len(raw) > 7 else None
+        task_id = raw[8] if len(raw) > 8 else None
+        type_code = EVENT_TYPE_CODES[event_type]
+        stack_change = STACK_CHANGES[type_code]
+        depth = self.thread_depths.get((process_id, thread_id), 0)
+        if stack_change > 0:
+            depth += 1
+        if value is not None:
+            self.values[len(self.types)] = value
+        self.types.append(type_code)
+        self.timestamps.append(timestamp)
+        self.file_ids.append(self.intern(file_name))
+        self.function_ids.append(self.intern(function_name))
+        self.line_numbers.append(-1 if line_number is None else line_number)
+        self.thread_ids.append(-1 if thread_id is None else thread_id)
+        self.process_ids.append(-1 if process_id is None else process_id)
+        self.task_ids.append(-1 if task_id is None else task_id)
+        self.depths.append(depth)
+        if stack_change < 0:
+            depth -= 1
+        self.thread_depths[process_id, thread_id] = depth
+
+    def append(self, event):
+        if event.event_type == "sample":
+            value = (event.interval, event.stack)
+        elif event.event_type == "call" or event.event_type == "resume":
+            value = getattr(event, "args", None)
+        else:
+            value = getattr(event, "retval", None)
+        self.append_raw((
+            event.event_type,
+            event.timestamp,
+            event.file_name,
+            event.line_number,
+            getattr(event, "function_name", None),
+            value,
+            event.thread_id,
+            event.process_id,
+            event.task_id,
+        ))
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    @classmethod
+    def from_events(cls, events):
+        result = cls()
+        result.extend(events)
+        return result
+
+    @classmethod
+    def from_reader(cls, reader):
+        """Load a log from a logreader reader, skipping Event objects if the reader supports it.
+        Samples are expanded into calls and returns (see expand_samples)"""
+        result = cls()
+        iter_raw = getattr(reader, "iter_raw", None)
+        if iter_raw is not None:
+            for raw in expand_samples_raw(iter_raw()):
+                result.append_raw(raw)
+        else:
+            result.extend(expand_samples(reader.iter_events()))
+        return result
+
+    def event(self, index):
+        """A full Event object for the event at index"""
+        return event_from_raw(self.raw(index))
+
+    def raw(self, index):
+        return (
+            EVENT_CLASSES[self.types[index]].event_type,
+            self.timestamps[index],
+            self.get_string(self.file_ids[index]),
+            None if self.line_numbers[index] < 0 else self.line_numbers[index],
+            self.get_string(self.function_ids[index]),
+            self.values.get(index),
+            self.get_thread_id(index),
+            self.get_process_id(index),
+            self.get_task_id(index),
+        )
+
+    def get_thread_id(self, index):
+        thread_id = self.thread_ids[index]
+        return None if thread_id < 0 else thread_id
+
+    def get_process_id(self, index):
+        process_id = self.process_ids[index]
+        return None if process_id < 0 else process_id
+
+    def get_task_id(self, index):
+        task_id = self.task_ids[index]
+        return None if task_id < 0 else task_id
+
+class EventView(object):
+    """An event in an EventStore. Has the same attributes as Events"""
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def event_type(self):
+        return EVENT_CLASSES[self.store.types[self.index]].event_type
+
+    @property
+    def stack_change(self):
+        return STACK_CHANGES[self.store.types[self.index]]
+
+    @property
+    def timestamp(self):
+        return self.store.timestamps[self.index]
+
+    @property
+    def file_name(self):
+        return self.store.get_string(self.store.file_ids[self.index])
+
+    @property
+    def line_number(self):
+        line_number = self.store.line_numbers[self.index]
+        return None if line_number < 0 else line_number
+
+    @property
+    def function_name(self):
+        return self.store.get_string(self.store.function_ids[self.index])
+
+    @property
+    def thread_id(self):
+        return self.store.get_thread_id(self.index)
+
+    @property
+    def process_id(self):
+        return self.store.get_process_id(self.index)
+
+    @property
+    def task_id(self):
+        return self.store.get_task_id(self.index)
+
+    @property
+    def depth(self):
+        return self.store.depths[self.index]
+
+    #like Events, only calls and resumes have args and only returns and suspends have a retval
+
+    @property
+    def args(self):
+        if self.store.types[self.index] not in (CALL_CODE, RESUME_CODE):
+            raise AttributeError("args")
+        return self.store.values.get(self.index)
+
+    @property
+    def retval(self):
+        if self.store.types[self.index] not in (RETURN_CODE, SUSPEND_CODE):
+            raise AttributeError("retval")
+        return self.store.values.get(self.index)
+
+    def sample_value(self, name):
+        if self.store.types[self.index] != SAMPLE_CODE:
+            raise AttributeError(name)
+        return self.store.values[self.index]
+
+    @property
+    def interval(self):
+        return self.sample_value("interval")[0]
+
+    @property
+    def stack(self):
+        return self.sample_value("stack")[1]
+
+    def to_data(self):
+        return self.store.event(self.index).to_data()
 
 #TODO move to different file?
 class ExecutionTree(object):
@@ -174,30 +760,79 @@ class ExecutionTree(object):
 
     @classmethod
     def from_events(cls, events):
+        if isinstance(events, EventStore):
+            return cls.from_store(events)
+        return cls.from_stack_changes(
+            (event.event_type, (event.process_id, event.thread_id, event.task_id), event)
+            for event in events if event.stack_change
+        )
+
+    @classmethod
+    def from_store(cls, store):
+        """from_events for an EventStore. Only calls and returns get EventViews"""
+        columns = enumerate(zip(store.types, store.process_ids, store.thread_ids, store.task_ids))
+        return cls.from_stack_changes(
+            (EVENT_CLASSES[type_code].event_type, (process_id, thread_id, task_id), EventView(store, index))
+            for index, (type_code, process_id, thread_id, task_id) in columns if STACK_CHANGES[type_code]
+        )
+
+    @classmethod
+    def from_stack_changes(cls, stack_changes):
+        """stack_changes: (event type, stack key, event) for each event that
+        changes the stack. The stack key tells the call stacks apart: each
+        asyncio task of each thread of each process has its own
+
+        The top level calls of all the stacks are the tree's sub_events. A
+        stack that returns from a call made before the log started is done:
+        its later events are ignored. A generator or coroutine call leaves
+        the stack when it's suspended and is put back when it's resumed, so
+        it's one FunctionCall however many times it runs"""
         result = cls()
-        call_stack = [result]
-        for event in events:
-            if event.stack_change > 0:
+        #stack key -> call stack. Empty once the stack is done
+        call_stacks = {}
+        #(stack key, function name, file name) -> suspended calls, the latest last.
+        #Resumes and suspends happen at the line of the yield or await, so line numbers don't match their call's
+        suspended = {}
+        for event_type, stack_key, event in stack_changes:
+            try:
+                call_stack = call_stacks[stack_key]
+            except KeyError:
+                call_stack = call_stacks[stack_key] = [result]
+            if not call_stack:
+                continue
+            if event_type == "resume":
+                calls = suspended.get((stack_key, event.function_name, event.file_name))
+                if calls:
+                    call = calls.pop()
+                    call.resume(event.timestamp)
+                    call_stack.append(call)
+                    continue
+                #suspended before the log started: a new call
+            if EVENT_LOOKUP[event_type].stack_change > 0:
                 call_stack.append(FunctionCall(event))
                 call_stack[-2].sub_events.append(call_stack[-1])
-            elif event.stack_change < 0:
+            else:
                 popped_call = call_stack.pop()
-                if call_stack:
-                    popped_call.return_event = event
+                if not call_stack:
+                    continue
+                if event_type == "suspend":
+                    popped_call.suspend(event.timestamp)
+                    suspended.setdefault((stack_key, event.function_name, event.file_name), []).append(popped_call)
                 else:
-                    return popped_call
+                    popped_call.return_event = event
         return result
 
     def to_data(self):
         return [event.to_data() for event in self.sub_events]
 
     def to_flame_chart(self, max_depth):
-        start_time = self.sub_events[0].call_event.timestamp
-        stop_time = self.sub_events[-1].return_event.timestamp
-        total_seconds = (stop_time - start_time).total_seconds()
+        #threads' events may not be in time order
+        start_time = min(call.call_event.timestamp for call in self.sub_events)
+        stop_time = max(call.return_event.timestamp for call in self.sub_events if call.return_event is not None)
+        total_seconds = float(stop_time - start_time) / NS_PER_SECOND
         id_gen = itertools.count(1)
         result = {
-            "start_time": start_time.strftime(TIME_FORMAT),
+            "start_time": format_timestamp(start_time),
             "total_seconds": total_seconds,
             "calls": [],
         }
@@ -206,11 +841,101 @@ class ExecutionTree(object):
                 result["calls"].append(call)
         return result
 
+def flame_chart_from_events(events, max_depth):
+    """Same result as ExecutionTree.from_events(events).to_flame_chart(max_depth),
+    but built in one pass over an iterable of events without building the
+    tree, so memory only grows with the call depth and the output.
+    Ids are given in call order, so with several threads they don't match
+    ExecutionTree's, which numbers each top level call's calls together.
+    Each time a generator or coroutine runs (from its call or a resume to a
+    suspend or its return) is a call here, where ExecutionTree has one
+    call for all of them"""
+    calls = []
+    #(process id, thread id) -> (id, call event) for each call that hasn't returned.
+    #Calls deeper than max_depth get no id
+    call_stacks = {}
+    #threads that returned from a call made before the log started
+    done_threads = set()
+    id_gen = itertools.count(1)
+    start_time = stop_time = None
+    for event in events:
+        stack_change = event.stack_change
+        if not stack_change:
+            continue
+        thread_key = (event.process_id, event.thread_id)
+        if thread_key in done_threads:
+            continue
+        try:
+            call_stack = call_stacks[thread_key]
+        except KeyError:
+            call_stack = call_stacks[thread_key] = []
+        if stack_change > 0:
+            if start_time is None or event.timestamp < start_time:
+                start_time = event.timestamp
+            call_id = next(id_gen) if len(call_stack) <= max_depth else None
+            call_stack.append((call_id, event))
+        else:
+            if not call_stack:
+                done_threads.add(thread_key)
+                continue
+            call_id, call_event = call_stack.pop()
+            if call_id is not None:
+                #times are made relative to start_time once it's known
+                calls.append({
+                    "id": call_id,
+                    "depth": len(call_stack),
+                    "parent_id": call_stack[-1][0] if call_stack else None,
+                    "call_time": call_event.timestamp,
+                    "ret_time": event.timestamp,
+                    "name": call_event.function_name,
+                    "file_name": call_event.file_name,
+                    "args": call_event.args,
+                    "retval": getattr(event, "retval", ""),
+                    "thread_id": call_event.thread_id,
+                    "process_id": call_event.process_id,
+                })
+            if not call_stack and (stop_time is None or event.timestamp > stop_time):
+                stop_time = event.timestamp
+    for call in calls:
+        call["call_time"] = float(call["call_time"] - start_time) / NS_PER_SECOND
+        call["ret_time"] = float(call["ret_time"] - start_time) / NS_PER_SECOND
+    #calls were collected as they returned; ids are in call order
+    calls.sort(key=lambda call: call["id"])
+    return {
+        "start_time": format_timestamp(start_time) if start_time is not None else None,
+        "total_seconds": float(stop_time - start_time) / NS_PER_SECOND if stop_time is not None else 0.0,
+        "calls": calls,
+    }
+
 class FunctionCall(object):
     def __init__(self, call_event=None, sub_events=None, return_event=None):
         self.call_event = call_event
         self.sub_events = sub_events or []
         self.return_event = return_event
+        #ns spent suspended (generators and coroutines), and when the current suspension started
+        self.suspended_time = 0
+        self.suspended_at = None
+
+    def suspend(self, timestamp):
+        self.suspended_at = timestamp
+
+    def resume(self, timestamp):
+        if self.suspended_at is not None:
+            self.suspended_time += timestamp - self.suspended_at
+            self.suspended_at = None
+
+    @property
+    def wall_time(self):
+        """ns from the call to the return, None if it hasn't returned"""
+        if self.call_event is None or self.return_event is None:
+            return None
+        return self.return_event.timestamp - self.call_event.timestamp
+
+    @property
+    def active_time(self):
+        """wall_time minus the time spent suspended, e.g. waiting in an await"""
+        wall_time = self.wall_time
+        return None if wall_time is None else wall_time - self.suspended_time
 
     def to_data(self, depth=None, parent=None):
         """serialize to data
@@ -237,12 +962,14 @@ class FunctionCall(object):
                 "id": this_id,
                 "depth": cur_depth,
                 "parent_id": parent_id,
-                "call_time": (self.call_event.timestamp - start_time).total_seconds(),
-                "ret_time": (self.return_event.timestamp - start_time).total_seconds(),
+                "call_time": float(self.call_event.timestamp - start_time) / NS_PER_SECOND,
+                "ret_time": float(self.return_event.timestamp - start_time) / NS_PER_SECOND,
                 "name": self.call_event.function_name,
                 "file_name": self.call_event.file_name,
                 "args": self.call_event.args,
                 "retval": getattr(self.return_event, "retval", ""),
+                "thread_id": self.call_event.thread_id,
+                "process_id": self.call_event.process_id,
             }
         if cur_depth < max_depth:
             for evt in self.sub_events:
@@ -297,15 +1024,52 @@ class FunctionSet(object):
 
     @classmethod
     def from_events(cls, events):
+        if isinstance(events, EventStore):
+            return cls.from_store(events)
         result = cls()
-        call_stack = []
+        #(process id, thread id) -> call stack
+        call_stacks = {}
         for event in events:
             if event.stack_change > 0:
                 function = result.add_function_from_event(event)
-                if call_stack:
+                call_stack = call_stacks.setdefault((event.process_id, event.thread_id), [])
+                #a resume isn't called by the frame that resumes it
+                if call_stack and event.event_type != "resume":
                     result.add_call(call_stack[-1], function)
                 call_stack.append(function)
             elif event.stack_change < 0:
+                call_stack = call_stacks.get((event.process_id, event.thread_id))
+                if call_stack:
+                    call_stack.pop()
+        return result
+
+    @classmethod
+    def from_store(cls, store):
+        """from_events for an EventStore, reading its columns directly"""
+        result = cls()
+        call_stacks = {}
+        #(function id, file id, line number) -> Function
+        functions = {}
+        columns = zip(
+            store.types, store.function_ids, store.file_ids, store.line_numbers, store.process_ids, store.thread_ids,
+        )
+        for type_code, function_id, file_id, line_number, process_id, thread_id in columns:
+            stack_change = STACK_CHANGES[type_code]
+            if stack_change > 0:
+                call_stack = call_stacks.setdefault((process_id, thread_id), [])
+                try:
+                    function = functions[function_id, file_id, line_number]
+                except KeyError:
+                    function = functions[function_id, file_id, line_number] = result.add_function(
+                        store.get_string(function_id),
+                        store.get_string(file_id),
+                        None if line_number < 0 else line_number,
+                    )
+                if call_stack and type_code != RESUME_CODE:
+                    result.add_call(call_stack[-1], function)
+                call_stack.append(function)
+            elif stack_change < 0:
+                call_stack = call_stacks.get((process_id, thread_id))
                 if call_stack:
                     call_stack.pop()
         return result
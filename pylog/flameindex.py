@@ -0,0 +1,237 @@
+"""An interval index over the calls in a log, for level-of-detail flame charts
+
+FlameIndex is built in one pass over the events. Calls are numbered in the
+order they're made (the flame chart id of call i is i + 1). Each thread (of
+each process, in logs merged from several) gets its own lane, drawn as a
+separate chart. For each lane and depth, the calls
+at that depth are kept sorted by start time; calls at the same depth in the
+same thread never overlap, so their end times are sorted too and the calls
+visible in a time window are found with two binary searches.
+
+FlameIndex.query returns the calls in a time window and depth range at the
+level of detail a chart of a given pixel width can show:
+* calls at least one pixel wide are returned as they are, with their
+    children at the next depth
+* runs of narrower siblings are merged into one "N calls" block that is
+    about a pixel wide. Merged blocks (and single calls narrower than a
+    pixel) don't get their children returned
+so the size of a response depends on the width of the chart, not on the
+number of calls in the log."""
+from array import array
+import bisect
+
+from six import itervalues
+from six.moves import range
+
+from pylog.events import NS_PER_SECOND, TIMESTAMP_TYPECODE, format_timestamp
+
+DEFAULT_MAX_DEPTH = 100
+
+class FlameIndex(object):
+    def __init__(self):
+        #per call, in call order. Calls that never return end with the last event
+        self.starts = array(TIMESTAMP_TYPECODE)
+        self.ends = array(TIMESTAMP_TYPECODE)
+        self.depths = array("i")
+        self.lanes = array("i")
+        #index of the calling call, -1 for top level calls
+        self.parents = array(TIMESTAMP_TYPECODE)
+        #index after the call's last descendant
+        self.subtree_ends = array(TIMESTAMP_TYPECODE)
+        self.names = []
+        self.file_names = []
+        self.args = []
+        self.retvals = []
+        #the (process id, thread id) of each lane, in the order the threads made their first call
+        self.lane_threads = []
+        #per lane, per depth: call indexes, and their start and end times
+        self.depth_calls = []
+        self.depth_starts = []
+        self.depth_ends = []
+        self.start_time = None
+        self.stop_time = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_events(cls, events):
+        result = cls()
+        #(process id, thread id) -> (lane, call stack)
+        threads = {}
+        #threads' events may not be in time order
+        last_time = None
+        for event in events:
+            timestamp = event.timestamp
+            if last_time is None or timestamp > last_time:
+                last_time = timestamp
+            if event.stack_change > 0:
+                thread_key = (event.process_id, event.thread_id)
+                try:
+                    lane, call_stack = threads[thread_key]
+                except KeyError:
+                    lane, call_stack = threads[thread_key] = (len(result.lane_threads), [])
+                    result.lane_threads.append(thread_key)
+                index = len(result.starts)
+                result.starts.append(timestamp)
+                result.ends.append(timestamp)
+                result.depths.append(len(call_stack))
+                result.lanes.append(lane)
+                result.parents.append(call_stack[-1] if call_stack else -1)
+                result.subtree_ends.append(index + 1)
+                result.names.append(event.function_name)
+                result.file_names.append(event.file_name)
+                result.args.append(event.args)
+                result.retvals.append("")
+                call_stack.append(index)
+            elif event.stack_change < 0 and (event.process_id, event.thread_id) in threads:
+                call_stack = threads[event.process_id, event.thread_id][1]
+                if not call_stack:
+                    continue
+                index = call_stack.pop()
+                result.ends[index] = timestamp
+                result.retvals[index] = getattr(event, "retval", "")
+                result.subtree_ends[index] = len(result.starts)
+        for _, call_stack in itervalues(threads):
+            for index in call_stack:
+                result.ends[index] = last_time
+                result.subtree_ends[index] = len(result.starts)
+        if len(result):
+            result.start_time = min(result.starts)
+            result.stop_time = max(result.ends[index] for index in range(len(result)) if result.parents[index] < 0)
+        result.index_depths()
+        return result
+
+    def index_depths(self):
+        self.depth_calls = [[] for _ in self.lane_threads]
+        self.depth_starts = [[] for _ in self.lane_threads]
+        self.depth_ends = [[] for _ in self.lane_threads]
+        for index in range(len(self)):
+            lane, depth = self.lanes[index], self.depths[index]
+            depth_calls, depth_starts, depth_ends = self.depth_calls[lane], self.depth_starts[lane], self.depth_ends[lane]
+            while len(depth_calls) <= depth:
+                depth_calls.append(array(TIMESTAMP_TYPECODE))
+                depth_starts.append(array(TIMESTAMP_TYPECODE))
+                depth_ends.append(array(TIMESTAMP_TYPECODE))
+            depth_calls[depth].append(index)
+            depth_starts[depth].append(self.starts[index])
+            depth_ends[depth].append(self.ends[index])
+
+    def seconds(self, timestamp):
+        return float(timestamp - self.start_time) / NS_PER_SECOND
+
+    def call_data(self, index):
+        parent = self.parents[index]
+        return {
+            "id": index + 1,
+            "depth": self.depths[index],
+            "parent_id": parent + 1 if parent >= 0 else None,
+            "call_time": self.seconds(self.starts[index]),
+            "ret_time": self.seconds(self.ends[index]),
+            "name": self.names[index],
+            "file_name": self.file_names[index],
+            "args": self.args[index],
+            "retval": self.retvals[index],
+            "thread_id": self.lane_threads[self.lanes[index]][1],
+            "process_id": self.lane_threads[self.lanes[index]][0],
+        }
+
+    def merged_data(self, first, last, count):
+        """A block standing in for `count` sibling calls, from call first to call last"""
+        parent = self.parents[first]
+        return {
+            "id": None,
+            "first_id": first + 1,
+            "count": count,
+            "depth": self.depths[first],
+            "parent_id": parent + 1 if parent >= 0 else None,
+            "call_time": self.seconds(self.starts[first]),
+            "ret_time": self.seconds(self.ends[last]),
+            "name": "{0} calls".format(count),
+            "file_name": "",
+            "args": "",
+            "retval": "",
+            "thread_id": self.lane_threads[self.lanes[first]][1],
+            "process_id": self.lane_threads[self.lanes[first]][0],
+        }
+
+    def children_range(self, index, depth):
+        """(lo, hi) positions in the depth arrays of the children of call index"""
+        calls = self.depth_calls[self.lanes[index]][depth]
+        return bisect.bisect_right(calls, index), bisect.bisect_left(calls, self.subtree_ends[index])
+
+    def query(self, start=None, end=None, min_depth=0, max_depth=DEFAULT_MAX_DEPTH, width=None):
+        """The calls overlapping [start, end] at depths min_depth..max_depth, lane by lane
+
+        start, end: timestamps in ns. Defaults to the whole log
+        width: the width of the chart in pixels. Calls narrower than
+            (end - start) / width are merged. None merges nothing"""
+        if not len(self):
+            return []
+        start = self.start_time if start is None else start
+        end = self.stop_time if end is None else end
+        min_duration = float(end - start) / width if width else 0
+        result = []
+        for lane in range(len(self.lane_threads)):
+            self.query_lane(result, lane, start, end, min_depth, max_depth, min_duration)
+        return result
+
+    def query_lane(self, result, lane, start, end, min_depth, max_depth, min_duration):
+        """Add the calls of one lane that query returns to result"""
+        lane_calls, lane_starts, lane_ends = self.depth_calls[lane], self.depth_starts[lane], self.depth_ends[lane]
+        if min_depth >= len(lane_calls):
+            return
+        #(lo, hi) ranges of positions in the depth arrays to look at
+        ranges = [(0, len(lane_calls[min_depth]))]
+        depth = min_depth
+        while ranges and depth <= max_depth:
+            calls, starts, ends = lane_calls[depth], lane_starts[depth], lane_ends[depth]
+            expand = depth < max_depth and depth + 1 < len(lane_calls)
+            next_ranges = []
+            for lo, hi in ranges:
+                #only the calls that overlap the window
+                lo = bisect.bisect_left(ends, start, lo, hi)
+                hi = bisect.bisect_right(starts, end, lo, hi)
+                position = lo
+                while position < hi:
+                    index = calls[position]
+                    if ends[position] - starts[position] >= min_duration:
+                        result.append(self.call_data(index))
+                        if expand:
+                            next_ranges.append(self.children_range(index, depth + 1))
+                        position += 1
+                        continue
+                    #merge the narrow calls starting within a pixel of this one
+                    next_position = bisect.bisect_left(starts, starts[position] + min_duration, position + 1, hi)
+                    last = next_position - 1
+                    if last > position and ends[last] - starts[last] >= min_duration:
+                        #only the last of them can be wide
+                        last -= 1
+                    #siblings only
+                    parent = self.parents[index]
+                    while self.parents[calls[last]] != parent:
+                        last -= 1
+                    if last == position:
+                        result.append(self.call_data(index))
+                    else:
+                        result.append(self.merged_data(index, calls[last], last - position + 1))
+                    position = last + 1
+            ranges = next_ranges
+            depth += 1
+
+    def to_flame_chart(self, start=None, end=None, min_depth=0, max_depth=DEFAULT_MAX_DEPTH, width=None):
+        """Like events.flame_chart_from_events, for a window of the log. start and end are seconds from the start of the log"""
+        if not len(self):
+            return {"start_time": None, "total_seconds": 0.0, "lanes": [], "calls": []}
+        start_ns = self.start_time + int(start * NS_PER_SECOND) if start is not None else None
+        end_ns = self.start_time + int(end * NS_PER_SECOND) if end is not None else None
+        return {
+            "start_time": format_timestamp(self.start_time),
+            "total_seconds": self.seconds(self.stop_time),
+            #how many depths each lane has, so the chart can lay them out
+            "lanes": [
+                {"process_id": process_id, "thread_id": thread_id, "depths": len(self.depth_calls[lane])}
+                for lane, (process_id, thread_id) in enumerate(self.lane_threads)
+            ],
+            "calls": self.query(start_ns, end_ns, min_depth, max_depth, width),
+        }
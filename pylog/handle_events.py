@@ -26,7 +26,7 @@ def make_function_graph(function_set):
 
 def main():
     """"""
-    evts = events.events_from_file(fileinput.input())
+    evts = events.iter_events_from_file(fileinput.input(openhook=fileinput.hook_compressed))
     func_set = events.FunctionSet.from_events(evts)
     graph = make_function_graph(func_set)
     graph.format = "svg"
@@ -0,0 +1,321 @@
+"""Following a log while it's being recorded
+
+`pylog-web --follow <log>` shows a log as it grows:
+* LogTailer reads the events appended to a log since it last looked.
+    Records that are only partly written are read the next time. Each read
+    takes at most about max_bytes of the log, so following a long log that
+    already has a lot in it doesn't load all of it at once: LiveFeed reads
+    the rest straight after
+* LiveLog keeps what the viewer shows, in memory bounded by a rolling
+    time window rather than by the length of the log: the calls that ended
+    in the last `window` seconds, the call stack of each thread, and
+    stats.ProfileStats and callpaths.CallPathTree aggregates of every call
+    that ended so far (which grow with the number of functions and call
+    paths, not of calls). update() returns what changed, as a delta
+* LiveFeed polls a LogTailer into a LiveLog in a background thread and
+    keeps the last deltas for the pages following it, which get them as
+    Server-Sent Events (webviewer.LiveWebViewer)"""
+import collections
+import os
+import threading
+
+from pylog import binformat, callpaths, compression, events, logreader, mapped, stats
+
+DEFAULT_WINDOW_SECONDS = 60
+DEFAULT_POLL_SECONDS = 0.5
+#how much of the log a LogTailer reads at a time
+DEFAULT_READ_BYTES = 8 << 20
+#deltas kept for pages that fall behind. Pages further behind start over
+DEFAULT_MAX_DELTAS = 256
+
+class LogTailer(object):
+    """Reads a log as it's written, JSON or binary. Not compressed: its blocks are only written once they're full"""
+
+    def __init__(self, log_path, max_bytes=DEFAULT_READ_BYTES):
+        """max_bytes: about how much of the log to read per call (more if a record is longer)"""
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        #whether the last read stopped before the end of what's been written
+        self.behind = False
+        self.log_file = None
+        self.binary = None
+        #JSON: the offset after the last complete line read
+        self.offset = 0
+        #binary: where to carry on reading (see BinaryFileEventReader.iter_raw)
+        self.start = None
+
+    def read(self):
+        """The events written since the last call, up to about max_bytes of them"""
+        if self.log_file is None:
+            try:
+                self.log_file = open(self.log_path, "rb")
+            except (IOError, OSError):
+                #not created yet
+                return []
+        if os.path.getsize(self.log_path) < max(self.offset, self.start[0] if self.start else 0):
+            #the log was started over
+            self.offset = 0
+            self.start = None
+            self.binary = None
+        if self.binary is None:
+            self.log_file.seek(0)
+            start = self.log_file.read(24)
+            magic = start[:len(binformat.MAGIC)]
+            if len(magic) < len(binformat.MAGIC) and binformat.MAGIC.startswith(magic):
+                return []
+            if compression.detect(start) is not None:
+                raise ValueError("Can't follow a compressed log: {0}".format(self.log_path))
+            self.binary = magic == binformat.MAGIC
+            if self.binary:
+                self.start = (len(binformat.MAGIC), 0, [], None, None, None)
+        if self.binary:
+            return self.read_binary()
+        return self.read_json()
+
+    def read_json(self):
+        result = []
+        self.log_file.seek(self.offset)
+        data = b""
+        while True:
+            chunk = self.log_file.read(self.max_bytes)
+            data += chunk
+            end = data.rfind(b"\n") + 1
+            #carry on if a line is longer than max_bytes
+            if end or len(chunk) < self.max_bytes:
+                break
+        self.behind = len(chunk) == self.max_bytes
+        for event_data in mapped.parse_lines(data[:end]):
+            if event_data["type"] != events.LOG_HEADER_TYPE:
+                result.append(events.event_from_data(event_data))
+        self.offset += end
+        return result
+
+    def read_binary(self):
+        result = []
+        reader = logreader.BinaryFileEventReader(self.log_file, chunk_size=1 << 16)
+        #the state after the last complete event. Strings defined after it are read again next time
+        end = None
+        stop_offset = self.start[0] + self.max_bytes
+        self.behind = False
+        try:
+            for raw in reader.iter_raw(start=self.start):
+                result.append(events.event_from_raw(raw))
+                end = (reader.end_offset, raw[1], len(reader.strings), raw[6], raw[7], raw[8])
+                if reader.end_offset >= stop_offset:
+                    self.behind = True
+                    break
+        except ValueError:
+            #the last record is only partly written
+            pass
+        if end is not None:
+            offset, timestamp, string_count, thread_id, process_id, task_id = end
+            self.start = (offset, timestamp, reader.strings[1:string_count], thread_id, process_id, task_id)
+        return result
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+class LiveLog(object):
+    """The recent calls of a log that's being read bit by bit, and aggregates of all of them
+
+    Calls are lists: [id, depth, parent id, start, end, name, file_name, args, retval, thread_id, process_id].
+    The ids number calls in the order they're made, from 1. The end of a call that's still running is the last
+    event's time"""
+
+    def __init__(self, window=DEFAULT_WINDOW_SECONDS):
+        """window: how many seconds of ended calls to keep"""
+        self.window = int(window * events.NS_PER_SECOND)
+        self.start_time = None
+        self.stop_time = None
+        #(process id, thread id) -> (lane, call stack)
+        self.threads = {}
+        #the (process id, thread id) of each lane, and the most depths it's had
+        self.lane_threads = []
+        self.lane_depths = []
+        #the calls that ended in the window, in the order they ended
+        self.calls = collections.deque()
+        self.call_count = 0
+        self.profile = stats.ProfileStats()
+        self.profile_stacks = stats.ProfileStacks(self.profile)
+        self.call_paths = callpaths.CallPathTree()
+
+    @property
+    def window_start(self):
+        if self.stop_time is None:
+            return None
+        return max(self.stop_time - self.window, self.start_time)
+
+    def update(self, evts):
+        """Add events that were just read. Returns the delta to send to the pages following the log"""
+        evts = list(evts)
+        ended = []
+        for event in evts:
+            timestamp = event.timestamp
+            if self.start_time is None:
+                self.start_time = timestamp
+            if self.stop_time is None or timestamp > self.stop_time:
+                self.stop_time = timestamp
+            if event.stack_change > 0:
+                thread_key = (event.process_id, event.thread_id)
+                try:
+                    lane, call_stack = self.threads[thread_key]
+                except KeyError:
+                    lane, call_stack = self.threads[thread_key] = (len(self.lane_threads), [])
+                    self.lane_threads.append(thread_key)
+                    self.lane_depths.append(0)
+                self.call_count += 1
+                call_stack.append([
+                    self.call_count, len(call_stack), call_stack[-1][0] if call_stack else None, timestamp, timestamp,
+                    event.function_name, event.file_name, getattr(event, "args", ""), "", event.thread_id,
+                    event.process_id,
+                ])
+                self.lane_depths[lane] = max(self.lane_depths[lane], len(call_stack))
+            elif event.stack_change < 0 and (event.process_id, event.thread_id) in self.threads:
+                call_stack = self.threads[event.process_id, event.thread_id][1]
+                if not call_stack:
+                    continue
+                call = call_stack.pop()
+                call[4] = timestamp
+                call[8] = getattr(event, "retval", "")
+                self.calls.append(call)
+                ended.append(call)
+        self.profile_stacks.add_events(evts)
+        if self.profile_stacks.start_time is not None:
+            self.profile.total_time = self.profile_stacks.stop_time - self.profile_stacks.start_time
+        self.call_paths.add_events(evts)
+        window_start = self.window_start
+        while self.calls and self.calls[0][4] < window_start:
+            self.calls.popleft()
+        return {
+            "total_seconds": self.seconds(self.stop_time),
+            "window_start": self.seconds(window_start),
+            "lanes": self.lanes_data(),
+            "calls": [self.call_data(call) for call in ended if call[4] >= window_start],
+            "open": self.open_calls_data(),
+        }
+
+    def seconds(self, timestamp):
+        if timestamp is None:
+            return 0.0
+        return float(timestamp - self.start_time) / events.NS_PER_SECOND
+
+    def call_data(self, call, running=False):
+        """The flame chart data of a call (see flameindex.FlameIndex.call_data)"""
+        return {
+            "id": call[0],
+            "depth": call[1],
+            "parent_id": call[2],
+            "call_time": self.seconds(call[3]),
+            "ret_time": self.seconds(self.stop_time if running else call[4]),
+            "name": call[5],
+            "file_name": call[6],
+            "args": call[7],
+            "retval": call[8],
+            "thread_id": call[9],
+            "process_id": call[10],
+            "open": running,
+        }
+
+    def open_calls_data(self):
+        return [
+            self.call_data(call, running=True)
+            for _, call_stack in sorted(self.threads.values(), key=lambda lane_stack: lane_stack[0])
+            for call in call_stack
+        ]
+
+    def lanes_data(self):
+        return [
+            {"process_id": process_id, "thread_id": thread_id, "depths": depths}
+            for (process_id, thread_id), depths in zip(self.lane_threads, self.lane_depths)
+        ]
+
+    def to_flame_chart(self, start=None, end=None):
+        """Like flameindex.FlameIndex.to_flame_chart, for the calls in the window and the calls still running.
+        start and end are seconds from the start of the log"""
+        calls = [self.call_data(call) for call in self.calls] + self.open_calls_data()
+        if start is not None:
+            calls = [call for call in calls if call["ret_time"] >= start]
+        if end is not None:
+            calls = [call for call in calls if call["call_time"] <= end]
+        return {
+            "live": True,
+            "start_time": events.format_timestamp(self.start_time) if self.start_time is not None else None,
+            "total_seconds": self.seconds(self.stop_time),
+            "window_start": self.seconds(self.window_start),
+            "lanes": self.lanes_data(),
+            "calls": calls,
+        }
+
+    def function_set(self):
+        """The functions called so far, with their callers and callees"""
+        result = events.FunctionSet()
+        for key in self.profile.functions:
+            result.add_function(*key)
+        for caller, callee in self.profile.edges:
+            result.add_call(result.add_function(*caller), result.add_function(*callee))
+        return result
+
+class LiveFeed(object):
+    """Reads a log into a LiveLog as it's written and keeps the last deltas for the pages following it
+
+    Deltas are numbered from 1; sequence is the number of the last one. Use
+    the LiveLog under `with feed.lock`"""
+
+    def __init__(self, tailer, live_log, interval=DEFAULT_POLL_SECONDS, max_deltas=DEFAULT_MAX_DELTAS):
+        """interval: seconds between reads of the log"""
+        self.tailer = tailer
+        self.live_log = live_log
+        self.interval = interval
+        self.lock = threading.Condition()
+        self.sequence = 0
+        #(sequence number, delta)
+        self.deltas = collections.deque(maxlen=max_deltas)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """Read what's new in the log. Returns whether there was anything"""
+        evts = self.tailer.read()
+        if not evts:
+            return False
+        with self.lock:
+            delta = self.live_log.update(evts)
+            self.sequence += 1
+            self.deltas.append((self.sequence, delta))
+            self.lock.notify_all()
+        return True
+
+    def poll_loop(self):
+        #no waiting while there's more to read
+        while not self.stopping.wait(0 if self.tailer.behind else self.interval):
+            self.poll()
+
+    def start(self):
+        """Poll in a background thread"""
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.poll_loop, name="pylog-follow")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def wait(self, after, timeout=None):
+        """The (sequence number, delta)s after delta number `after`, waiting up to timeout seconds for one if
+        there are none yet. None if some of them were dropped: the page has to start over"""
+        with self.lock:
+            if self.sequence == after and timeout:
+                self.lock.wait(timeout)
+            if self.sequence == after:
+                return []
+            if not self.deltas or self.deltas[0][0] > after + 1 or after > self.sequence:
+                return None
+            return [(sequence, delta) for sequence, delta in self.deltas if sequence > after]
@@ -0,0 +1,343 @@
+"""A sidecar index for random access into large logs
+
+An index is built in one pass over a log (`pylog index <log>`, or
+`pylog record --index`) and saved next to it as <log>.idx. It holds:
+* checkpoints: the byte offset of every checkpoint_interval-th event, so
+    event N can be read by seeking to the checkpoint before it and reading
+    at most checkpoint_interval events
+* matches: for every call the index of its return (or exception) event and
+    the other way around, -1 for everything else
+* depths: the call depth at every event, in its thread (see events.EventStore.depths)
+* locations: for every (file, line), the sorted indexes of the events there,
+    so the next visit to a location is a binary search
+
+Index file layout: INDEX_MAGIC, an 8 byte little endian length, JSON
+metadata, then the arrays in the order the metadata lists them, in the byte
+order recorded in the metadata."""
+from array import array
+import bisect
+import collections
+import json
+import os
+import struct
+import sys
+
+from pylog import compression, events, logreader
+
+INDEX_MAGIC = b"\x89PYLOGIDX\x01\n"
+INDEX_VERSION = 4
+DEFAULT_CHECKPOINT_INTERVAL = 1024
+INDEX_TYPECODE = events.TIMESTAMP_TYPECODE
+
+def index_path(log_path):
+    return log_path + ".idx"
+
+def array_to_bytes(arr):
+    return arr.tobytes() if hasattr(arr, "tobytes") else arr.tostring()
+
+def array_from_bytes(typecode, data, byteorder):
+    arr = array(typecode)
+    if hasattr(arr, "frombytes"):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if byteorder != sys.byteorder:
+        arr.byteswap()
+    return arr
+
+class LogIndexBuilder(object):
+    """Builds a LogIndex from events as they're read"""
+
+    def __init__(self, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_offsets = array(INDEX_TYPECODE)
+        self.checkpoint_timestamps = array(INDEX_TYPECODE)
+        #the thread, process and task of the event at each checkpoint, -1 for None
+        self.checkpoint_threads = array(INDEX_TYPECODE)
+        self.checkpoint_processes = array(INDEX_TYPECODE)
+        self.checkpoint_tasks = array(INDEX_TYPECODE)
+        self.matches = array(INDEX_TYPECODE)
+        self.depths = array("i")
+        #(file_name, line_number) -> event indexes
+        self.locations = collections.OrderedDict()
+        #(process id, thread id) -> indexes of the calls that haven't returned
+        self.open_calls = {}
+        self.event_count = 0
+
+    def add(self, event_type, file_name, line_number, offset, timestamp_before=0, thread_id=None, process_id=None,
+            task_id=None):
+        """offset: where the event starts in the log
+        timestamp_before: the previous event's timestamp (needed to resume binary logs)"""
+        event_index = self.event_count
+        self.event_count += 1
+        if event_index % self.checkpoint_interval == 0:
+            self.checkpoint_offsets.append(offset)
+            self.checkpoint_timestamps.append(timestamp_before)
+            self.checkpoint_threads.append(-1 if thread_id is None else thread_id)
+            self.checkpoint_processes.append(-1 if process_id is None else process_id)
+            self.checkpoint_tasks.append(-1 if task_id is None else task_id)
+        stack_change = events.EVENT_LOOKUP[event_type].stack_change
+        self.matches.append(-1)
+        try:
+            open_calls = self.open_calls[process_id, thread_id]
+        except KeyError:
+            open_calls = self.open_calls[process_id, thread_id] = []
+        if stack_change > 0:
+            open_calls.append(event_index)
+        self.depths.append(len(open_calls))
+        if stack_change < 0 and open_calls:
+            call_index = open_calls.pop()
+            self.matches[call_index] = event_index
+            self.matches[event_index] = call_index
+        if stack_change >= 0:
+            location = (file_name, line_number)
+            try:
+                self.locations[location].append(event_index)
+            except KeyError:
+                self.locations[location] = array(INDEX_TYPECODE, [event_index])
+
+    def build(self, log_format, log_size, strings=None):
+        return LogIndex(
+            log_format=log_format,
+            log_size=log_size,
+            checkpoint_interval=self.checkpoint_interval,
+            checkpoint_offsets=self.checkpoint_offsets,
+            checkpoint_timestamps=self.checkpoint_timestamps,
+            checkpoint_threads=self.checkpoint_threads,
+            checkpoint_processes=self.checkpoint_processes,
+            checkpoint_tasks=self.checkpoint_tasks,
+            matches=self.matches,
+            depths=self.depths,
+            locations=self.locations,
+            strings=strings or [],
+        )
+
+class LogIndex(object):
+    def __init__(self, log_format, log_size, checkpoint_interval, checkpoint_offsets,
+                 checkpoint_timestamps, checkpoint_threads, checkpoint_processes, checkpoint_tasks, matches, depths,
+                 locations, strings):
+        self.log_format = log_format
+        self.log_size = log_size
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_offsets = checkpoint_offsets
+        self.checkpoint_timestamps = checkpoint_timestamps
+        self.checkpoint_threads = checkpoint_threads
+        self.checkpoint_processes = checkpoint_processes
+        self.checkpoint_tasks = checkpoint_tasks
+        self.matches = matches
+        self.depths = depths
+        self.locations = locations
+        #the string table of a binary log, needed to start reading it from a checkpoint
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.depths)
+
+    @classmethod
+    def build(cls, log_path, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        """Index the log at log_path by reading it once. Offsets in a compressed log are of its decompressed
+        contents"""
+        builder = LogIndexBuilder(checkpoint_interval)
+        with open(log_path, "rb") as raw_file:
+            log_file = compression.open_compressed(raw_file)
+            if logreader.is_binary_log(log_file):
+                reader = logreader.BinaryFileEventReader(log_file)
+                timestamp = 0
+                for raw in reader.iter_raw():
+                    builder.add(raw[0], raw[2], raw[3], reader.event_offset, timestamp, raw[6], raw[7], raw[8])
+                    timestamp = raw[1]
+                strings = reader.strings[1:] if reader.strings else []
+                index = builder.build("binary", os.path.getsize(log_path), strings)
+            else:
+                offset = 0
+                for line in log_file:
+                    if line.strip():
+                        data = json.loads(line)
+                        if data["type"] != events.LOG_HEADER_TYPE:
+                            builder.add(
+                                data["type"], data.get("file_name"), data.get("line_number"), offset,
+                                thread_id=data.get("thread_id"), process_id=data.get("process_id"),
+                                task_id=data.get("task_id"),
+                            )
+                    offset += len(line)
+                index = builder.build("json", os.path.getsize(log_path))
+        return index
+
+    def save(self, path):
+        locations = list(self.locations.items())
+        meta = {
+            "version": INDEX_VERSION,
+            "byteorder": sys.byteorder,
+            "log_format": self.log_format,
+            "log_size": self.log_size,
+            "checkpoint_interval": self.checkpoint_interval,
+            "event_count": len(self.depths),
+            "checkpoint_count": len(self.checkpoint_offsets),
+            "strings": self.strings,
+            "locations": [[file_name, line_number, len(indexes)] for (file_name, line_number), indexes in locations],
+        }
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        with open(path, "wb") as index_file:
+            index_file.write(INDEX_MAGIC)
+            index_file.write(struct.pack("<Q", len(meta_bytes)))
+            index_file.write(meta_bytes)
+            arrays = (
+                self.checkpoint_offsets, self.checkpoint_timestamps, self.checkpoint_threads, self.checkpoint_processes,
+                self.checkpoint_tasks, self.matches, self.depths,
+            )
+            for arr in arrays:
+                index_file.write(array_to_bytes(arr))
+            for _, indexes in locations:
+                index_file.write(array_to_bytes(indexes))
+
+    @classmethod
+    def load(cls, path, log_path=None):
+        """Load an index. If log_path is given, check the index still matches the log"""
+        with open(path, "rb") as index_file:
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("Not a pylog index: {0}".format(path))
+            meta_length, = struct.unpack("<Q", index_file.read(8))
+            meta = json.loads(index_file.read(meta_length).decode("utf-8"))
+            if meta["version"] != INDEX_VERSION:
+                raise ValueError("Unsupported index version: {0}".format(path))
+            byteorder = meta["byteorder"]
+            def read_array(typecode, count):
+                itemsize = array(typecode).itemsize
+                return array_from_bytes(typecode, index_file.read(itemsize * count), byteorder)
+            checkpoint_offsets = read_array(INDEX_TYPECODE, meta["checkpoint_count"])
+            checkpoint_timestamps = read_array(INDEX_TYPECODE, meta["checkpoint_count"])
+            checkpoint_threads = read_array(INDEX_TYPECODE, meta["checkpoint_count"])
+            checkpoint_processes = read_array(INDEX_TYPECODE, meta["checkpoint_count"])
+            checkpoint_tasks = read_array(INDEX_TYPECODE, meta["checkpoint_count"])
+            matches = read_array(INDEX_TYPECODE, meta["event_count"])
+            depths = read_array("i", meta["event_count"])
+            locations = collections.OrderedDict()
+            for file_name, line_number, count in meta["locations"]:
+                locations[file_name, line_number] = read_array(INDEX_TYPECODE, count)
+        if log_path is not None and os.path.getsize(log_path) != meta["log_size"]:
+            raise ValueError("The index {0} is out of date".format(path))
+        return cls(
+            log_format=meta["log_format"],
+            log_size=meta["log_size"],
+            checkpoint_interval=meta["checkpoint_interval"],
+            checkpoint_offsets=checkpoint_offsets,
+            checkpoint_timestamps=checkpoint_timestamps,
+            checkpoint_threads=checkpoint_threads,
+            checkpoint_processes=checkpoint_processes,
+            checkpoint_tasks=checkpoint_tasks,
+            matches=matches,
+            depths=depths,
+            locations=locations,
+            strings=meta["strings"],
+        )
+
+    @classmethod
+    def for_log(cls, log_path):
+        """Load the sidecar index of a log, building and saving it if it's missing or stale"""
+        path = index_path(log_path)
+        try:
+            return cls.load(path, log_path)
+        except (IOError, OSError, ValueError):
+            index = cls.build(log_path)
+            index.save(path)
+            return index
+
+    def match(self, event_index):
+        """The index of the return for a call (or the call for a return). -1 if there's none"""
+        return self.matches[event_index]
+
+    def depth(self, event_index):
+        return self.depths[event_index]
+
+    def next_visit(self, file_name, line_number, after):
+        """The index of the first event at file_name:line_number after event `after`. None if there's none"""
+        indexes = self.locations.get((file_name, line_number))
+        if not indexes:
+            return None
+        position = bisect.bisect_right(indexes, after)
+        return indexes[position] if position < len(indexes) else None
+
+    def previous_visit(self, file_name, line_number, before):
+        """The index of the last event at file_name:line_number before event `before`. None if there's none"""
+        indexes = self.locations.get((file_name, line_number))
+        if not indexes:
+            return None
+        position = bisect.bisect_left(indexes, before)
+        return indexes[position - 1] if position > 0 else None
+
+    def checkpoint(self, event_index):
+        """(checkpoint number, offset, timestamp before it, thread id, process id, task id) for the checkpoint at
+        or before event_index"""
+        number = event_index // self.checkpoint_interval
+        thread_id = self.checkpoint_threads[number]
+        process_id = self.checkpoint_processes[number]
+        task_id = self.checkpoint_tasks[number]
+        return (
+            number, self.checkpoint_offsets[number], self.checkpoint_timestamps[number],
+            None if thread_id < 0 else thread_id, None if process_id < 0 else process_id,
+            None if task_id < 0 else task_id,
+        )
+
+class IndexedLog(object):
+    """Random access to the events of a log through its LogIndex
+
+    Events are read a checkpoint interval at a time, and the last few blocks
+    are kept in memory, so walking the log in either direction is cheap."""
+
+    def __init__(self, log_path, index=None, cached_blocks=8):
+        self.index = index or LogIndex.for_log(log_path)
+        self.raw_file = open(log_path, "rb")
+        self.log_file = compression.open_compressed(self.raw_file)
+        self.cached_blocks = cached_blocks
+        #checkpoint number -> list of events, in least recently used order
+        self.blocks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, event_index):
+        if event_index < 0:
+            event_index += len(self)
+        if not 0 <= event_index < len(self):
+            raise IndexError("event index out of range")
+        number = event_index // self.index.checkpoint_interval
+        return self.get_block(number)[event_index % self.index.checkpoint_interval]
+
+    def __iter__(self):
+        for event_index in range(len(self)):
+            yield self[event_index]
+
+    def get_block(self, number):
+        try:
+            block = self.blocks.pop(number)
+        except KeyError:
+            block = self.read_block(number)
+            if len(self.blocks) >= self.cached_blocks:
+                self.blocks.popitem(last=False)
+        self.blocks[number] = block
+        return block
+
+    def read_block(self, number):
+        _, offset, timestamp, thread_id, process_id, task_id = self.index.checkpoint(
+            number * self.index.checkpoint_interval)
+        count = self.index.checkpoint_interval
+        block = []
+        if self.index.log_format == "binary":
+            reader = logreader.BinaryFileEventReader(self.log_file, chunk_size=1 << 16)
+            for raw in reader.iter_raw(start=(offset, timestamp, self.index.strings, thread_id, process_id, task_id)):
+                block.append(events.event_from_raw(raw))
+                if len(block) == count:
+                    break
+        else:
+            self.log_file.seek(offset)
+            while len(block) < count:
+                line = self.log_file.readline()
+                if not line:
+                    break
+                if line.strip():
+                    block.append(events.event_from_data(json.loads(line)))
+        return block
+
+    def close(self):
+        self.log_file.close()
+        self.raw_file.close()
@@ -1,14 +1,195 @@
 import json
-import events
+
+from pylog import binformat, compression, events, mapped
+
 class JsonFileEventReader(object):
     """Reads a log file"""
 
     def __init__(self, log_file):
         """log_file: an open file to read from"""
         self.log_file = log_file
+        #the log header (events.make_log_header), once it's been read. None for version 1 logs
+        self.header = None
+
+    def iter_events(self):
+        for event_data in mapped.iter_json(self.log_file):
+            if event_data["type"] == events.LOG_HEADER_TYPE:
+                self.header = event_data
+                continue
+            yield events.event_from_data(event_data)
+
+def decode_varint(buf, pos):
+    """returns (value, position after the varint)"""
+    byte = buf[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = buf[pos]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+def decode_bytes(buf, pos):
+    """returns (bytes, position after them) for a length-prefixed string"""
+    length, pos = decode_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise IndexError("record continues in the next chunk")
+    return bytes(buf[pos:end]), end
+
+class BinaryFileEventReader(object):
+    """Reads a log written by debugger.BinaryFileEventLogger"""
+
+    def __init__(self, log_file, chunk_size=1 << 20):
+        """log_file: a file opened in binary mode. It's decoded straight out of a mapping if it can be mapped (see
+        mapped), else read chunk_size bytes at a time"""
+        self.log_file = log_file
+        self.chunk_size = chunk_size
+        #the log header (events.make_log_header), once it's been read
+        self.header = None
+        #the string table, once reading has started (index 0 is None)
+        self.strings = None
+        self.event_offset = None
+        self.end_offset = None
 
     def iter_events(self):
-        for line in self.log_file:
-            if line:
-                event_data = json.loads(line)
-                yield events.event_from_data(event_data)
+        for raw in self.iter_raw():
+            yield events.event_from_raw(raw)
+
+    def iter_raw(self, start=None):
+        """yields [event_type, timestamp in ns, file_name, line_number, function_name, args or retval, thread_id,
+        process_id, task_id]
+
+        start: (offset, timestamp before it, string table, thread id, process id, task id) to start
+            reading from the middle of the log, e.g. from a logindex.LogIndex checkpoint.
+        While iterating, event_offset is the file offset of the last event yielded and end_offset the offset
+        right after it"""
+        if start is None:
+            magic = self.log_file.read(len(binformat.MAGIC))
+            if magic != binformat.MAGIC:
+                raise ValueError("Not a binary pylog log")
+            offset, timestamp, table, thread_id, process_id, task_id = len(binformat.MAGIC), 0, [], None, None, None
+        else:
+            offset, timestamp, table, thread_id, process_id, task_id = start
+            self.log_file.seek(offset)
+        #string table. Index 0 is None so ids (which are offset by 1) can be used directly
+        strings = self.strings = [None] + list(table)
+        #file offset of buf[0]
+        buf_base = offset
+        buf = bytearray()
+        pos = 0
+        eof = False
+        mapping = mapped.map_file(self.log_file) if mapped.MAPS_BINARY else None
+        if mapping is not None:
+            #buf is the whole file. The mapping is unmapped once the memoryview and it are garbage collected
+            buf_base, buf, pos, eof = 0, mapping, offset, True
+        while True:
+            if pos >= len(buf):
+                if eof:
+                    return
+                buf_base += len(buf)
+                buf = bytearray(self.log_file.read(self.chunk_size))
+                pos = 0
+                eof = not buf
+                continue
+            start = pos
+            try:
+                tag = buf[pos]
+                pos += 1
+                if tag == binformat.TAG_STRING:
+                    string, pos = decode_bytes(buf, pos)
+                    strings.append(string.decode("utf-8"))
+                    continue
+                elif tag == binformat.TAG_HEADER:
+                    header, pos = decode_bytes(buf, pos)
+                    self.header = json.loads(header.decode("utf-8"))
+                    continue
+                elif tag == binformat.TAG_THREAD:
+                    thread_id, pos = decode_varint(buf, pos)
+                    thread_id = thread_id - 1 if thread_id else None
+                    continue
+                elif tag == binformat.TAG_PROCESS:
+                    process_id, pos = decode_varint(buf, pos)
+                    process_id = process_id - 1 if process_id else None
+                    continue
+                elif tag == binformat.TAG_TASK:
+                    task_id, pos = decode_varint(buf, pos)
+                    task_id = task_id - 1 if task_id else None
+                    continue
+                event_type = binformat.TAG_EVENT_TYPES[tag]
+                delta, pos = decode_varint(buf, pos)
+                file_id, pos = decode_varint(buf, pos)
+                line_number, pos = decode_varint(buf, pos)
+                function_id = 0
+                if tag in binformat.FUNCTION_TAGS:
+                    function_id, pos = decode_varint(buf, pos)
+                value = None
+                if tag in binformat.VALUE_TAGS:
+                    kind, pos = decode_varint(buf, pos)
+                    if kind != binformat.VALUE_NONE:
+                        value, pos = decode_bytes(buf, pos)
+                        value = value.decode("utf-8")
+                        if kind == binformat.VALUE_JSON:
+                            value = json.loads(value)
+                elif event_type == "sample":
+                    interval, pos = decode_varint(buf, pos)
+                    frame_count, pos = decode_varint(buf, pos)
+                    stack = []
+                    for _ in range(frame_count):
+                        frame_function_id, pos = decode_varint(buf, pos)
+                        frame_file_id, pos = decode_varint(buf, pos)
+                        frame_line_number, pos = decode_varint(buf, pos)
+                        stack.append((
+                            strings[frame_function_id],
+                            strings[frame_file_id],
+                            frame_line_number - 1 if frame_line_number else None,
+                        ))
+                    value = (interval, stack)
+            except IndexError:
+                #the record is cut off at the end of the chunk
+                chunk = self.log_file.read(self.chunk_size) if not eof else None
+                if not chunk:
+                    raise ValueError("Truncated binary log")
+                buf_base += start
+                buf = buf[start:] + bytearray(chunk)
+                pos = 0
+                continue
+            timestamp += binformat.unzigzag(delta)
+            self.event_offset = buf_base + start
+            self.end_offset = buf_base + pos
+            yield [
+                event_type,
+                timestamp,
+                strings[file_id],
+                line_number - 1 if line_number else None,
+                strings[function_id],
+                value,
+                thread_id,
+                process_id,
+                task_id,
+            ]
+
+def is_binary_log(log_file):
+    """Whether a file opened in binary mode holds a binary log. Doesn't move the file position"""
+    position = log_file.tell()
+    magic = log_file.read(len(binformat.MAGIC))
+    log_file.seek(position)
+    return magic == binformat.MAGIC
+
+def get_reader(log_file):
+    """Return the right reader for a log file opened in binary mode, compressed or not"""
+    log_file = compression.open_compressed(log_file)
+    if is_binary_log(log_file):
+        return BinaryFileEventReader(log_file)
+    return JsonFileEventReader(log_file)
+
+def iter_log_events(log_path):
+    """Lazily read the events of the log at log_path, whatever its format.
+    Samples are expanded into calls and returns (see events.expand_samples)"""
+    with open(log_path, "rb") as log_file:
+        for event in events.expand_samples(get_reader(log_file).iter_events()):
+            yield event
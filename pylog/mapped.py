@@ -0,0 +1,97 @@
+"""Reading logs in blocks, through memory maps
+
+A log that's a plain file on disk (not compressed, see compression) is
+read through an mmap of it rather than with read() calls:
+* binary logs are decoded straight out of the mapping (see
+    logreader.BinaryFileEventReader), with no chunks copied out of the
+    file and no records pieced together across chunks. Their records
+    aren't fixed width (they're mostly varints, see binformat), so they're
+    still decoded one at a time. Python 2 indexes mappings as 1 character
+    strings, so it reads binary logs a chunk at a time
+* JSON logs are split into blocks of about BLOCK_SIZE bytes of whole
+    lines, found with mmap.rfind, and each block is parsed with one
+    json.loads call (the lines joined into a JSON array) instead of a call
+    per line, which takes about half as long. Files that can't be mapped
+    are read a block at a time"""
+import io
+import json
+import mmap
+
+import six
+
+BLOCK_SIZE = 1 << 20
+#whether indexing a mapping gives ints, which the binary decoder needs
+MAPS_BINARY = six.PY3
+#the types of files open() returns (unbuffered)
+FILE_TYPES = (io.FileIO, getattr(six.moves.builtins, "file", io.FileIO))
+
+def map_file(log_file):
+    """A read-only mmap of the whole of log_file, or None if it isn't a plain file that can be mapped (a compressed
+    log, an empty file, a pipe, an in-memory file...)"""
+    raw = getattr(log_file, "raw", log_file)
+    if not isinstance(raw, FILE_TYPES):
+        return None
+    try:
+        return mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def iter_blocks(log_file, end=None, block_size=BLOCK_SIZE):
+    """Blocks of whole lines, of about block_size bytes, of a file opened in binary mode, from its current
+    position to end (an offset at the start of a line), or to the end of the file. The last one doesn't end with a
+    newline if the file doesn't"""
+    mapping = map_file(log_file)
+    if mapping is None:
+        rest = b""
+        remaining = None if end is None else end - log_file.tell()
+        while True:
+            chunk = log_file.read(block_size if remaining is None else min(block_size, remaining))
+            if remaining is not None:
+                remaining -= len(chunk)
+            if not chunk:
+                if rest:
+                    yield rest
+                return
+            chunk = rest + chunk
+            lines_end = chunk.rfind(b"\n") + 1
+            rest = chunk[lines_end:]
+            if lines_end:
+                yield chunk[:lines_end]
+    try:
+        pos = log_file.tell()
+        size = len(mapping) if end is None else min(end, len(mapping))
+        while pos < size:
+            block_end = size
+            if pos + block_size < size:
+                block_end = mapping.rfind(b"\n", pos, pos + block_size) + 1
+                if block_end <= pos:
+                    #a line longer than block_size
+                    block_end = min(mapping.find(b"\n", pos + block_size) + 1 or size, size)
+            yield mapping[pos:block_end]
+            pos = block_end
+    finally:
+        mapping.close()
+
+def parse_lines(block):
+    """The JSON values of the lines of a block, parsed in one go. Blank lines are skipped"""
+    lines = block.strip()
+    if not lines:
+        return []
+    try:
+        return json.loads(b"[" + lines.replace(b"\n", b",") + b"]")
+    except ValueError:
+        #blank lines, or a line that isn't JSON: parse them one by one to skip the first and report the second
+        return [json.loads(line) for line in lines.splitlines() if line.strip()]
+
+def iter_json(log_file, end=None):
+    """The values of the lines of a JSON lines log (up to offset end), parsed a block at a time. Files that aren't
+    read as bytes (text streams, fileinput) are parsed a line at a time, to their end"""
+    read = getattr(log_file, "read", None)
+    if read is None or not isinstance(read(0), bytes):
+        for line in log_file:
+            if line.strip():
+                yield json.loads(line)
+        return
+    for block in iter_blocks(log_file, end):
+        for data in parse_lines(block):
+            yield data
@@ -0,0 +1,310 @@
+"""Profiling a log with several processes
+
+profile_stats splits a log into chunks and builds the stats.ProfileStats
+of each chunk in a process pool, then merges them. A chunk can't be
+profiled on its own: the calls still running (or suspended) when it starts
+were made in earlier chunks. So it takes two passes over the log:
+1. each chunk is compacted (StackCompactor) into the few stack events that
+    leave the same calls running and suspended as the whole chunk does:
+    calls that return in the chunk are dropped with their returns. The
+    compacted chunks are replayed in order into a stats.CallStacks, which
+    gives the stacks each chunk starts with. This pass only looks at the
+    events that change the stacks, without building Event objects
+    (iter_chunk_stack_changes): in JSON logs the lines of other events
+    aren't even parsed
+2. each chunk is profiled from its starting stacks (stats.ProfileStacks),
+    and the partial stats are merged. The calls still running at the end
+    of the last chunk are ended at the time of the log's last event, once
+    every chunk has been read
+
+The first pass costs a fraction of the second (on a log of calls and
+lines, about a quarter of it for JSON and half for binary logs, whose
+records all have to be decoded), and only replaying the compacted chunks
+is done in order, so the time profiling takes shrinks with the number of
+processes, though not quite linearly.
+
+JSON logs are split at line boundaries. Binary logs can only be read from
+a checkpoint of their sidecar index (`pylog index`), so they're split at
+checkpoints, and profiled in one process if they haven't been indexed.
+Compressed logs (see compression) are split the same way, through their
+blocks, except for gzip files that weren't written in blocks.
+Logs with samples are profiled in one process too: expanding a sample
+depends on the sample before it."""
+import multiprocessing
+import os
+
+from six import iteritems
+
+from pylog import compression, events, logindex, logreader, mapped, stats
+
+#chunks per process, so a process that finishes early can take another one
+CHUNKS_PER_JOB = 4
+#don't split logs into chunks smaller than this
+MIN_CHUNK_BYTES = 1 << 20
+
+def split_json_log(log_path, count):
+    """count (or fewer) ("json", log_path, start offset, end offset) chunks of a JSON log, split at line boundaries.
+    Offsets in a compressed log are of its decompressed contents"""
+    offsets = [0]
+    with open(log_path, "rb") as raw_file:
+        log_file = compression.open_compressed(raw_file)
+        log_file.seek(0, os.SEEK_END)
+        size = log_file.tell()
+        for i in range(1, count):
+            #the start of the first line that starts at or after size * i / count
+            log_file.seek(max(size * i // count - 1, 0))
+            log_file.readline()
+            offset = log_file.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return [("json", log_path, start, end) for start, end in zip(offsets, offsets[1:])]
+
+def split_binary_log(log_path, count):
+    """count (or fewer) ("binary", log_path, start, event count) chunks of a binary log, split at the checkpoints of
+    its index (start: see logreader.BinaryFileEventReader.iter_raw). None if it has no up to date index"""
+    try:
+        index = logindex.LogIndex.load(logindex.index_path(log_path), log_path)
+    except (IOError, OSError, ValueError):
+        return None
+    checkpoints = len(index.checkpoint_offsets)
+    numbers = sorted(set(checkpoints * i // count for i in range(count)))
+    chunks = []
+    for number, next_number in zip(numbers, numbers[1:] + [checkpoints]):
+        _, offset, timestamp, thread_id, process_id, task_id = index.checkpoint(number * index.checkpoint_interval)
+        event_count = min(next_number * index.checkpoint_interval, len(index)) - number * index.checkpoint_interval
+        chunks.append(("binary", log_path, (offset, timestamp, index.strings, thread_id, process_id, task_id), event_count))
+    return chunks
+
+def split_log(log_path, count):
+    """Chunks of the log at log_path for iter_chunk_events. None if it can't be split"""
+    with open(log_path, "rb") as raw_file:
+        if compression.detect(raw_file.read(24)) == "gzip_stream":
+            #a gzip file that wasn't written in blocks can only be read from the start
+            return None
+        raw_file.seek(0)
+        binary = logreader.is_binary_log(compression.open_compressed(raw_file))
+    if binary:
+        return split_binary_log(log_path, count)
+    return split_json_log(log_path, count)
+
+#JSON lines of the events that don't change the stacks, as the event loggers write them, which the first pass
+#skips without parsing them. Lines written some other way are parsed, and skipped by their type
+SKIPPED_PREFIXES = tuple(
+    '{{"type": "{0}"'.format(event_type).encode("utf-8")
+    for event_type, event_class in iteritems(events.EVENT_LOOKUP)
+    if not event_class.stack_change and event_type != "sample"
+) + ('{{"type": "{0}"'.format(events.LOG_HEADER_TYPE).encode("utf-8"),)
+#the event types the first pass needs: those that change the stacks, and samples
+STACK_CHANGE_TYPES = frozenset(
+    event_type for event_type, event_class in iteritems(events.EVENT_LOOKUP) if event_class.stack_change
+) | frozenset(["sample"])
+
+def iter_chunk_events(chunk):
+    """The events of a chunk from split_log. Samples aren't expanded"""
+    log_format, log_path, start, end = chunk
+    with open(log_path, "rb") as raw_file:
+        log_file = compression.open_compressed(raw_file)
+        if log_format == "binary":
+            reader = logreader.BinaryFileEventReader(log_file, chunk_size=1 << 16)
+            count = 0
+            for raw in reader.iter_raw(start=start):
+                if count == end:
+                    return
+                count += 1
+                yield events.event_from_raw(raw)
+        else:
+            log_file.seek(start)
+            for event_data in mapped.iter_json(log_file, end):
+                if event_data["type"] != events.LOG_HEADER_TYPE:
+                    yield events.event_from_data(event_data)
+
+def iter_chunk_stack_changes(chunk):
+    """(event type, (process id, thread id, task id), (function name, file name, line number), timestamp) of the
+    events of a chunk from split_log that change the stacks, and of its samples. No Event objects are built"""
+    log_format, log_path, start, end = chunk
+    with open(log_path, "rb") as raw_file:
+        log_file = compression.open_compressed(raw_file)
+        if log_format == "binary":
+            reader = logreader.BinaryFileEventReader(log_file, chunk_size=1 << 16)
+            count = 0
+            for raw in reader.iter_raw(start=start):
+                if count == end:
+                    return
+                count += 1
+                if raw[0] in STACK_CHANGE_TYPES:
+                    yield raw[0], (raw[7], raw[6], raw[8]), (raw[4], raw[2], raw[3]), raw[1]
+        else:
+            log_file.seek(start)
+            for block in mapped.iter_blocks(log_file, end):
+                lines = [line for line in block.split(b"\n") if not line.startswith(SKIPPED_PREFIXES)]
+                for data in mapped.parse_lines(b"\n".join(lines)):
+                    if data["type"] in STACK_CHANGE_TYPES:
+                        get = data.get
+                        yield (
+                            data["type"],
+                            (get("process_id"), get("thread_id"), get("task_id")),
+                            (get("function_name"), get("file_name"), get("line_number")),
+                            events.timestamp_to_ns(get("timestamp")),
+                        )
+
+class StackCompactor(object):
+    """The events of part of a log that change the call stacks, without those that cancel out
+
+    A call followed by its return leaves the stacks as they were, and so
+    does a suspend followed by the resume of the same call (or the other way
+    around), so both are dropped. What's left, replayed into a
+    stats.CallStacks, leaves the same calls running and suspended as all of
+    the events do, whatever calls were running before them. Local calls are
+    lists: [Function.key, [(index of an opening event in kept, "call", "resume" or "miss")], index of the suspend in
+    kept, start of the current run]. A "miss" is a resume of a call suspended before these events (or before the
+    log started), which is never dropped"""
+
+    def __init__(self):
+        #stack key -> kept (event_type, key, timestamp)
+        self.kept = {}
+        #stack key -> local calls running
+        self.stacks = {}
+        #stack key + (function name, file name) -> local calls suspended, the latest last
+        self.suspended = {}
+        self.has_samples = False
+
+    def add_events(self, events):
+        for event in events:
+            if event.event_type == "sample":
+                self.has_samples = True
+            elif event.stack_change:
+                self.add(
+                    event.event_type,
+                    (event.process_id, event.thread_id, event.task_id),
+                    (event.function_name, event.file_name, event.line_number),
+                    event.timestamp,
+                )
+
+    def add(self, event_type, stack_key, key, timestamp):
+        try:
+            kept = self.kept[stack_key]
+            stack = self.stacks[stack_key]
+        except KeyError:
+            kept = self.kept[stack_key] = []
+            stack = self.stacks[stack_key] = []
+        if events.EVENT_LOOKUP[event_type].stack_change > 0:
+            calls = self.suspended.get(stack_key + key[:2]) if event_type == "resume" else None
+            if calls:
+                call = calls.pop()
+                if call[2] == len(kept) - 1:
+                    #resumed right after its suspend
+                    kept.pop()
+                    call[2] = None
+                else:
+                    kept.append((event_type, key, timestamp))
+                    call[1].append((len(kept) - 1, "resume"))
+                call[3] = timestamp
+            else:
+                kept.append((event_type, key, timestamp))
+                call = [key, [(len(kept) - 1, "miss" if event_type == "resume" else "call")], None, timestamp]
+            stack.append(call)
+            return
+        if not stack:
+            #ends a call from before these events
+            kept.append((event_type, key, timestamp))
+            return
+        call = stack.pop()
+        opening, kind = call[1][-1]
+        cancels = opening == len(kept) - 1 and kind == ("resume" if event_type == "suspend" else "call")
+        if cancels:
+            kept.pop()
+        else:
+            kept.append((event_type, key, timestamp))
+        if event_type == "suspend":
+            if cancels:
+                #suspended right after its resume: back to how it was suspended before
+                call[1].pop()
+            else:
+                call[2] = len(kept) - 1
+            self.suspended.setdefault(stack_key + call[0][:2], []).append(call)
+
+    def summary(self):
+        """(kept events by stack key, run starts of the local calls still running by stack key, whether there were
+        samples)"""
+        run_starts = dict((stack_key, [call[3] for call in stack]) for stack_key, stack in iteritems(self.stacks) if stack)
+        return self.kept, run_starts, self.has_samples
+
+def summarize_chunk(chunk):
+    """First pass: StackCompactor.summary of a chunk"""
+    compactor = StackCompactor()
+    for event_type, stack_key, key, timestamp in iter_chunk_stack_changes(chunk):
+        if event_type == "sample":
+            #the log is profiled in one process
+            compactor.has_samples = True
+            break
+        compactor.add(event_type, stack_key, key, timestamp)
+    return compactor.summary()
+
+def starting_states(summaries):
+    """The CallStacks.get_state each chunk starts with, from the summaries of all the chunks in order"""
+    stacks = stats.CallStacks()
+    states = []
+    for kept, run_starts, _ in summaries:
+        states.append(stacks.get_state())
+        for stack_key, stack_events in iteritems(kept):
+            for event_type, key, timestamp in stack_events:
+                stacks.add(event_type, stack_key, key, timestamp)
+        #runs that started with a resume that was dropped
+        for stack_key, starts in iteritems(run_starts):
+            stack = stacks.stacks[stack_key]
+            for call, start in zip(stack[len(stack) - len(starts):], starts):
+                call[4] = start
+    return states
+
+def profile_chunk(args):
+    """Second pass: (ProfileStats of a chunk, its first call's start time, the time of its last event, the
+    CallStacks.get_state it ends with if it's the last chunk, else None)
+
+    args: (chunk, state it starts with, whether it's the last chunk)"""
+    chunk, state, last = args
+    profile = stats.ProfileStats()
+    stacks = stats.ProfileStacks(profile)
+    stacks.set_state(state)
+    stacks.add_events(iter_chunk_events(chunk))
+    return profile, stacks.start_time, stacks.stop_time, stacks.get_state() if last else None
+
+def profile_stats(log_path, jobs=1, chunk_count=None):
+    """stats.ProfileStats of the log at log_path, profiled in jobs processes
+
+    chunk_count: how many chunks to split it into. Default: CHUNKS_PER_JOB per job, if they're at least
+        MIN_CHUNK_BYTES, and none with one job: the two passes take longer than profiling it in one go"""
+    if chunk_count is None:
+        chunk_count = max(min(jobs * CHUNKS_PER_JOB, os.path.getsize(log_path) // MIN_CHUNK_BYTES), 1) if jobs > 1 else 1
+    chunks = split_log(log_path, chunk_count) if chunk_count > 1 else None
+    if not chunks or len(chunks) < 2:
+        return stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        map_chunks = pool.map if pool is not None else map
+        summaries = list(map_chunks(summarize_chunk, chunks))
+        if any(has_samples for _, _, has_samples in summaries):
+            return stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+        states = starting_states(summaries)
+        last = len(chunks) - 1
+        partials = list(map_chunks(profile_chunk, [
+            (chunk, state, i == last) for i, (chunk, state) in enumerate(zip(chunks, states))
+        ]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    result = stats.ProfileStats()
+    stop_times = [stop_time for _, _, stop_time, _ in partials if stop_time is not None]
+    if not stop_times:
+        return result
+    stop_time = max(stop_times)
+    for profile, _, _, _ in partials:
+        result.merge(profile)
+    #end the calls still running at the end of the log
+    stacks = stats.ProfileStacks(result)
+    stacks.set_state(partials[-1][3])
+    stacks.finish(stop_time)
+    start_times = [start_time for _, start_time, _, _ in partials if start_time is not None]
+    result.total_time = stop_time - min(start_times) if start_times else 0
+    return result
@@ -0,0 +1,288 @@
+"""Recording programs that start other processes
+
+A ShardedRecording (`pylog record --processes`) of log_path gives every
+process its own log, a shard, at shard_path(log_path, pid). Each shard's
+header records the pid and parent pid of the process that wrote it.
+* forked children (os.fork, multiprocessing's fork start method) keep
+    recording after the fork: the parent's buffers are flushed before the
+    fork and the child switches to its own shard
+* children started with multiprocessing's spawn start method get a command
+    line that hooks multiprocessing, so they're recorded from when it starts
+    running the process (not while the interpreter starts and unpickles it)
+All the processes share the first one's clock anchor, so the timestamps of
+the shards line up. Children that end with os._exit (other than
+multiprocessing's, whose exit handlers are hooked) lose the events they
+still had buffered. The forkserver start method isn't followed.
+
+With a collector (`pylog record --processes --collector=<socket>`), each
+process sends its events to a collector.Collector, which writes the shards.
+
+merge_shards writes the events of several shards to one log, in time order,
+with the process_id of each event set from its shard's header. Analyses
+key call stacks by (process id, thread id), and the flame chart gives each
+thread of each process its own lane."""
+import atexit
+import heapq
+import importlib
+import itertools
+import json
+import os
+import sys
+
+from pylog import debugger, events, logreader
+
+ENVIRONMENT_VARIABLE = "PYLOG_SHARDS"
+#run by spawned children before multiprocessing sets up their sys.path, so pylog may not be importable yet
+SPAWN_PRELUDE = "import sys; sys.path.append({0!r}); import pylog.processes; pylog.processes.record_spawned_child(); ".format(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def shard_path(log_path, pid):
+    """Where the process pid writes its shard of a recording of log_path"""
+    return "{0}.{1}".format(log_path, pid)
+
+def find_shards(log_path):
+    """The shards of a recording of log_path, sorted by pid"""
+    prefix = shard_path(log_path, "")
+    shards = []
+    for name in os.listdir(os.path.dirname(log_path) or os.curdir):
+        path = os.path.join(os.path.dirname(log_path), name)
+        if path.startswith(prefix) and path[len(prefix):].isdigit():
+            shards.append((int(path[len(prefix):]), path))
+    return [path for _, path in sorted(shards)]
+
+#the ShardedRecording of this process, if one is running
+active_recording = None
+
+def before_fork():
+    if active_recording is not None:
+        active_recording.before_fork()
+
+def after_fork_in_parent():
+    if active_recording is not None:
+        active_recording.after_fork_in_parent()
+
+def after_fork_in_child():
+    if active_recording is not None:
+        active_recording.after_fork_in_child()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent, after_in_child=after_fork_in_child)
+    _original_fork = None
+else:
+    #python 2 has no fork hooks; os.fork is wrapped while recording
+    _original_fork = os.fork
+
+def fork():
+    before_fork()
+    pid = _original_fork()
+    if pid == 0:
+        after_fork_in_child()
+    else:
+        after_fork_in_parent()
+    return pid
+
+def patch_spawn():
+    """Make multiprocessing start spawned children with SPAWN_PRELUDE"""
+    try:
+        from multiprocessing import spawn
+    except ImportError:
+        #python 2 only forks
+        return
+    if hasattr(spawn.get_command_line, "original"):
+        return
+    original = spawn.get_command_line
+    def get_command_line(**kwargs):
+        command = original(**kwargs)
+        if "-c" in command:
+            position = command.index("-c") + 1
+            command[position] = SPAWN_PRELUDE + command[position]
+        return command
+    get_command_line.original = original
+    spawn.get_command_line = get_command_line
+
+def unpatch_spawn():
+    spawn = sys.modules.get("multiprocessing.spawn")
+    if spawn is not None and hasattr(spawn.get_command_line, "original"):
+        spawn.get_command_line = spawn.get_command_line.original
+
+def record_spawned_child():
+    """Run by SPAWN_PRELUDE: if the parent is being recorded, record the
+    child once multiprocessing starts running it"""
+    recording = ShardedRecording.from_environment()
+    if recording is None:
+        return
+    from multiprocessing import process
+    original = process.BaseProcess._bootstrap
+    def _bootstrap(self, *args, **kwargs):
+        recording.start(sys._getframe())
+        return original(self, *args, **kwargs)
+    process.BaseProcess._bootstrap = _bootstrap
+
+class ShardedRecording(object):
+    """Records a program and the processes it starts, one shard per process"""
+
+    def __init__(self, log_path, recorder_class, log_format="json", options=None, clock_anchor=None, collector=None):
+        """recorder_class: debugger.LoggingDebugger or tracer.LoggingTracer
+        options: keyword arguments for debugger.Options
+        clock_anchor: (wall_time_ns, clock_ns) to base timestamps on. Default: this process's
+        collector: the socket of a collector.Collector to send each process's events to, instead of writing
+            the shards (the collector writes them, in the binary format)"""
+        self.log_path = os.path.abspath(log_path)
+        self.recorder_class = recorder_class
+        self.log_format = log_format
+        self.options = options or {}
+        self.clock_anchor = clock_anchor or (events.WALL_ANCHOR_NS, events.CLOCK_ANCHOR_NS)
+        self.collector = collector
+        self.recorder = None
+        #the hooks of the thread that forks, put back after the fork
+        self.trace = None
+        self.profile = None
+
+    def to_data(self):
+        return {
+            "log_path": self.log_path,
+            "recorder": "{0}:{1}".format(self.recorder_class.__module__, self.recorder_class.__name__),
+            "log_format": self.log_format,
+            "options": self.options,
+            "clock_anchor": list(self.clock_anchor),
+            "collector": self.collector,
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        module_name, class_name = data["recorder"].split(":")
+        return cls(
+            log_path=data["log_path"],
+            recorder_class=getattr(importlib.import_module(module_name), class_name),
+            log_format=data["log_format"],
+            options=data["options"],
+            clock_anchor=tuple(data["clock_anchor"]),
+            collector=data.get("collector"),
+        )
+
+    @classmethod
+    def from_environment(cls):
+        """The recording a parent process passed down, None if there's none"""
+        data = os.environ.get(ENVIRONMENT_VARIABLE)
+        return cls.from_data(json.loads(data)) if data else None
+
+    def open_event_logger(self):
+        if self.collector is not None:
+            #collector imports this module
+            from pylog.collector import SocketEventLogger
+            return SocketEventLogger(self.collector)
+        return debugger.open_event_logger(shard_path(self.log_path, os.getpid()), self.log_format)
+
+    def install(self):
+        """Follow the processes this one starts"""
+        global active_recording
+        active_recording = self
+        events.use_clock_anchor(*self.clock_anchor)
+        os.environ[ENVIRONMENT_VARIABLE] = json.dumps(self.to_data())
+        patch_spawn()
+        if _original_fork is not None:
+            os.fork = fork
+
+    def uninstall(self):
+        global active_recording
+        active_recording = None
+        os.environ.pop(ENVIRONMENT_VARIABLE, None)
+        unpatch_spawn()
+        if _original_fork is not None:
+            os.fork = _original_fork
+
+    def start(self, frame):
+        """Record this process from frame on, until it exits"""
+        self.install()
+        self.recorder = self.recorder_class(self.open_event_logger(), options=debugger.Options(**self.options))
+        atexit.register(self.stop)
+        self.recorder.set_trace(frame)
+
+    def stop(self):
+        """Stop recording this process and close its shard"""
+        if self.recorder is None:
+            return
+        recorder, self.recorder = self.recorder, None
+        recorder.set_quit()
+        recorder.event_logger.close()
+        self.uninstall()
+
+    def run(self, cmd, globals=None, locals=None):
+        """Record the execution of cmd and of the processes it starts, like bdb.Bdb.run.
+        Merge the shards afterwards with merge_recording"""
+        self.install()
+        self.recorder = self.recorder_class(self.open_event_logger(), options=debugger.Options(**self.options))
+        try:
+            self.recorder.run(cmd, globals, locals)
+        finally:
+            #in a forked child that returned out of run, this closes the child's shard
+            self.recorder.event_logger.close()
+            self.recorder = None
+            self.uninstall()
+
+    def before_fork(self):
+        #nothing is left in the buffers for the child to write again, and the flush itself isn't logged
+        if self.recorder is None:
+            return
+        self.trace, self.profile = sys.gettrace(), sys.getprofile()
+        sys.settrace(None)
+        sys.setprofile(None)
+        self.recorder.flush_events()
+
+    def after_fork_in_parent(self):
+        if self.recorder is None:
+            return
+        sys.settrace(self.trace)
+        sys.setprofile(self.profile)
+
+    def after_fork_in_child(self):
+        if self.recorder is None:
+            return
+        self.recorder.set_event_logger(self.open_event_logger())
+        atexit.register(self.stop)
+        if "multiprocessing" in sys.modules:
+            #multiprocessing's children end with os._exit, after running its finalizers instead of atexit's.
+            #The finalizers registered before the child starts are cleared, so register one once it has
+            from multiprocessing import util
+            util.register_after_fork(self, ShardedRecording.stop_with_multiprocessing)
+        sys.settrace(self.trace)
+        sys.setprofile(self.profile)
+
+    def stop_with_multiprocessing(self):
+        from multiprocessing import util
+        util.Finalize(None, self.stop, exitpriority=0)
+
+def iter_shard_events(log_path):
+    """The events of a log, with their process_id set from its header if they don't have one"""
+    with open(log_path, "rb") as log_file:
+        reader = logreader.get_reader(log_file)
+        for event in reader.iter_events():
+            if event.process_id is None and reader.header:
+                event.process_id = reader.header.get("pid")
+            yield event
+
+def merge_shards(log_paths, event_logger):
+    """Log the events of several logs to event_logger, in time order
+
+    The events of each log are mostly in time order (batches of different
+    threads can be out of order), and so is the merged log"""
+    sequence = itertools.count()
+    def decorate(log_path):
+        #the sequence number keeps events from being compared
+        for event in iter_shard_events(log_path):
+            yield event.timestamp, next(sequence), event
+    for _, _, event in heapq.merge(*[decorate(log_path) for log_path in log_paths]):
+        event_logger.log_event(event)
+
+def merge_recording(log_path, log_format="json", remove_shards=True):
+    """Merge the shards of a ShardedRecording of log_path into log_path. Returns the shard paths"""
+    shards = find_shards(log_path)
+    event_logger = debugger.open_event_logger(log_path, log_format)
+    try:
+        merge_shards(shards, event_logger)
+    finally:
+        event_logger.close()
+    if remove_shards:
+        for shard in shards:
+            os.remove(shard)
+    return shards
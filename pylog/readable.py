@@ -1,12 +1,25 @@
-"""Convert default pylog output to a human-readable format"""
-import fileinput
-import json
-for line in fileinput.input():
-    event = json.loads(line)
-    print u"{time}\t{file}:{line}\t{type}\t{function}".format(
-        time=event["timestamp"],
-        file=event["file_name"],
-        line=event["line_number"],
-        type=event["type"],
-        function=event.get("function_name", ""),
+"""Convert default pylog output to a human-readable format
+
+Usage:
+  python -m pylog.readable <file>...
+
+Events are read and printed one at a time, so logs of any size work."""
+import sys
+from pylog import events, logreader
+
+def format_event(event):
+    return u"{time}\t{file}:{line}\t{type}\t{function}".format(
+        time=events.format_timestamp(event.timestamp),
+        file=event.file_name,
+        line=event.line_number,
+        type=event.event_type,
+        function=getattr(event, "function_name", ""),
     )
+
+def main():
+    for log_path in sys.argv[1:]:
+        for event in logreader.iter_log_events(log_path):
+            print(format_event(event))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
+from array import array
+import bisect
 import collections
 
+from pylog.events import EventStore
+from pylog.logindex import INDEX_TYPECODE
+
 class ImmutableStack(object):
     def __init__(self, items=None):
         self.items = tuple(items) if items else tuple()
@@ -21,65 +26,79 @@ class ImmutableStack(object):
 
 Location = collections.namedtuple("Location", ["file", "line"])
 
-class PushLocation(object):
-    def __init__(self, location):
-        self.location = location
-
-    def undo_command(self):
-        return PopLocation(self.location)
-
-    def apply(self, stack):
-        return stack.push(self.location)
-
-class PopLocation(object):
-    def __init__(self, location):
-        self.location = location
-
-    def undo_command(self):
-        return PushLocation(self.location)
-
-    def apply(self, stack):
-        return stack.pop()
+#kinds of undo records. The record's value says how to undo the step
+UNDO_PUSH = 0 #a location was pushed; pop it
+UNDO_POP = 1 #the value was popped; push it back
+UNDO_LINE = 2 #the top location was replaced; put the value back
+UNDO_NOTHING = 3 #a return with nothing on the stack
 
-class ChangeLine(object):
-    def __init__(self, old, new):
-        self.old = old
-        self.new = new
+DEFAULT_SNAPSHOT_INTERVAL = 1024
+#event types that open and close a frame
+OPENING_TYPES = ("call", "resume")
+CLOSING_TYPES = ("return", "suspend", "exception")
 
-    def undo_command(self):
-        return ChangeLine(self.new, self.old)
+class FrameIndex(object):
+    """The frame structure of a sequence of events, found in one pass
 
-    def apply(self, stack):
-        old_location = stack.top()
-        return stack.pop().push(Location(old_location.file, self.new))
+    Frames are opened and closed the way Stepper does it: calls and resumes
+    (and lines while nothing is open) open them, returns, suspends and
+    exceptions close them.
+    * matches[i]: for an event that opens a frame, the index of the event
+        that closes it, and the other way around. -1 for everything else,
+        including frames that are never closed
+    * openers[i]: the index of the event that opened the top frame after
+        event i. -1 if no frame is open"""
 
-def get_command(stack, event):
-    if event.event_type == "call":
-        return PushLocation(Location(event.file_name, event.line_number))
-    elif event.event_type in {"return", "exception"}:
-        return PopLocation(stack.top())
-    elif event.event_type == "line":
-        #if the stack is empty (i.e. lines executed before a function is ever called), push a location on
-        if not stack:
-            return PushLocation(Location(event.file_name, event.line_number))
-        return ChangeLine(stack.top().line, event.line_number)
+    def __init__(self, events):
+        self.matches = array(INDEX_TYPECODE, [-1]) * len(events)
+        self.openers = array(INDEX_TYPECODE, [-1]) * len(events)
+        open_frames = []
+        for index, event in enumerate(events):
+            event_type = event.event_type
+            if event_type in OPENING_TYPES or (event_type == "line" and not open_frames):
+                open_frames.append(index)
+            elif event_type in CLOSING_TYPES and open_frames:
+                opener = open_frames.pop()
+                self.matches[opener] = index
+                self.matches[index] = opener
+            if open_frames:
+                self.openers[index] = open_frames[-1]
 
-#class LocationStack(object):
-    #def __init__(self, locations=tuple()):
-        #self.locations = ImmutableStack(locations)
+class Stepper(object):
+    """Steps through events, keeping track of the stack of locations
 
-    #def get_command(self, event):
-        #return get_command(self.locations, event)
+    The stack is a mutable list. Each step forwards records a compact undo
+    record (a kind byte and the location it replaced, if any), so stepping
+    backwards is O(1). Every snapshot_interval events, a copy of the stack is
+    kept; jumping to any event restores the nearest snapshot and replays at
+    most snapshot_interval events. Undo records are only kept for the last
+    two intervals, so memory doesn't grow with the length of the log.
 
-    #def apply(self, command):
-        #return command.apply(self.locations)
+    step_over, step_out and step_back_over use a FrameIndex (built the first
+    time one of them is used) to jump over whole calls without replaying
+    them. Each jump keeps a snapshot of where it lands, and one of just
+    before the call returns, so stepping back after it is O(1) too."""
 
-class Stepper(object):
-    def __init__(self, events):
-        self.events = list(events)
-        self.commands = []
-        self.locations = ImmutableStack()
+    def __init__(self, events, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """events: a sequence of events (e.g. an EventStore or logindex.IndexedLog),
+            or any iterable of events"""
+        self.events = events if hasattr(events, "__getitem__") else list(events)
+        self.snapshot_interval = snapshot_interval
+        self.stack = []
         self.next_event_index = 0
+        #event index -> the stack before that event
+        self.snapshots = {}
+        #sorted keys of snapshots
+        self.snapshot_indexes = []
+        self.frame_index = None
+        self.undo_kinds = bytearray()
+        self.undo_values = []
+        #the event index the first undo record takes you back to
+        self.undo_base = 0
+
+    @property
+    def locations(self):
+        return ImmutableStack(self.stack)
 
     def at_last_step(self):
         return self.next_event_index == len(self.events)
@@ -88,40 +107,159 @@ class Stepper(object):
         return self.next_event_index == 0
 
     def step_forwards(self):
-        if not self.at_last_step():
-            command = get_command(self.locations, self.events[self.next_event_index])
-            self.commands.append(command)
-            self.locations = command.apply(self.locations)
-            self.next_event_index += 1
-
-    def step_backwards(self):
-        if not self.at_first_step():
-            last_command = self.commands.pop()
-            self.locations = last_command.undo_command().apply(self.locations)
-            self.next_event_index -= 1
+        if self.at_last_step():
+            return
+        index = self.next_event_index
+        if index % self.snapshot_interval == 0:
+            self.reached_snapshot(index)
+        event = self.events[index]
+        stack = self.stack
+        event_type = event.event_type
+        if event_type in OPENING_TYPES or (event_type == "line" and not stack):
+            #lines executed before a function is ever called get a location too
+            stack.append(Location(event.file_name, event.line_number))
+            kind, value = UNDO_PUSH, None
+        elif event_type in CLOSING_TYPES:
+            if stack:
+                kind, value = UNDO_POP, stack.pop()
+            else:
+                kind, value = UNDO_NOTHING, None
+        elif event_type == "line":
+            value = stack[-1]
+            stack[-1] = Location(value.file, event.line_number)
+            kind = UNDO_LINE
+        else:
+            kind, value = UNDO_NOTHING, None
+        self.undo_kinds.append(kind)
+        self.undo_values.append(value)
+        self.next_event_index = index + 1
+
+    def reached_snapshot(self, index):
+        """Called when stepping forwards from an event at a snapshot boundary"""
+        self.add_snapshot(index)
+        #drop the undo records from before the previous interval
+        drop = index - self.snapshot_interval - self.undo_base
+        if drop > 0:
+            del self.undo_kinds[:drop]
+            del self.undo_values[:drop]
+            self.undo_base += drop
+
+    def add_snapshot(self, index, stack=None):
+        if index not in self.snapshots:
+            self.snapshots[index] = tuple(self.stack if stack is None else stack)
+            bisect.insort(self.snapshot_indexes, index)
+
+    def step_backwards(self, count=1):
+        self.go_to(max(self.next_event_index - count, 0))
+
+    def undo(self):
+        kind = self.undo_kinds.pop()
+        value = self.undo_values.pop()
+        if kind == UNDO_PUSH:
+            self.stack.pop()
+        elif kind == UNDO_POP:
+            self.stack.append(value)
+        elif kind == UNDO_LINE:
+            self.stack[-1] = value
+        self.next_event_index -= 1
+
+    def go_to(self, event_index):
+        """Move to just before event event_index (len(events) for the end)"""
+        event_index = min(max(event_index, 0), len(self.events))
+        if self.undo_base <= event_index <= self.next_event_index:
+            while self.next_event_index > event_index:
+                self.undo()
+            return
+        position = bisect.bisect_right(self.snapshot_indexes, event_index)
+        snapshot_index = self.snapshot_indexes[position - 1] if position else 0
+        if not snapshot_index <= self.next_event_index <= event_index:
+            self.restore_snapshot(snapshot_index)
+        while self.next_event_index < event_index:
+            self.step_forwards()
+
+    def restore_snapshot(self, index):
+        self.jump(index, list(self.snapshots.get(index, ())))
+
+    def jump(self, event_index, stack):
+        """Move to event_index, where the stack is `stack`, without stepping through the events in between"""
+        self.stack = stack
+        self.next_event_index = event_index
+        del self.undo_kinds[:]
+        del self.undo_values[:]
+        self.undo_base = event_index
+        self.add_snapshot(event_index)
+
+    def jump_over_frame(self, opener, closer, outer_stack):
+        """Jump to just after closer, the event that closes the frame opener opened, with outer_stack below it"""
+        frame_index = self.get_frame_index()
+        #the frame's location before it closes has the line of its last line event
+        last_line = self.events[opener].line_number
+        index = closer - 1
+        while index > opener:
+            event = self.events[index]
+            if event.event_type in CLOSING_TYPES and frame_index.matches[index] >= 0:
+                #skip calls made from the frame
+                index = frame_index.matches[index] - 1
+            elif event.event_type == "line" and frame_index.openers[index] == opener:
+                last_line = event.line_number
+                break
+            else:
+                index -= 1
+        self.add_snapshot(closer, outer_stack + [Location(self.events[opener].file_name, last_line)])
+        self.jump(closer + 1, outer_stack)
+
+    def get_frame_index(self):
+        if self.frame_index is None:
+            self.frame_index = FrameIndex(self.events)
+        return self.frame_index
 
     def step_out(self):
-        stack_depth = len(self.locations)
-        while len(self.locations) >= stack_depth and not self.at_last_step():
+        """Step to just after the return of the current frame"""
+        if not self.at_first_step() and not self.at_last_step():
+            opener = self.get_frame_index().openers[self.next_event_index - 1]
+            closer = self.get_frame_index().matches[opener] if opener >= 0 else -1
+            if closer >= 0:
+                self.jump_over_frame(opener, closer, self.stack[:-1])
+                return
+        #the frame never returns
+        stack_depth = len(self.stack)
+        while len(self.stack) >= stack_depth and not self.at_last_step():
             self.step_forwards()
 
     def step_over(self):
-        stack_depth = len(self.locations)
+        if self.at_last_step():
+            return
+        closer = self.get_frame_index().matches[self.next_event_index]
+        if self.events[self.next_event_index].event_type in OPENING_TYPES and closer >= 0:
+            #the stack after the call returns is the same as before it
+            self.jump_over_frame(self.next_event_index, closer, self.stack)
+            return
+        stack_depth = len(self.stack)
         self.step_forwards()
         #if we stepped in, step back out
-        if stack_depth < len(self.locations):
+        if stack_depth < len(self.stack):
             self.step_out()
 
+    def step_back_over(self):
+        """Step backwards; if that goes back into a call, step back to before the call"""
+        if self.at_first_step():
+            return
+        opener = self.get_frame_index().matches[self.next_event_index - 1]
+        if self.events[self.next_event_index - 1].event_type in CLOSING_TYPES and opener >= 0:
+            self.jump(opener, self.stack)
+            return
+        self.step_backwards()
+
     def step_until_location(self, location):
-        while self.locations.top() != location and not self.at_last_step():
+        while self.stack[-1] != location and not self.at_last_step():
             self.step_forwards()
 
 if __name__ == '__main__':
-    import fileinput
-    import logreader
+    import sys
     from pprint import pprint
-    reader = logreader.JsonFileEventReader(fileinput.input())
-    stepper = Stepper(reader.iter_events())
+    from pylog import logreader
+    reader = logreader.get_reader(open(sys.argv[1], "rb"))
+    stepper = Stepper(EventStore.from_reader(reader))
     while not stepper.at_last_step():
         stepper.step_forwards()
         pprint(stepper.locations)
@@ -0,0 +1,144 @@
+"""A statistical alternative to the tracing recorders
+
+LoggingDebugger and LoggingTracer log every call, which makes some programs
+several times slower. SamplingRecorder doesn't hook into the interpreter at
+all: a background thread wakes up hz times a second, captures the stack of
+every thread with sys._current_frames() and logs it as an
+events.SampleEvent. The overhead depends on hz and the depth of the stacks,
+not on how many calls the program makes.
+
+Sampled logs use the same formats as traced ones. Readers expand the
+samples into the calls and returns they imply (events.expand_samples), so
+FunctionSet, `pylog stats` and the flame charts work on them, with times
+accurate to about one sample interval and no args, retvals or lines.
+
+Threads that were already running when sampling started (like the writer
+thread of background.BackgroundEventLogger) aren't sampled."""
+import os
+import sys
+import threading
+import time
+
+from pylog.codefilter import CodeFilter
+from pylog.debugger import Options
+from pylog.events import NS_PER_SECOND, event_from_raw, now_ns
+
+DEFAULT_SAMPLE_HZ = 100
+
+class SamplingRecorder(object):
+    """Drop-in replacement for LoggingDebugger (set_trace, set_quit, run)"""
+
+    def __init__(self, event_logger, hz=DEFAULT_SAMPLE_HZ, skip=None, options=None):
+        """hz: samples per second
+        skip, options: like debugger.EventRecorder's. Frames of code that
+            wouldn't be logged are left out of the stacks"""
+        if hz <= 0:
+            raise ValueError("The sampling rate must be positive")
+        self.event_logger = event_logger
+        self.hz = hz
+        self.interval = int(NS_PER_SECOND / hz)
+        self.options = options or Options()
+        self.code_filter = CodeFilter(self.options, skip)
+        self.log_raw = getattr(event_logger, "log_raw", None)
+        #co_filename -> absolute path
+        self.file_names = {}
+        #thread id -> the frame stacks stop at (exclusive), e.g. run's own frame
+        self.base_frames = {}
+        self.ignored_threads = set()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def get_file_name(self, code):
+        try:
+            return self.file_names[code.co_filename]
+        except KeyError:
+            file_name = self.file_names[code.co_filename] = os.path.abspath(code.co_filename)
+            return file_name
+
+    def get_stack(self, frame, base_frame=None):
+        """(function_name, file_name, first line) for each logged frame, outermost first"""
+        stack = []
+        while frame is not None and frame is not base_frame:
+            if self.code_filter.decide(frame).trace:
+                code = frame.f_code
+                stack.append((code.co_name, self.get_file_name(code), code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def sample(self):
+        """Log the stacks of all the sampled threads"""
+        timestamp = now_ns()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in self.ignored_threads:
+                continue
+            stack = self.get_stack(frame, self.base_frames.get(thread_id))
+            if not stack:
+                continue
+            raw = ("sample", timestamp, self.get_file_name(frame.f_code), frame.f_lineno, None,
+                   (self.interval, stack), thread_id)
+            if self.log_raw is not None:
+                self.log_raw(raw)
+            else:
+                self.event_logger.log_event(event_from_raw(raw))
+
+    def sample_loop(self):
+        self.ignored_threads.add(threading.current_thread().ident)
+        period = 1.0 / self.hz
+        next_time = time.time()
+        while True:
+            next_time += period
+            if self.stopping.wait(max(next_time - time.time(), 0)):
+                return
+            self.sample()
+
+    def start(self, base_frame=None):
+        """Start sampling in a background thread
+
+        base_frame: stacks of the calling thread stop before this frame"""
+        if self.thread is not None:
+            return
+        current_thread_id = threading.current_thread().ident
+        self.base_frames[current_thread_id] = base_frame
+        self.ignored_threads = set(sys._current_frames()) - set([current_thread_id])
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sample_loop, name="pylog-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def flush_events(self):
+        flush = getattr(self.event_logger, "flush", None)
+        if flush is not None:
+            flush()
+
+    def set_trace(self, frame=None):
+        """Start sampling. Stacks of the calling thread stop at the caller of frame (default: the caller's frame)"""
+        if frame is None:
+            frame = sys._getframe().f_back
+        self.start(frame.f_back)
+
+    def set_quit(self):
+        """Stop sampling"""
+        self.stop()
+        self.flush_events()
+
+    def run(self, cmd, globals=None, locals=None):
+        """Sample the execution of cmd, like bdb.Bdb.run"""
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.start(sys._getframe())
+        try:
+            exec(cmd, globals, locals)
+        finally:
+            self.stop()
+            self.flush_events()
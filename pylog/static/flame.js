@@ -194,18 +194,68 @@ var CallTreeNode = React.createClass({
 
 
 //d3 visualization for flame chart
+//Only the calls visible at the current zoom level are loaded. Zooming in
+//fetches the calls in the new time window from the server.
+//Each thread (of each process, in merged logs) gets its own lane, labelled
+//when there's more than one.
 var flameChart;
+function flameUrl(start, end, width){
+    var url = "/flame.json?width=" + Math.round(width);
+    if(start !== null){
+        url += "&start=" + start + "&end=" + end;
+    }
+    return url;
+}
+function laneKey(d){
+    return d.process_id + "/" + d.thread_id;
+}
+function laneLabel(d){
+    var label = "thread " + d.thread_id;
+    return d.process_id !== null && d.process_id !== undefined ? "process " + d.process_id + " " + label : label;
+}
+function callKey(call){
+    return call.id !== null ? call.id : "merged-" + call.first_id;
+}
 function FlameChart(data, containerSelector){
     //maps a call's filename to the class that should be put on that call
     var filenameClasses = {};
     var funcnameClasses = {};
+    var callsById = {};
+    function indexCalls(){
+        callsById = {};
+        data.calls.forEach(function(call){
+            if(call.id !== null){
+                callsById[call.id] = call;
+            }
+        });
+    }
     function getCall(id){
-        return data.calls[id-1];
+        return callsById[id];
     }
+    //laneKey -> row of the lane's first depth
+    var laneRows = {};
+    var totalRows = 0;
+    function layoutLanes(){
+        var lanes = data.lanes || [];
+        var labelled = lanes.length > 1;
+        laneRows = {};
+        totalRows = 0;
+        lanes.forEach(function(lane){
+            if(labelled){
+                totalRows += 1;
+            }
+            laneRows[laneKey(lane)] = totalRows;
+            totalRows += lane.depths;
+        });
+    }
+    function row(call){
+        return (laneRows[laneKey(call)] || 0) + call.depth;
+    }
+    //the call and those of its callers that are loaded
     function ancestors(call){
         result = [call];
         cur_call = call;
-        while(cur_call.parent_id !== null){
+        while(cur_call.parent_id !== null && getCall(cur_call.parent_id)){
             cur_call = getCall(cur_call.parent_id);
             result.push(cur_call);
         }
@@ -215,28 +265,60 @@ function FlameChart(data, containerSelector){
         .domain([0, data.total_seconds])
         .range([0, WIDTH]);
     var calls;
+    //pylog-web --follow: the chart shows the window of recent calls until the user zooms
+    var following = data.live;
+    if(following){
+        time.domain([data.window_start, data.total_seconds]);
+    }
     function zoomToCall(call){
-        time.domain([call.call_time, call.ret_time]);
+        zoomTo(call.call_time, call.ret_time);
+    }
+    function zoomTo(start, end){
+        following = false;
+        time.domain([start, end]);
         draw();
+        d3.json(flameUrl(start, end, $(containerSelector).width()), function(error, json){
+            if(error){console.error(error); return;}
+            data.calls = json.calls;
+            draw();
+        });
+    }
+    function drawLaneLabels(){
+        var lanes = (data.lanes || []).length > 1 ? data.lanes : [];
+        var labels = d3.select(containerSelector).selectAll(".lane-label")
+            .data(lanes, laneKey);
+        labels.exit().remove();
+        labels.enter().append("text")
+            .attr("class", "lane-label");
+        labels.attr("x", 0)
+            .attr("y", function(d){return laneRows[laneKey(d)] * 40 - 10;})
+            .text(laneLabel);
     }
     function draw(){
+        indexCalls();
         time.range([0, $(containerSelector).width()]);
+        d3.select(containerSelector).style("height", Math.max(500, totalRows * 40) + "px");
+        drawLaneLabels();
         calls = d3.select(containerSelector).selectAll(".call")
-            .data(data.calls);
+            .data(data.calls, callKey);
 
+        calls.exit().remove();
         calls.enter().append("rect")
             .attr("data-retval", function(d){return d.retval;})
             .attr("height", 30)
         calls.transition()
             .attr("x", function(d){return time(d.call_time)})
             .attr("width", function(d){result = time(d.ret_time) - time(d.call_time); return (result > 0)? result: 0;})
-            .attr("y", function(d){return d.depth * 40});
+            .attr("y", function(d){return row(d) * 40});
 
         calls.attr("class", function(d){
                 var cls = "call ";
                 cls += filenameClasses[d.file_name] || "";
                 cls += " ";
                 cls += funcnameClasses[d.name] || "";
+                if(d.id === null){
+                    cls += " merged";
+                }
                 if(d.hovered){
                     cls += " hovered";
                 }
@@ -262,16 +344,34 @@ function FlameChart(data, containerSelector){
 
         });
         calls.on("click", function(d){
-            time.domain([d.call_time, d.ret_time]);
-            draw();
+            zoomToCall(d);
         });
     }
+    //a delta from /events: the calls that just ended, and the calls still running.
+    //replace: drop the calls already loaded, e.g. for a new snapshot of the chart
+    function update(delta, replace){
+        var kept = replace ? [] : data.calls.filter(function(call){
+            return !call.open && call.ret_time >= delta.window_start;
+        });
+        data.calls = kept.concat(delta.calls, delta.open);
+        data.lanes = delta.lanes;
+        data.total_seconds = delta.total_seconds;
+        data.window_start = delta.window_start;
+        if(following){
+            time.domain([delta.window_start, delta.total_seconds]);
+        }
+        layoutLanes();
+        draw();
+    }
+    layoutLanes();
     draw();
     return {
         filenameClasses: filenameClasses,
         funcnameClasses: funcnameClasses,
         calls: calls,
-        zoomToCall: zoomToCall
+        zoomToCall: zoomToCall,
+        zoomTo: zoomTo,
+        update: update
     };
 }
 //calls: vector of calls. Each call is a hashmap.
@@ -315,14 +415,76 @@ function ExecutionTree(calls){
   }
   return self;
 }
+//d3 visualization of calls merged by call path (from /callpaths.json).
+//Each node's width is its share of its parent's inclusive time.
+function FlameGraph(root, containerSelector){
+    var nodes = [];
+    function layout(node, depth, x, width){
+        nodes.push({node: node, depth: depth, x: x, width: width});
+        var childX = x;
+        node.children.forEach(function(child){
+            var childWidth = node.inclusive > 0 ? width * child.inclusive / node.inclusive : 0;
+            layout(child, depth + 1, childX, childWidth);
+            childX += childWidth;
+        });
+    }
+    function draw(){
+        nodes = [];
+        layout(root, 0, 0, $(containerSelector).width());
+        var rects = d3.select(containerSelector).attr("height", d3.max(nodes, function(d){return d.depth + 1;}) * 20)
+            .selectAll(".path").data(nodes);
+        rects.enter().append("rect")
+            .attr("class", "call path")
+            .attr("height", 18)
+            .append("title");
+        rects.attr("x", function(d){return d.x;})
+            .attr("y", function(d){return d.depth * 20;})
+            .attr("width", function(d){return d.width;});
+        rects.select("title").text(function(d){
+            return d.node.name + " (" + d.node.file_name + ":" + d.node.line_number + ") " +
+                d.node.calls + " calls, " + d.node.inclusive.toFixed(6) + "s";
+        });
+    }
+    draw();
+    return {draw: draw};
+}
+//pylog-web --follow pushes deltas as Server-Sent Events. A "reset" means
+//this page fell too far behind, so it loads the chart again
+function followLog(sequence){
+    var source = new EventSource("/events?after=" + sequence);
+    source.addEventListener("delta", function(e){
+        flameChart.update(JSON.parse(e.data));
+    });
+    source.addEventListener("reset", function(){
+        source.close();
+        d3.json(flameUrl(null, null, $("#fc").width()), function(error, json){
+            if(error){console.error(error); return;}
+            flameChart.update({calls: json.calls, open: [], lanes: json.lanes, total_seconds: json.total_seconds,
+                               window_start: json.window_start}, true);
+            followLog(json.sequence);
+        });
+    });
+}
+var flameGraph;
 var onLoad = function(){
     $('.nav-tabs a').click(function (e) {
         e.preventDefault();
         $(this).tab('show');
     });
-    d3.json("/flame.json", function(error, json){
+    $('#flame-graph-tab').on('shown.bs.tab', function(){
+        if(!flameGraph){
+            d3.json("/callpaths.json", function(error, json){
+                if(error){console.error(error); return;}
+                flameGraph = FlameGraph(json, "#fg");
+            });
+        }
+    });
+    d3.json(flameUrl(null, null, $("#fc").width()), function(error, json){
         if(error){console.error(error);}
         flameChart = FlameChart(json, "#fc");
+        if(json.live){
+            followLog(json.sequence);
+        }
         var etree = ExecutionTree(mori.toClj(json.calls))
         React.render(
           React.createElement(FilterableFunctionCallList, {calls: json.calls}),
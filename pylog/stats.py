@@ -0,0 +1,405 @@
+"""Per-function profile statistics for a log
+
+ProfileStats is built in one pass over the events. For every function
+(keyed by Function.key: name, file name, line number) it has the call
+count, inclusive and exclusive time and the distribution of call durations,
+and for every caller -> callee edge the call count and time.
+
+Like cProfile, inclusive time only counts the outermost call when a
+function is recursive, and "primitive" calls are the calls that aren't
+recursive. Each thread (of each process) has its own call stack. Calls that haven't returned
+by the end of the log are ended at the last event.
+
+Each asyncio task gets its own call stack too, on which a coroutine stays
+one call from its call to its return however many times it's suspended
+and resumed. Its inclusive time is that wall time; its active time leaves
+out the time it spent suspended, so a coroutine with a lot more inclusive
+than active time is one that's waiting on slow awaits. Exclusive times
+only count the time functions are running.
+
+Stats can be printed as a table (`pylog stats <log>`), written as JSON, or
+saved in the format of the standard library's pstats module, so tools that
+read cProfile output (pstats, snakeviz, gprof2dot...) can read pylog logs."""
+import json
+import marshal
+
+from six import iteritems, itervalues
+
+from pylog.events import EVENT_LOOKUP, NS_PER_SECOND
+
+PERCENTILES = (50, 90, 99)
+SORT_KEYS = ("calls", "inclusive", "active", "exclusive", "max", "name")
+
+def duration_bucket(duration):
+    """Histogram bucket of a duration in ns. Durations under 16ns get their
+    own bucket; above that, each power of two is split into 8 buckets, so a
+    bucket is at most 12.5% wide"""
+    if duration < 16:
+        return max(duration, 0)
+    shift = duration.bit_length() - 4
+    return 16 + (shift - 1) * 8 + (duration >> shift) - 8
+
+def bucket_bounds(bucket):
+    """[low, high) durations of a duration_bucket"""
+    if bucket < 16:
+        return bucket, bucket + 1
+    shift = (bucket - 16) // 8 + 1
+    top = (bucket - 16) % 8 + 8
+    return top << shift, (top + 1) << shift
+
+class CallStats(object):
+    """Counts and times (in ns) of the calls to a function, or along an edge"""
+
+    def __init__(self):
+        self.count = 0
+        #calls that weren't made while the function was already running
+        self.primitive_count = 0
+        self.inclusive = 0
+        #inclusive time, without the time calls spent suspended
+        self.active = 0
+        self.exclusive = 0
+
+    def add(self, duration, exclusive, recursive, active=None):
+        """active: the part of duration the call wasn't suspended. Default: all of it"""
+        self.count += 1
+        self.exclusive += exclusive
+        if not recursive:
+            self.primitive_count += 1
+            self.inclusive += duration
+            self.active += duration if active is None else active
+
+    def merge(self, other):
+        self.count += other.count
+        self.primitive_count += other.primitive_count
+        self.inclusive += other.inclusive
+        self.active += other.active
+        self.exclusive += other.exclusive
+
+    def to_data(self):
+        return {
+            "calls": self.count,
+            "primitive_calls": self.primitive_count,
+            "inclusive": float(self.inclusive) / NS_PER_SECOND,
+            "active": float(self.active) / NS_PER_SECOND,
+            "exclusive": float(self.exclusive) / NS_PER_SECOND,
+        }
+
+class FunctionStats(CallStats):
+    """CallStats plus the distribution of call durations"""
+
+    def __init__(self):
+        super(FunctionStats, self).__init__()
+        self.min = None
+        self.max = None
+        #duration_bucket -> count
+        self.histogram = {}
+
+    def add(self, duration, exclusive, recursive, active=None):
+        super(FunctionStats, self).add(duration, exclusive, recursive, active)
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        bucket = duration_bucket(duration)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        super(FunctionStats, self).merge(other)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        for bucket, count in iteritems(other.histogram):
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def percentile(self, percent):
+        """Approximate duration (in ns) that percent% of calls don't exceed"""
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= wanted:
+                low, high = bucket_bounds(bucket)
+                return min(max((low + high - 1) // 2, self.min), self.max)
+        return self.max
+
+    def to_data(self):
+        result = super(FunctionStats, self).to_data()
+        result["min"] = float(self.min) / NS_PER_SECOND
+        result["max"] = float(self.max) / NS_PER_SECOND
+        for percent in PERCENTILES:
+            result["p{0}".format(percent)] = float(self.percentile(percent)) / NS_PER_SECOND
+        return result
+
+class CallStacks(object):
+    """The calls running at a point of a log, with a call stack per (process id, thread id, asyncio task id)
+
+    add() is given the events that change the stacks, in log order. A
+    generator or coroutine call leaves its stack when it's suspended and is
+    put back when it's resumed, so it stays one call. Each call is a list:
+    [Function.key, the caller's key (None at the bottom of a stack), whether
+    it's recursive, start time, start of its current run]
+
+    Subclasses hear about calls starting, stopping (returning or being
+    suspended) and ending through the started, stopped and ended methods."""
+
+    def __init__(self):
+        #stack key -> running calls
+        self.stacks = {}
+        #stack key -> {key -> number of running calls}, to spot recursion
+        self.running = {}
+        #stack key + (function name, file name) -> suspended calls, the latest last. Resumes happen at the line
+        #of the yield or await, so their line number doesn't match the call's
+        self.suspended = {}
+
+    def get_state(self):
+        """A copy of the running and suspended calls, for set_state"""
+        return (
+            dict((stack_key, [list(call) for call in stack]) for stack_key, stack in iteritems(self.stacks)),
+            dict((suspend_key, [list(call) for call in calls]) for suspend_key, calls in iteritems(self.suspended)),
+        )
+
+    def set_state(self, state):
+        """Carry on from a state get_state returned, e.g. from another part of the same log"""
+        stacks, suspended = state
+        self.stacks = dict((stack_key, [list(call) for call in stack]) for stack_key, stack in iteritems(stacks))
+        self.suspended = dict((suspend_key, [list(call) for call in calls]) for suspend_key, calls in iteritems(suspended))
+        self.running = {}
+        for stack_key, stack in iteritems(self.stacks):
+            running = self.running[stack_key] = {}
+            for call in stack:
+                running[call[0]] = running.get(call[0], 0) + 1
+
+    def add(self, event_type, stack_key, key, timestamp):
+        """event_type: the type of an event that changes the stack (call, resume, return, suspend or exception)
+        key: its (function name, file name, line number)"""
+        try:
+            stack = self.stacks[stack_key]
+        except KeyError:
+            stack = self.stacks[stack_key] = []
+            self.running[stack_key] = {}
+        running = self.running[stack_key]
+        if EVENT_LOOKUP[event_type].stack_change > 0:
+            calls = self.suspended.get(stack_key + key[:2]) if event_type == "resume" else None
+            if calls:
+                call = calls.pop()
+                call[4] = timestamp
+            else:
+                #resumes of calls suspended before the log started are new calls
+                call = [key, stack[-1][0] if stack else None, running.get(key, 0) > 0, timestamp, timestamp]
+                self.started(call)
+            stack.append(call)
+            running[call[0]] = running.get(call[0], 0) + 1
+        elif stack:
+            call = stack.pop()
+            running[call[0]] -= 1
+            self.stopped(call, stack[-1] if stack else None, timestamp)
+            if event_type == "suspend":
+                self.suspended.setdefault(stack_key + call[0][:2], []).append(call)
+            else:
+                self.ended(call, timestamp)
+
+    def finish(self, timestamp):
+        """End the calls still running or suspended at timestamp"""
+        for stack_key, stack in iteritems(self.stacks):
+            running = self.running[stack_key]
+            while stack:
+                call = stack.pop()
+                running[call[0]] -= 1
+                self.stopped(call, stack[-1] if stack else None, timestamp)
+                self.ended(call, timestamp)
+        for calls in itervalues(self.suspended):
+            while calls:
+                self.ended(calls.pop(), timestamp)
+
+    def started(self, call):
+        pass
+
+    def stopped(self, call, running_call, timestamp):
+        """call returned or was suspended at timestamp. running_call: the call it ran in, if any"""
+        pass
+
+    def ended(self, call, timestamp):
+        pass
+
+class ProfileStacks(CallStacks):
+    """CallStacks that add the calls to a ProfileStats"""
+
+    def __init__(self, profile):
+        super(ProfileStacks, self).__init__()
+        self.profile = profile
+        #the first call and the last event seen. Threads' events may not be in time order
+        self.start_time = None
+        self.stop_time = None
+
+    def add_events(self, events):
+        for event in events:
+            timestamp = event.timestamp
+            if self.stop_time is None or timestamp > self.stop_time:
+                self.stop_time = timestamp
+            if event.stack_change:
+                self.add(
+                    event.event_type,
+                    (event.process_id, event.thread_id, event.task_id),
+                    (event.function_name, event.file_name, event.line_number),
+                    timestamp,
+                )
+
+    def started(self, call):
+        if self.start_time is None or call[3] < self.start_time:
+            self.start_time = call[3]
+
+    def stopped(self, call, running_call, timestamp):
+        self.profile.add_run(call, running_call, timestamp - call[4])
+
+    def ended(self, call, timestamp):
+        self.profile.end_call(call, timestamp)
+
+class ProfileStats(object):
+    def __init__(self):
+        #Function.key -> FunctionStats
+        self.functions = {}
+        #(caller key, callee key) -> CallStats
+        self.edges = {}
+        #time from the first call to the last return, in ns
+        self.total_time = 0
+
+    @classmethod
+    def from_events(cls, events):
+        result = cls()
+        stacks = ProfileStacks(result)
+        stacks.add_events(events)
+        if stacks.stop_time is not None:
+            stacks.finish(stacks.stop_time)
+        if stacks.start_time is not None:
+            result.total_time = stacks.stop_time - stacks.start_time
+        return result
+
+    def get_function(self, key):
+        try:
+            return self.functions[key]
+        except KeyError:
+            function = self.functions[key] = FunctionStats()
+            return function
+
+    def get_edge(self, caller, callee):
+        try:
+            return self.edges[caller, callee]
+        except KeyError:
+            edge = self.edges[caller, callee] = CallStats()
+            return edge
+
+    def add_run(self, call, running_call, run_time):
+        """Add the time a CallStacks call ran before returning or being suspended. It's exclusive time of the
+        call, and not of running_call, the call it ran in"""
+        key, caller, recursive = call[:3]
+        function = self.get_function(key)
+        function.exclusive += run_time
+        if not recursive:
+            function.active += run_time
+        if caller is not None:
+            edge = self.get_edge(caller, key)
+            edge.exclusive += run_time
+            if not recursive:
+                edge.active += run_time
+        if running_call is not None:
+            self.get_function(running_call[0]).exclusive -= run_time
+            if running_call[1] is not None:
+                self.get_edge(running_call[1], running_call[0]).exclusive -= run_time
+
+    def end_call(self, call, timestamp):
+        """Add a CallStacks call that ended at timestamp. Its exclusive and active time were added by add_run"""
+        key, caller, recursive, start = call[:4]
+        duration = timestamp - start
+        self.get_function(key).add(duration, 0, recursive, 0)
+        if caller is not None:
+            self.get_edge(caller, key).add(duration, 0, recursive, 0)
+
+    def merge(self, other):
+        """Add the stats of another log (or part of one) to these"""
+        for key, function in iteritems(other.functions):
+            self.functions.setdefault(key, FunctionStats()).merge(function)
+        for key, edge in iteritems(other.edges):
+            self.edges.setdefault(key, CallStats()).merge(edge)
+        self.total_time += other.total_time
+
+    def sorted_functions(self, sort="inclusive"):
+        """(key, FunctionStats) pairs, most expensive first"""
+        if sort not in SORT_KEYS:
+            raise ValueError("Unknown sort key: {0}".format(sort))
+        if sort == "name":
+            return sorted(iteritems(self.functions), key=lambda item: tuple(str(part) for part in item[0]))
+        attribute = "count" if sort == "calls" else sort
+        return sorted(iteritems(self.functions), key=lambda item: getattr(item[1], attribute), reverse=True)
+
+    def to_data(self, sort="inclusive"):
+        functions = []
+        for (name, file_name, line_number), function in self.sorted_functions(sort):
+            data = function.to_data()
+            data.update(name=name, file_name=file_name, line_number=line_number)
+            functions.append(data)
+        edges = []
+        for (caller, callee), edge in iteritems(self.edges):
+            data = edge.to_data()
+            data.update(caller=list(caller), callee=list(callee))
+            edges.append(data)
+        return {
+            "total_time": float(self.total_time) / NS_PER_SECOND,
+            "functions": functions,
+            "edges": edges,
+        }
+
+    def to_json(self, sort="inclusive"):
+        return json.dumps(self.to_data(sort), indent=2)
+
+    def format_table(self, sort="inclusive", limit=None):
+        """A text table like the one cProfile prints. Times are in seconds"""
+        header = "{0:>12}{1:>12}{2:>12}{3:>12}{4:>12}{5:>12}{6:>12}  {7}".format(
+            "ncalls", "inclusive", "active", "exclusive", "p50", "p99", "max", "function")
+        row = ("{calls:>12}{inclusive:>12.6f}{active:>12.6f}{exclusive:>12.6f}"
+               "{p50:>12.6f}{p99:>12.6f}{max:>12.6f}  {function}")
+        lines = [
+            "{0} functions, {1} calls in {2:.6f} seconds".format(
+                len(self.functions),
+                sum(function.count for function in itervalues(self.functions)),
+                float(self.total_time) / NS_PER_SECOND,
+            ),
+            "",
+            header,
+        ]
+        for (name, file_name, line_number), function in self.sorted_functions(sort)[:limit]:
+            data = function.to_data()
+            if function.primitive_count != function.count:
+                data["calls"] = "{0}/{1}".format(function.count, function.primitive_count)
+            data["function"] = "{0}:{1}({2})".format(file_name, line_number, name)
+            lines.append(row.format(**data))
+        return "\n".join(lines)
+
+    def to_pstats(self):
+        """The stats in the layout pstats.Stats loads:
+        {(file, line, name): (primitive calls, calls, exclusive, inclusive, callers)}
+        where callers maps each caller to the same tuple for just the calls it made"""
+        def pstats_key(key):
+            name, file_name, line_number = key
+            return (file_name or "~", line_number or 0, name or "")
+        def pstats_tuple(stats):
+            return (
+                stats.primitive_count,
+                stats.count,
+                float(stats.exclusive) / NS_PER_SECOND,
+                float(stats.inclusive) / NS_PER_SECOND,
+            )
+        callers = dict((pstats_key(key), {}) for key in self.functions)
+        for (caller, callee), edge in iteritems(self.edges):
+            callers[pstats_key(callee)][pstats_key(caller)] = pstats_tuple(edge)
+        return dict(
+            (pstats_key(key), pstats_tuple(function) + (callers[pstats_key(key)],))
+            for key, function in iteritems(self.functions)
+        )
+
+    def dump_pstats(self, path):
+        """Write a file pstats.Stats(path) can load"""
+        with open(path, "wb") as pstats_file:
+            marshal.dump(self.to_pstats(), pstats_file)
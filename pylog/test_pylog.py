@@ -1,7 +1,23 @@
 import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import pstats
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import timeit
 import unittest
 
-from pylog import events
+import bottle
+import six
+
+from pylog import events, debugger, tracer, codefilter, background, logreader, replay, logindex, flameindex, webviewer, stats, callpaths, sampler, processes, parallel, live, collector, compression, mapped
+from pylog.events import datetime_to_ns
 
 EVENT_LISTS = { 
     "1": [
@@ -40,11 +56,13 @@ class TestEventSerialization(unittest.TestCase):
         **events["function"]
     )
     events["exception"] = dict(**events["function"])
+    events["resume"] = dict(task_id=5, **events["call"])
+    events["suspend"] = dict(task_id=5, **events["return"])
     for event_type, event in events.items():
         event["type"] = event_type
 
     expected_attrs = {
-        "timestamp": datetime.datetime(
+        "timestamp": datetime_to_ns(datetime.datetime(
             year=1989,
             month=3,
             day=11,
@@ -52,7 +70,7 @@ class TestEventSerialization(unittest.TestCase):
             minute=30,
             second=1,
             microsecond=234567,
-        ),
+        )),
         "file_name": "my_file.py",
         "line_number": 7,
         "function_name": "some_func",
@@ -70,7 +88,9 @@ class TestEventSerialization(unittest.TestCase):
             if hasattr(evt, attr):
                 self.assertEqual(getattr(evt, attr), expected_val)
         back_to_data = evt.to_data()
-        self.assertEqual(evt_data, back_to_data)
+        self.assertEqual(dict(evt_data, timestamp=self.expected_attrs["timestamp"]), back_to_data)
+        #timestamps are written as integer nanoseconds
+        self.assertEqual(events.event_from_data(back_to_data).to_data(), back_to_data)
 
     def test_event(self):
         self._test_serialization("event")
@@ -87,6 +107,52 @@ class TestEventSerialization(unittest.TestCase):
     def test_exception(self):
         self._test_serialization("exception")
 
+    def test_resume(self):
+        self._test_serialization("resume")
+
+    def test_suspend(self):
+        self._test_serialization("suspend")
+
+    def test_parse_timestamp(self):
+        for timestamp in ("1989-03-11T13:30:01.234567", "2015-01-20T00:00:00.000000", "1969-12-31T23:59:59.999999"):
+            self.assertEqual(
+                events.parse_timestamp(timestamp),
+                events.datetime_to_ns(datetime.datetime.strptime(timestamp, events.TIME_FORMAT)),
+            )
+            self.assertEqual(events.format_timestamp(events.parse_timestamp(timestamp)), timestamp)
+
+    def test_now(self):
+        self.assertTrue(events.now_ns() <= events.Event().timestamp <= events.now_ns())
+        self.assertTrue(abs(events.now_ns() - events.datetime_to_ns(datetime.datetime.now())) < 10 * events.NS_PER_SECOND)
+
+    def test_decoders(self):
+        sample = dict(self.events["event"], type="sample", interval=5, stack=[["main", "a.py", 1]], thread_id=3)
+        for evt_data in list(self.events.values()) + [sample]:
+            for data in (evt_data, events.EVENT_LOOKUP[evt_data["type"]].from_data(evt_data).to_data()):
+                expected = events.EVENT_LOOKUP[data["type"]].from_data(data)
+                evt = events.event_from_data(data)
+                self.assertTrue(type(evt) is type(expected))
+                self.assertEqual(vars(evt), vars(expected))
+        for evt_data in self.events.values():
+            evt = events.event_from_data(evt_data)
+            raw = [evt.event_type, evt.timestamp, evt.file_name, evt.line_number, getattr(evt, "function_name", None),
+                   getattr(evt, "args", getattr(evt, "retval", None)), 1, None, evt.task_id]
+            self.assertEqual(vars(events.event_from_raw(raw)), dict(vars(evt), thread_id=1))
+            self.assertEqual(vars(events.event_from_raw(raw[:6])), vars(evt) if evt.task_id is None else dict(vars(evt), task_id=None))
+
+    def test_decoder_speed(self):
+        datas = [evt.to_data() for evt in make_wide_tree(1000)]
+        def from_data():
+            for data in datas:
+                events.EVENT_LOOKUP[data["type"]].from_data(data)
+        def decoders():
+            for data in datas:
+                events.event_from_data(data)
+        slow = min(timeit.repeat(from_data, number=1, repeat=5))
+        fast = min(timeit.repeat(decoders, number=1, repeat=5))
+        #about 3.5 times as fast, but leave room for noisy machines
+        self.assertTrue(fast * 2 < slow, "decoders took {0:.4f}s, from_data {1:.4f}s".format(fast, slow))
+
 
 class TestFunction(unittest.TestCase):
     """Tests events.Function"""
@@ -184,6 +250,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'main',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 1,
                     'call_time': 0.0
                 }, {
@@ -194,6 +262,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'somefunc',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 2,
                     'call_time': 3.0
                 }, {
@@ -204,6 +274,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'func3',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 3,
                     'call_time': 4.001
                 }, {
@@ -214,6 +286,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'someotherfunc',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 4,
                     'call_time': 3600.0
                 }
@@ -231,6 +305,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'main',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 1,
                     'call_time': 0.0
                 }, {
@@ -241,6 +317,8 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'somefunc',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 2,
                     'call_time': 3.0
                 }, {
@@ -251,11 +329,1501 @@ class TestFunctionSet(unittest.TestCase):
                     'name': 'someotherfunc',
                     'args': None,
                     'retval': None,
+                    'thread_id': None,
+                    'process_id': None,
                     'id': 3,
                     'call_time': 3600.0
                 }
             ]
         })
 
+class ListEventLogger(object):
+    """Keeps logged events in memory"""
+    def __init__(self):
+        self.events = []
+
+    def log_event(self, event):
+        self.events.append(event)
+
+def recorded_function(n):
+    if n < 2:
+        return n
+    return recorded_function(n - 1) + recorded_function(n - 2)
+
+def record_fib():
+    return recorded_function(4)
+
+def record(recorder_class, options, function=record_fib, wrap_logger=None):
+    """wrap_logger: optionally wraps the ListEventLogger in another logger"""
+    event_logger = ListEventLogger()
+    recorder = recorder_class(wrap_logger(event_logger) if wrap_logger else event_logger, options=options)
+    recorder.set_trace()
+    function()
+    recorder.set_quit()
+    return [
+        (evt.event_type, getattr(evt, "function_name", None), evt.line_number, getattr(evt, "retval", None))
+        for evt in event_logger.events
+        if evt.file_name == os.path.abspath(recorded_function.__code__.co_filename)
+    ]
+
+class TestLoggingTracer(unittest.TestCase):
+    """tracer.LoggingTracer should log the same events as debugger.LoggingDebugger"""
+
+    def _test_same_events(self, function=record_fib, **options):
+        options = debugger.Options(log_retval=True, **options)
+        expected = record(debugger.LoggingDebugger, options, function)
+        actual = record(tracer.LoggingTracer, options, function)
+        self.assertTrue(expected)
+        self.assertEqual(actual, expected)
+
+    def test_calls_only(self):
+        self._test_same_events()
+
+    def test_lines(self):
+        self._test_same_events(log_lines=True)
+
+    def test_explicit_only(self):
+        self._test_same_events(explicitly_logged, log_lines=True, explicit_only=True)
+
+@debugger.log_function
+def explicitly_logged():
+    return recorded_function(2)
+
+class FakeFrame(object):
+    def __init__(self, function):
+        self.f_code = function.__code__
+        self.f_globals = function.__globals__
+
+class TestCodeFilter(unittest.TestCase):
+    """tests codefilter.CodeFilter"""
+
+    def test_decision_is_cached(self):
+        code_filter = codefilter.CodeFilter(debugger.Options(log_lines=True))
+        decision = code_filter.decide(FakeFrame(recorded_function))
+        self.assertEqual(decision, codefilter.FilterDecision(trace=True, log_lines=True, log_args=False))
+        code_filter.make_decision = None
+        self.assertTrue(code_filter.decide(FakeFrame(recorded_function)) is decision)
+
+    def test_explicit_only(self):
+        code_filter = codefilter.CodeFilter(debugger.Options(explicit_only=True))
+        self.assertTrue(code_filter.decide(FakeFrame(explicitly_logged)).trace)
+        self.assertEqual(code_filter.decide(FakeFrame(recorded_function)), codefilter.UNTRACED)
+
+    def test_skip(self):
+        code_filter = codefilter.CodeFilter(debugger.Options(), skip=["pylog.test_*"])
+        self.assertEqual(code_filter.decide(FakeFrame(recorded_function)), codefilter.UNTRACED)
+
+    def test_invalidate(self):
+        import pylog.test_pylog
+        code_filter = codefilter.CodeFilter(debugger.Options())
+        code_filter.decide(FakeFrame(recorded_function))
+        code_filter.invalidate(events)
+        self.assertEqual(len(code_filter.decisions), 1)
+        code_filter.invalidate(pylog.test_pylog)
+        self.assertEqual(code_filter.decisions, {})
+
+class TestBufferedJsonFileEventLogger(unittest.TestCase):
+    """tests debugger.BufferedJsonFileEventLogger"""
+
+    def test_same_output(self):
+        expected = six.StringIO()
+        plain = debugger.JsonFileEventLogger(expected)
+        actual = six.StringIO()
+        buffered = debugger.BufferedJsonFileEventLogger(actual, debugger.FlushPolicy(max_events=3, max_seconds=60))
+        for evt in EVENT_LISTS["1"]:
+            plain.log_event(evt)
+            buffered.log_event(evt)
+        #header + 2 full batches
+        self.assertEqual(len(actual.getvalue().splitlines()), 7)
+        buffered.flush()
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        stats = buffered.stats()
+        self.assertEqual(stats["events_written"], 8)
+        self.assertEqual(stats["events_dropped"], 0)
+        self.assertEqual(stats["flush_count"], 3)
+
+    def test_flush_interval(self):
+        log_file = six.StringIO()
+        buffered = debugger.BufferedJsonFileEventLogger(log_file, debugger.FlushPolicy(max_events=100, max_seconds=0))
+        buffered.log_event(EVENT_LISTS["1"][0])
+        self.assertEqual(len(log_file.getvalue().splitlines()), 2)
+
+    def test_dropped(self):
+        log_file = six.StringIO()
+        buffered = debugger.BufferedJsonFileEventLogger(log_file)
+        buffered.log_event(EVENT_LISTS["1"][0])
+        log_file.close()
+        buffered.flush()
+        self.assertEqual(buffered.stats()["events_dropped"], 1)
+
+class TestBackgroundEventLogger(unittest.TestCase):
+    """tests background.BackgroundEventLogger"""
+
+    def test_same_events(self):
+        options = debugger.Options(log_lines=True, log_args=True, log_retval=True)
+        expected = record(tracer.LoggingTracer, options)
+        background_loggers = []
+        def wrap_logger(event_logger):
+            background_loggers.append(background.BackgroundEventLogger(event_logger, capacity=4))
+            return background_loggers[0]
+        actual = record(tracer.LoggingTracer, options, wrap_logger=wrap_logger)
+        self.assertEqual(actual, expected)
+        background_loggers[0].close()
+        self.assertEqual(background_loggers[0].stats()["events_dropped"], 0)
+
+    def test_trace_threads(self):
+        options = debugger.Options(log_lines=True, log_retval=True, trace_threads=True)
+        expected = record(tracer.LoggingTracer, options)
+        background_loggers = []
+        def wrap_logger(event_logger):
+            background_loggers.append(background.BackgroundEventLogger(event_logger))
+            #the raw tuples are passed on, so the events are built by the writer thread
+            background_loggers[0].log_event = None
+            return background_loggers[0]
+        actual = record(tracer.LoggingTracer, options, wrap_logger=wrap_logger)
+        background_loggers[0].close()
+        self.assertEqual(actual, expected)
+
+    def test_process_trace_threads(self):
+        options = debugger.Options(log_lines=True, log_retval=True, trace_threads=True)
+        expected = record(tracer.LoggingTracer, options)
+        directory = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(directory, "log.txt")
+            event_logger = background.ProcessEventLogger(log_path)
+            recorder = tracer.LoggingTracer(event_logger, options=options)
+            recorder.set_trace()
+            record_fib()
+            recorder.set_quit()
+            event_logger.close()
+            actual = [
+                (evt.event_type, getattr(evt, "function_name", None), evt.line_number, getattr(evt, "retval", None))
+                for evt in logreader.iter_log_events(log_path)
+                if evt.file_name == os.path.abspath(recorded_function.__code__.co_filename)
+            ]
+        finally:
+            shutil.rmtree(directory)
+        #the lines of this test around record_fib aren't those of record's
+        self.assertEqual(actual[1:-1], expected[1:-1])
+
+    def test_event_from_raw(self):
+        timestamp = datetime.datetime(2015, 1, 20)
+        evt = events.event_from_raw(("call", timestamp, "foo.py", 8, "main", "a=1"))
+        self.assertEqual(evt.to_data(), events.CallEvent(
+            timestamp=timestamp, file_name="foo.py", line_number=8, function_name="main", args="a=1",
+        ).to_data())
+
+    def test_backpressure(self):
+        drop_lines = background.Backpressure("drop_lines")
+        self.assertTrue(drop_lines.keep_line(congested=True, full=False))
+        self.assertFalse(drop_lines.keep_line(congested=True, full=True))
+        sample = background.Backpressure("sample", sample_every=2)
+        self.assertEqual([sample.keep_line(congested=True, full=False) for _ in range(4)], [False, True, False, True])
+        self.assertEqual(sample.events_dropped, 2)
+        self.assertRaises(ValueError, background.Backpressure, "bogus")
+
+    def test_congested_events(self):
+        class SlowEventLogger(object):
+            def __init__(self):
+                self.events = []
+            def log_event(self, event):
+                time.sleep(0.001)
+                self.events.append(event)
+        slow_logger = SlowEventLogger()
+        event_logger = background.BackgroundEventLogger(slow_logger, capacity=4, backpressure="drop_lines")
+        evts = make_wide_tree(20)
+        for evt in evts:
+            event_logger.log_event(evt)
+            for line_number in range(5):
+                event_logger.log_event(events.LineEvent(file_name="a.py", line_number=line_number, timestamp=evt.timestamp))
+        event_logger.close()
+        dropped = event_logger.stats()["events_dropped"]
+        self.assertTrue(dropped > 0)
+        self.assertEqual(len(slow_logger.events), len(evts) * 6 - dropped)
+        #only lines were dropped
+        self.assertEqual([evt for evt in slow_logger.events if evt.event_type != "line"], evts)
+
+    def test_failing_writes(self):
+        class FailingEventLogger(object):
+            def __init__(self):
+                self.events = []
+            def log_event(self, event):
+                if event.event_type == "return":
+                    raise IOError("No space left on device")
+                self.events.append(event)
+        failing_logger = FailingEventLogger()
+        event_logger = background.BackgroundEventLogger(failing_logger, capacity=4)
+        evts = make_wide_tree(20)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        self.assertEqual(failing_logger.events, [evt for evt in evts if evt.event_type != "return"])
+        self.assertEqual(event_logger.stats()["events_failed"], len(evts) - len(failing_logger.events))
+        self.assertTrue(isinstance(event_logger.write_error, IOError))
+
+    def test_writer_stopped(self):
+        event_logger = background.BackgroundEventLogger(ListEventLogger(), capacity=4)
+        #stop the writer, as if it had died
+        event_logger.closing = True
+        event_logger.writer.join()
+        event_logger.closing = False
+        #the queue fills up, then events are dropped instead of waiting for the writer forever
+        for timestamp in range(10):
+            event_logger.log_event(events.CallEvent(file_name="a.py", line_number=1, function_name="main", timestamp=timestamp))
+        self.assertEqual(event_logger.stats()["events_dropped"], 6)
+        event_logger.close()
+
+class TestBinaryFormat(unittest.TestCase):
+    """debugger.BinaryFileEventLogger and logreader.BinaryFileEventReader"""
+
+    def _roundtrip(self, evts, chunk_size=1 << 20):
+        log_file = io.BytesIO()
+        event_logger = debugger.BinaryFileEventLogger(log_file)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.flush()
+        log_file.seek(0)
+        reader = logreader.get_reader(log_file)
+        self.assertTrue(isinstance(reader, logreader.BinaryFileEventReader))
+        reader.chunk_size = chunk_size
+        return list(reader.iter_events())
+
+    def test_roundtrip(self):
+        evts = EVENT_LISTS["1"] + [
+            events.event_from_data(data) for data in TestEventSerialization.events.values()
+        ] + make_samples([["main"], ["main", "work"]])
+        for chunk_size in (1, 7, 1 << 20):
+            self.assertEqual(
+                [evt.to_data() for evt in self._roundtrip(evts, chunk_size)],
+                [evt.to_data() for evt in evts],
+            )
+
+    def test_smaller_than_json(self):
+        log_file = io.BytesIO()
+        event_logger = debugger.BinaryFileEventLogger(log_file)
+        json_file = six.StringIO()
+        json_logger = debugger.JsonFileEventLogger(json_file)
+        for evt in EVENT_LISTS["1"] * 10:
+            event_logger.log_event(evt)
+            json_logger.log_event(evt)
+        event_logger.flush()
+        self.assertTrue(len(log_file.getvalue()) * 5 < len(json_file.getvalue()))
+
+    def test_json_reader(self):
+        log_file = io.BytesIO(b'{"type": "line", "timestamp": "2015-01-20T14:30:32.001000", "file_name": "a.py", "line_number": 1}\n')
+        reader = logreader.get_reader(log_file)
+        self.assertTrue(isinstance(reader, logreader.JsonFileEventReader))
+        self.assertEqual([evt.line_number for evt in reader.iter_events()], [1])
+
+class TestEventStore(unittest.TestCase):
+    """tests events.EventStore"""
+
+    def setUp(self):
+        self.evts = EVENT_LISTS["1"] + [
+            events.event_from_data(TestEventSerialization.events[event_type])
+            for event_type in ("line", "call", "return", "exception")
+        ]
+        self.store = events.EventStore.from_events(self.evts)
+
+    def test_views(self):
+        self.assertEqual(len(self.store), len(self.evts))
+        self.assertEqual([evt.to_data() for evt in self.store], [evt.to_data() for evt in self.evts])
+        for view, evt in zip(self.store, self.evts):
+            self.assertEqual(view.event_type, evt.event_type)
+            self.assertEqual(view.stack_change, evt.stack_change)
+            self.assertEqual(view.timestamp, evt.timestamp)
+            self.assertEqual(view.function_name, getattr(evt, "function_name", None))
+        self.assertEqual(self.store[-1].file_name, "my_file.py")
+        self.assertRaises(IndexError, lambda: self.store[len(self.evts)])
+
+    def test_depths(self):
+        self.assertEqual(list(self.store.depths), [1, 2, 3, 3, 2, 2, 2, 1, 0, 1, 1, 0])
+
+    def test_function_set(self):
+        self.assertEqual(
+            sorted(events.FunctionSet.from_events(self.store).to_data(), key=lambda a: a["name"]),
+            sorted(events.FunctionSet.from_events(self.evts).to_data(), key=lambda a: a["name"]),
+        )
+
+    def test_flame_chart(self):
+        store = events.EventStore.from_events(EVENT_LISTS["1"])
+        self.assertEqual(
+            events.ExecutionTree.from_events(store).to_flame_chart(100),
+            events.ExecutionTree.from_events(EVENT_LISTS["1"]).to_flame_chart(100),
+        )
+
+    def test_stepper(self):
+        stepper = replay.Stepper(self.store)
+        self.assertTrue(stepper.events is self.store)
+        stepper.step_forwards()
+        stepper.step_forwards()
+        self.assertEqual(list(stepper.locations), [replay.Location("foo.py", 8), replay.Location("bar.py", 22)])
+
+    def test_from_reader(self):
+        log_file = io.BytesIO()
+        event_logger = debugger.BinaryFileEventLogger(log_file)
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.flush()
+        log_file.seek(0)
+        store = events.EventStore.from_reader(logreader.get_reader(log_file))
+        self.assertEqual([evt.to_data() for evt in store], [evt.to_data() for evt in self.evts])
+
+class TestStreaming(unittest.TestCase):
+    """analysis paths that take iterators"""
+
+    def test_flame_chart_from_events(self):
+        for max_depth in (100, 1, 0):
+            self.assertEqual(
+                events.flame_chart_from_events(iter(EVENT_LISTS["1"]), max_depth),
+                events.ExecutionTree.from_events(EVENT_LISTS["1"]).to_flame_chart(max_depth),
+            )
+        store = events.EventStore.from_events(EVENT_LISTS["1"])
+        self.assertEqual(
+            events.flame_chart_from_events(store, 100),
+            events.ExecutionTree.from_events(EVENT_LISTS["1"]).to_flame_chart(100),
+        )
+
+    def test_iter_events_from_file(self):
+        log_file = six.StringIO()
+        event_logger = debugger.JsonFileEventLogger(log_file)
+        for evt in EVENT_LISTS["1"]:
+            event_logger.log_event(evt)
+        log_file.seek(0)
+        evts = events.iter_events_from_file(log_file)
+        self.assertFalse(isinstance(evts, list))
+        fset = events.FunctionSet.from_events(evts)
+        self.assertEqual(len(fset.functions), 4)
+
+class TestStepper(unittest.TestCase):
+    """tests replay.Stepper"""
+
+    def setUp(self):
+        self.evts = (EVENT_LISTS["1"] + [
+            events.event_from_data(TestEventSerialization.events[event_type])
+            for event_type in ("line", "call", "line", "return")
+        ]) * 5
+        #the stack before each event, found by stepping forwards only
+        stepper = replay.Stepper(self.evts)
+        self.stacks = [list(stepper.locations)]
+        while not stepper.at_last_step():
+            stepper.step_forwards()
+            self.stacks.append(list(stepper.locations))
+
+    def test_step_backwards(self):
+        stepper = replay.Stepper(self.evts, snapshot_interval=4)
+        stepper.go_to(len(self.evts))
+        while not stepper.at_first_step():
+            stepper.step_backwards()
+            self.assertEqual(list(stepper.locations), self.stacks[stepper.next_event_index])
+        self.assertTrue(len(stepper.undo_kinds) <= 8)
+
+    def test_go_to(self):
+        stepper = replay.Stepper(self.evts, snapshot_interval=4)
+        for event_index in (37, 3, 59, 4, 60, 12, 11, 0, 33, 58):
+            stepper.go_to(event_index)
+            self.assertEqual(stepper.next_event_index, event_index)
+            self.assertEqual(list(stepper.locations), self.stacks[event_index])
+        stepper.step_backwards(25)
+        self.assertEqual(list(stepper.locations), self.stacks[33])
+
+    def test_step_over(self):
+        stepper = replay.Stepper(self.evts)
+        stepper.step_forwards()
+        stepper.step_over()
+        self.assertEqual(stepper.next_event_index, 5)
+        self.assertEqual(list(stepper.locations), [replay.Location("foo.py", 8)])
+        #the call was jumped over, not stepped through
+        self.assertEqual(len(stepper.undo_kinds), 0)
+        stepper.step_over()
+        self.assertEqual(stepper.next_event_index, 7)
+        stepper.step_back_over()
+        self.assertEqual(stepper.next_event_index, 5)
+        stepper.step_back_over()
+        stepper.step_back_over()
+        self.assertEqual(stepper.next_event_index, 0)
+        self.assertEqual(list(stepper.locations), [])
+
+    def test_step_back_after_step_over(self):
+        frame_index = replay.FrameIndex(self.evts)
+        for opener, event in enumerate(self.evts):
+            closer = frame_index.matches[opener]
+            if event.event_type not in replay.OPENING_TYPES or closer < 0:
+                continue
+            stepper = replay.Stepper(self.evts, snapshot_interval=4)
+            stepper.go_to(opener)
+            stepper.step_over()
+            self.assertEqual(stepper.next_event_index, closer + 1)
+            #stepping back restores the snapshot from before the return, without replaying the call
+            stepper.step_forwards = None
+            stepper.step_backwards()
+            self.assertEqual(stepper.next_event_index, closer)
+            self.assertEqual(list(stepper.locations), self.stacks[closer])
+
+    def test_step_out(self):
+        stepper = replay.Stepper(self.evts, snapshot_interval=4)
+        for start, end in ((3, 4), (4, 5), (14, 17), (22, 24), (34, 36)):
+            stepper.go_to(start)
+            stepper.step_out()
+            self.assertEqual(stepper.next_event_index, end)
+            self.assertEqual(list(stepper.locations), self.stacks[end])
+            stepper.step_backwards()
+            self.assertEqual(list(stepper.locations), self.stacks[end - 1])
+        #the frame opened by a line outside of any call never returns
+        stepper.go_to(9)
+        stepper.step_out()
+        self.assertTrue(stepper.at_last_step())
+
+    def test_frame_index(self):
+        frame_index = replay.FrameIndex(self.evts)
+        self.assertEqual(list(frame_index.matches[:12]), [7, 4, 3, 2, 1, 6, 5, 0, -1, 11, -1, 9])
+        self.assertEqual(list(frame_index.openers[:13]), [0, 1, 2, 1, 0, 5, 0, -1, 8, 9, 9, 8, 12])
+
+def make_wide_tree(children, start=0):
+    """main() calling `children` 1ns calls to leaf(), each of which calls inner(). Timestamps in ns"""
+    evts = [events.CallEvent(file_name="foo.py", line_number=1, function_name="main", timestamp=start)]
+    for child in range(children):
+        timestamp = start + 10 * child + 1
+        evts.append(events.CallEvent(file_name="foo.py", line_number=5, function_name="leaf", timestamp=timestamp))
+        evts.append(events.CallEvent(file_name="foo.py", line_number=9, function_name="inner", timestamp=timestamp))
+        evts.append(events.ReturnEvent(file_name="foo.py", line_number=9, function_name="inner", timestamp=timestamp + 1))
+        evts.append(events.ReturnEvent(file_name="foo.py", line_number=5, function_name="leaf", timestamp=timestamp + 1))
+    evts.append(events.ReturnEvent(file_name="foo.py", line_number=1, function_name="main", timestamp=start + 10 * children))
+    return evts
+
+class TestFlameIndex(unittest.TestCase):
+    """tests flameindex.FlameIndex"""
+
+    def test_full_detail(self):
+        chart = flameindex.FlameIndex.from_events(EVENT_LISTS["1"]).to_flame_chart()
+        chart["calls"].sort(key=lambda call: call["id"])
+        self.assertEqual(chart.pop("lanes"), [{"process_id": None, "thread_id": None, "depths": 3}])
+        self.assertEqual(chart, events.flame_chart_from_events(EVENT_LISTS["1"], 100))
+
+    def test_depth_range(self):
+        index = flameindex.FlameIndex.from_events(EVENT_LISTS["1"])
+        self.assertEqual([call["id"] for call in index.query(min_depth=1, max_depth=1)], [2, 4])
+        self.assertEqual([call["id"] for call in index.query(max_depth=0)], [1])
+        self.assertEqual(index.query(min_depth=5), [])
+
+    def test_time_window(self):
+        index = flameindex.FlameIndex.from_events(make_wide_tree(100))
+        calls = index.query(start=505, end=525)
+        self.assertEqual(sorted(call["id"] for call in calls), [1, 104, 105, 106, 107])
+
+    def test_merging(self):
+        index = flameindex.FlameIndex.from_events(make_wide_tree(1000))
+        calls = index.query(width=100)
+        #main, then ~1 block per pixel for the leaves, and none of their children
+        self.assertEqual(calls[0]["name"], "main")
+        merged = [call for call in calls if call["id"] is None]
+        self.assertEqual(len(calls), 101)
+        self.assertEqual(sum(call["count"] for call in merged), 1000)
+        self.assertTrue(all(call["depth"] == 1 and call["parent_id"] == 1 for call in merged))
+        #zooming in shows the calls themselves
+        calls = index.query(start=5000, end=5100, width=100)
+        self.assertEqual(len([call for call in calls if call["name"] == "inner"]), 10)
+
+def make_recursive_calls(depth, start=0):
+    """f() calling itself depth times. Each call takes 10ns more than its callee"""
+    evts = []
+    for level in range(depth):
+        evts.append(events.CallEvent(file_name="f.py", line_number=1, function_name="f", timestamp=start + level * 5))
+    for level in reversed(range(depth)):
+        evts.append(events.ReturnEvent(file_name="f.py", line_number=1, function_name="f", timestamp=start + level * 5 + 10 * (depth - level)))
+    return evts
+
+class TestProfileStats(unittest.TestCase):
+    """tests stats.ProfileStats"""
+
+    def test_times(self):
+        profile = stats.ProfileStats.from_events(make_wide_tree(10))
+        main = profile.functions["main", "foo.py", 1]
+        leaf = profile.functions["leaf", "foo.py", 5]
+        self.assertEqual((main.count, main.inclusive, main.exclusive), (1, 100, 90))
+        self.assertEqual((leaf.count, leaf.inclusive, leaf.exclusive, leaf.min, leaf.max), (10, 10, 0, 1, 1))
+        edge = profile.edges[("main", "foo.py", 1), ("leaf", "foo.py", 5)]
+        self.assertEqual((edge.count, edge.inclusive), (10, 10))
+        self.assertEqual(profile.total_time, 100)
+
+    def test_recursion(self):
+        profile = stats.ProfileStats.from_events(make_recursive_calls(4))
+        function = profile.functions["f", "f.py", 1]
+        self.assertEqual((function.count, function.primitive_count), (4, 1))
+        self.assertEqual(function.inclusive, 40)
+        self.assertEqual(function.exclusive, 40 - 10 * 3 + 30 - 10 * 2 + 20 - 10 + 10)
+        self.assertTrue("4/1" in profile.format_table())
+
+    def test_percentiles(self):
+        for duration in (0, 15, 16, 17, 100, 12345, 10 ** 9):
+            low, high = stats.bucket_bounds(stats.duration_bucket(duration))
+            self.assertTrue(low <= duration < high)
+            self.assertTrue(high - low <= max(1, low // 8))
+        function = stats.FunctionStats()
+        for duration in range(1, 1001):
+            function.add(duration, duration, False)
+        self.assertTrue(abs(function.percentile(50) - 500) <= 500 // 8)
+        self.assertTrue(abs(function.percentile(99) - 990) <= 990 // 8)
+
+    def test_merge(self):
+        profile = stats.ProfileStats.from_events(make_wide_tree(10))
+        profile.merge(stats.ProfileStats.from_events(make_wide_tree(5, start=1000)))
+        self.assertEqual(profile.functions["leaf", "foo.py", 5].count, 15)
+        self.assertEqual(profile.total_time, 150)
+
+    def test_pstats(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "log.prof")
+            stats.ProfileStats.from_events(make_wide_tree(10) + make_recursive_calls(3, start=200)).dump_pstats(path)
+            loaded = pstats.Stats(path)
+            self.assertEqual(loaded.total_calls, 24)
+            self.assertEqual(loaded.prim_calls, 22)
+            primitive, count, exclusive, inclusive, callers = loaded.stats["foo.py", 5, "leaf"]
+            self.assertEqual((primitive, count), (10, 10))
+            self.assertEqual(list(callers), [("foo.py", 1, "main")])
+        finally:
+            shutil.rmtree(directory)
+
+class TestCallPathTree(unittest.TestCase):
+    """tests callpaths.CallPathTree"""
+
+    def test_merged(self):
+        tree = callpaths.CallPathTree.from_events(make_wide_tree(1000))
+        main = tree.root.children["main", "foo.py", 1]
+        leaf = main.children["leaf", "foo.py", 5]
+        inner = leaf.children["inner", "foo.py", 9]
+        self.assertEqual((main.count, main.inclusive, main.exclusive), (1, 10000, 9000))
+        self.assertEqual((leaf.count, leaf.inclusive, leaf.exclusive), (1000, 1000, 0))
+        self.assertEqual((inner.count, inner.inclusive), (1000, 1000))
+        data = tree.to_data()
+        self.assertEqual(data["inclusive"], 10000.0 / events.NS_PER_SECOND)
+        self.assertEqual(data["children"][0]["children"][0]["calls"], 1000)
+
+    def test_collapsed(self):
+        tree = callpaths.CallPathTree.from_events(make_wide_tree(10) + make_recursive_calls(2, start=200))
+        self.assertEqual(tree.to_collapsed(), "".join([
+            "f (f.py:1) 10\n",
+            "f (f.py:1);f (f.py:1) 10\n",
+            "main (foo.py:1) 90\n",
+            "main (foo.py:1);leaf (foo.py:5);inner (foo.py:9) 10\n",
+        ]))
+
+    def test_merge(self):
+        tree = callpaths.CallPathTree.from_events(make_wide_tree(10))
+        tree.merge(callpaths.CallPathTree.from_events(make_wide_tree(5)))
+        self.assertEqual(tree.root.children["main", "foo.py", 1].children["leaf", "foo.py", 5].count, 15)
+
+    def test_deep(self):
+        #deeper than the recursion limit
+        depth = 3000
+        tree = callpaths.CallPathTree.from_events(make_recursive_calls(depth))
+        tree.merge(callpaths.CallPathTree.from_events(make_recursive_calls(depth, start=100000)))
+        data = tree.to_data()
+        for _ in range(depth):
+            self.assertEqual(len(data["children"]), 1)
+            data = data["children"][0]
+            self.assertEqual(data["calls"], 2)
+        self.assertEqual(data["children"], [])
+
+    def test_children_order(self):
+        tree = callpaths.CallPathTree.from_events(make_wide_tree(3) + make_recursive_calls(2, start=100))
+        self.assertEqual([child["name"] for child in tree.to_data()["children"]], ["main", "f"])
+        tree = callpaths.CallPathTree.from_events(make_wide_tree(1) + make_recursive_calls(2, start=100))
+        self.assertEqual([child["name"] for child in tree.to_data()["children"]], ["f", "main"])
+
+def make_samples(stacks, start=0, interval=10, thread_id=1):
+    """A sample every interval ns for each stack, given as function names. Function f is at f.py:1"""
+    return [
+        events.SampleEvent(
+            timestamp=start + number * interval, file_name="f.py", line_number=2,
+            thread_id=thread_id, interval=interval, stack=[(name, "f.py", 1) for name in stack],
+        )
+        for number, stack in enumerate(stacks)
+    ]
+
+def busy_function(seconds):
+    stop = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    while datetime.datetime.now() < stop:
+        pass
+
+class TestSampling(unittest.TestCase):
+    """tests sampler.SamplingRecorder and events.expand_samples"""
+
+    def test_serialization(self):
+        sample, = make_samples([["main", "work"]])
+        data = sample.to_data()
+        self.assertEqual(data["stack"], [["main", "f.py", 1], ["work", "f.py", 1]])
+        self.assertEqual(events.event_from_data(data).to_data(), data)
+        store = events.EventStore.from_events(make_samples([["main"]]))
+        self.assertEqual((store[0].thread_id, store[0].interval, store[0].stack), (1, 10, [("main", "f.py", 1)]))
+
+    def test_expand(self):
+        samples = make_samples([["main"], ["main", "work"], ["main", "work"], ["main", "other"], ["main"]])
+        samples += make_samples([["main", "elsewhere"]], start=5, thread_id=2)
+        profile = stats.ProfileStats.from_events(events.expand_samples(samples))
+        self.assertEqual(profile.functions["main", "f.py", 1].inclusive, 60)
+        self.assertEqual(profile.functions["work", "f.py", 1].inclusive, 20)
+        self.assertEqual(profile.functions["other", "f.py", 1].inclusive, 10)
+        self.assertEqual(profile.functions["elsewhere", "f.py", 1].inclusive, 10)
+        self.assertEqual(
+            [evt.to_data() for evt in events.EventStore.from_events(events.expand_samples(samples))],
+            [events.event_from_raw(raw).to_data() for raw in events.expand_samples_raw(
+                (evt.event_type, evt.timestamp, evt.file_name, evt.line_number, None, (evt.interval, evt.stack), evt.thread_id)
+                for evt in samples
+            )],
+        )
+
+    def test_record(self):
+        event_logger = ListEventLogger()
+        recorder = sampler.SamplingRecorder(event_logger, hz=1000)
+        recorder.set_trace()
+        busy_function(0.05)
+        recorder.set_quit()
+        self.assertTrue(event_logger.events)
+        self.assertTrue(all(evt.event_type == "sample" for evt in event_logger.events))
+        self.assertTrue(any(
+            evt.stack[-1][0] == "busy_function" and evt.stack[0][0] == "test_record"
+            for evt in event_logger.events
+        ))
+        calls = [evt.function_name for evt in events.expand_samples(event_logger.events) if evt.event_type == "call"]
+        self.assertTrue("busy_function" in calls)
+
+def in_thread(evts, thread_id):
+    """Copies of evts that happened in thread thread_id"""
+    return [events.event_from_data(dict(evt.to_data(), thread_id=thread_id)) for evt in evts]
+
+def interleave(*event_lists):
+    return [evt for evts in zip(*event_lists) for evt in evts]
+
+def record_threads():
+    thread = threading.Thread(target=record_fib)
+    thread.start()
+    thread.join()
+    return record_fib()
+
+class TestThreads(unittest.TestCase):
+    """tests logging and analysing several threads"""
+
+    def setUp(self):
+        self.evts = interleave(in_thread(EVENT_LISTS["1"], 1), in_thread(EVENT_LISTS["1"], 2))
+
+    def test_recorders(self):
+        key = ("recorded_function", os.path.abspath(recorded_function.__code__.co_filename), recorded_function.__code__.co_firstlineno)
+        for recorder_class in (debugger.LoggingDebugger, tracer.LoggingTracer):
+            for log_lines in (False, True):
+                event_logger = ListEventLogger()
+                recorder = recorder_class(event_logger, options=debugger.Options(trace_threads=True, log_lines=log_lines))
+                recorder.set_trace()
+                record_threads()
+                recorder.set_quit()
+                evts = [evt for evt in event_logger.events if evt.file_name == key[1]]
+                thread_ids = set(evt.thread_id for evt in evts)
+                self.assertEqual(len(thread_ids), 2)
+                self.assertEqual(stats.ProfileStats.from_events(evts).functions[key].count, 18)
+                tree = events.ExecutionTree.from_events(evts)
+                self.assertEqual(set(call.call_event.thread_id for call in tree.sub_events), thread_ids)
+
+    def test_split(self):
+        fset = events.FunctionSet.from_events(self.evts)
+        self.assertEqual(
+            sorted(fset.to_data(), key=lambda a: a["name"]),
+            sorted(events.FunctionSet.from_events(EVENT_LISTS["1"]).to_data(), key=lambda a: a["name"]),
+        )
+        store = events.EventStore.from_events(self.evts)
+        self.assertEqual(list(store.depths[:6]), [1, 1, 2, 2, 3, 3])
+        self.assertEqual(
+            sorted(events.FunctionSet.from_events(store).to_data(), key=lambda a: a["name"]),
+            sorted(fset.to_data(), key=lambda a: a["name"]),
+        )
+        tree = events.ExecutionTree.from_events(store)
+        self.assertEqual([call.call_event.thread_id for call in tree.sub_events], [1, 2])
+        chart = tree.to_flame_chart(100)
+        streamed = events.flame_chart_from_events(self.evts, 100)
+        #ids are numbered differently, the calls are the same
+        summary = lambda chart: sorted((call["thread_id"], call["call_time"], call["depth"], call["name"]) for call in chart["calls"])
+        self.assertEqual(summary(chart), summary(streamed))
+        self.assertEqual(chart["total_seconds"], streamed["total_seconds"])
+        self.assertEqual([call["thread_id"] for call in chart["calls"] if call["depth"] == 0], [1, 2])
+        index = flameindex.FlameIndex.from_events(self.evts)
+        self.assertEqual(index.to_flame_chart()["lanes"], [
+            {"process_id": None, "thread_id": 1, "depths": 3}, {"process_id": None, "thread_id": 2, "depths": 3},
+        ])
+        self.assertEqual([call["thread_id"] for call in index.query(max_depth=0)], [1, 2])
+        self.assertEqual(len(index.query()), 8)
+        main = stats.ProfileStats.from_events(self.evts).functions["main", "foo.py", 8]
+        self.assertEqual((main.count, main.primitive_count), (2, 2))
+
+    def test_binary(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(directory, "log.bin")
+            event_logger = debugger.open_event_logger(log_path, "binary")
+            for evt in self.evts:
+                event_logger.log_event(evt)
+            event_logger.close()
+            index = logindex.LogIndex.build(log_path, checkpoint_interval=3)
+            self.assertEqual(list(index.depths[:6]), [1, 1, 2, 2, 3, 3])
+            self.assertEqual((index.match(0), index.match(1)), (14, 15))
+            indexed_log = logindex.IndexedLog(log_path, index)
+            self.assertEqual([evt.to_data() for evt in indexed_log], [evt.to_data() for evt in self.evts])
+            indexed_log.close()
+        finally:
+            shutil.rmtree(directory)
+
+#async def is a syntax error in python 2
+TASKS_SOURCE = """
+import asyncio
+
+async def wait(seconds):
+    await asyncio.sleep(seconds)
+    return seconds
+
+async def worker(seconds):
+    await wait(seconds)
+    await wait(seconds)
+    return seconds
+
+async def run_tasks():
+    return await asyncio.gather(worker(0.02), worker(0.03))
+"""
+TASKS_FILE_NAME = os.path.abspath("<tasks>")
+
+def record_tasks(recorder_class, options):
+    """The events of the <tasks> code, recorded while asyncio runs two workers"""
+    import asyncio
+    namespace = {}
+    exec(compile(TASKS_SOURCE, "<tasks>", "exec"), namespace)
+    event_logger = ListEventLogger()
+    recorder = recorder_class(event_logger, options=options)
+    recorder.set_trace()
+    asyncio.run(namespace["run_tasks"]())
+    recorder.set_quit()
+    return [evt for evt in event_logger.events if evt.file_name == TASKS_FILE_NAME]
+
+class TestTasks(unittest.TestCase):
+    """tests recording coroutines and putting their asyncio tasks back together"""
+
+    def setUp(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest("no asyncio")
+        if not hasattr(asyncio, "run"):
+            self.skipTest("no asyncio.run")
+
+    def key(self, name):
+        lines = TASKS_SOURCE.split("\n")
+        return (name, TASKS_FILE_NAME, lines.index("async def {0}(seconds):".format(name)) + 1)
+
+    def check_events(self, evts):
+        worker_ids = set(evt.task_id for evt in evts if getattr(evt, "function_name", None) == "worker")
+        self.assertEqual(len(worker_ids), 2)
+        self.assertTrue(None not in worker_ids)
+        event_types = set(evt.event_type for evt in evts)
+        self.assertTrue("resume" in event_types and "suspend" in event_types)
+        self.assertFalse("exception" in event_types)
+
+        tree = events.ExecutionTree.from_events(evts)
+        workers = [call for call in tree.sub_events if call.call_event.function_name == "worker"]
+        self.assertEqual(sorted(call.call_event.task_id for call in workers), sorted(worker_ids))
+        for call in workers:
+            self.assertEqual([sub_call.call_event.function_name for sub_call in call.sub_events], ["wait", "wait"])
+            self.assertEqual(call.return_event.event_type, "return")
+            self.assertTrue(call.wall_time >= 0.04 * events.NS_PER_SECOND)
+            self.assertTrue(call.active_time < call.wall_time / 2)
+
+        profile = stats.ProfileStats.from_events(evts)
+        worker = profile.functions[self.key("worker")]
+        self.assertEqual(worker.count, 2)
+        self.assertTrue(worker.active < worker.inclusive / 2)
+        self.assertEqual(profile.functions[self.key("wait")].count, 4)
+        self.assertEqual(profile.edges[self.key("worker"), self.key("wait")].count, 4)
+        actives = [function.active for _, function in profile.sorted_functions("active")]
+        self.assertEqual(actives, sorted(actives, reverse=True))
+        self.assertTrue("active" in profile.format_table().split("\n")[2])
+        self.assertEqual(callpaths.CallPathTree.from_events(evts).root.child(self.key("worker")).count, 2)
+
+    def test_recorders(self):
+        for recorder_class in (debugger.LoggingDebugger, tracer.LoggingTracer):
+            for log_lines in (False, True):
+                options = debugger.Options(trace_tasks=True, log_lines=log_lines)
+                self.check_events(record_tasks(recorder_class, options))
+
+    def test_raw(self):
+        #trace_threads logs raw tuples to a ThreadBufferedEventLogger
+        self.check_events(record_tasks(tracer.LoggingTracer, debugger.Options(trace_tasks=True, trace_threads=True)))
+
+    def test_binary(self):
+        evts = record_tasks(tracer.LoggingTracer, debugger.Options(trace_tasks=True, log_args=True, log_retval=True))
+        directory = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(directory, "log.bin")
+            event_logger = debugger.open_event_logger(log_path, "binary")
+            for evt in evts:
+                event_logger.log_event(evt)
+            event_logger.close()
+            self.assertEqual([evt.to_data() for evt in logreader.iter_log_events(log_path)], [evt.to_data() for evt in evts])
+            index = logindex.LogIndex.build(log_path, checkpoint_interval=3)
+            indexed_log = logindex.IndexedLog(log_path, index)
+            self.assertEqual([evt.to_data() for evt in indexed_log], [evt.to_data() for evt in evts])
+            indexed_log.close()
+        finally:
+            shutil.rmtree(directory)
+
+def multiprocessing_context(method):
+    """A multiprocessing context for the start method, None if it isn't available"""
+    if not hasattr(multiprocessing, "get_context"):
+        #python 2 only forks
+        return multiprocessing if method == "fork" and hasattr(os, "fork") else None
+    if method not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context(method)
+
+def record_processes(context):
+    process = context.Process(target=record_fib)
+    process.start()
+    process.join()
+    return record_fib()
+
+class TestProcesses(unittest.TestCase):
+    """tests recording several processes and merging their shards"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_recording(self, method):
+        context = multiprocessing_context(method)
+        if context is None:
+            self.skipTest("no {0} start method".format(method))
+        log_path = os.path.join(self.directory, "log.txt")
+        recording = processes.ShardedRecording(log_path, tracer.LoggingTracer)
+        recording.run("record_processes(context)", {"record_processes": record_processes, "context": context})
+        self.assertTrue(processes.active_recording is None)
+        shards = processes.find_shards(log_path)
+        self.assertEqual(len(shards), 2)
+        headers = {}
+        for shard in shards:
+            with open(shard, "rb") as log_file:
+                reader = logreader.get_reader(log_file)
+                list(reader.iter_events())
+                headers[reader.header["pid"]] = reader.header
+        self.assertTrue(os.getpid() in headers)
+        child_pid, = set(headers) - set([os.getpid()])
+        self.assertEqual(headers[child_pid]["parent_pid"], os.getpid())
+        self.assertEqual(headers[child_pid]["wall_time_ns"], headers[os.getpid()]["wall_time_ns"])
+
+        self.assertEqual(processes.merge_recording(log_path), shards)
+        self.assertEqual(processes.find_shards(log_path), [])
+        evts = list(logreader.iter_log_events(log_path))
+        self.assertEqual(set(evt.process_id for evt in evts), set(headers))
+        timestamps = [evt.timestamp for evt in evts]
+        self.assertEqual(timestamps, sorted(timestamps))
+        key = ("recorded_function", os.path.abspath(recorded_function.__code__.co_filename), recorded_function.__code__.co_firstlineno)
+        self.assertEqual(stats.ProfileStats.from_events(evts).functions[key].count, 18)
+        lanes = flameindex.FlameIndex.from_events(evts).to_flame_chart()["lanes"]
+        self.assertEqual(set(lane["process_id"] for lane in lanes), set(headers))
+        #the child ran while the parent was waiting for it
+        child_calls = [evt.timestamp for evt in evts if evt.process_id == child_pid and evt.function_name == "recorded_function"]
+        parent_waits = [
+            evt.timestamp for evt in evts
+            if evt.process_id == os.getpid() and evt.function_name == "record_processes"
+        ]
+        self.assertTrue(parent_waits[0] < child_calls[0] < child_calls[-1] < parent_waits[-1])
+
+    def test_fork(self):
+        self.check_recording("fork")
+
+    def test_spawn(self):
+        self.check_recording("spawn")
+
+    def test_merge_binary(self):
+        shards = []
+        for process_id in (1, 2):
+            shard = os.path.join(self.directory, "log.bin.{0}".format(process_id))
+            event_logger = debugger.open_event_logger(shard, "binary")
+            for evt in in_thread(EVENT_LISTS["1"], 7):
+                evt.process_id = process_id
+                event_logger.log_event(evt)
+            event_logger.close()
+            shards.append(shard)
+        merged_path = os.path.join(self.directory, "merged.bin")
+        event_logger = debugger.open_event_logger(merged_path, "binary")
+        processes.merge_shards(shards, event_logger)
+        event_logger.close()
+        evts = list(logreader.iter_log_events(merged_path))
+        self.assertEqual([evt.process_id for evt in evts[:4]], [1, 2, 1, 2])
+        #the same thread id in two processes: two call stacks
+        index = logindex.LogIndex.build(merged_path, checkpoint_interval=3)
+        self.assertEqual(list(index.depths[:6]), [1, 1, 2, 2, 3, 3])
+        indexed_log = logindex.IndexedLog(merged_path, index)
+        self.assertEqual([evt.to_data() for evt in indexed_log], [evt.to_data() for evt in evts])
+        indexed_log.close()
+        self.assertEqual(len(flameindex.FlameIndex.from_events(evts).lane_threads), 2)
+
+class TestWebViewer(unittest.TestCase):
+    """tests the response caching in webviewer.WebViewer"""
+
+    def setUp(self):
+        self.viewer = webviewer.WebViewer(events.EventStore.from_events(make_wide_tree(100)), cache_size=2)
+
+    def get(self, path, query="", **headers):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query}
+        for name, value in headers.items():
+            environ["HTTP_" + name.upper()] = value
+        bottle.request.bind(environ)
+        bottle.response.bind()
+        callback = {
+            "/flame.json": self.viewer.get_flame_json,
+            "/functions.json": self.viewer.get_functions_json,
+            "/collapsed.txt": self.viewer.get_collapsed,
+        }[path]
+        return callback()
+
+    def test_cache(self):
+        body = self.get("/flame.json", "width=10")
+        self.assertEqual(len(json.loads(body.decode("utf-8"))["calls"]), 11)
+        self.assertTrue(self.get("/flame.json", "width=10") is body)
+        flame_index = self.viewer.get_flame_index()
+        self.get("/flame.json", "width=20")
+        self.get("/functions.json")
+        self.assertTrue(self.viewer.get_flame_index() is flame_index)
+        #evicted
+        self.assertFalse(self.get("/flame.json", "width=10") is body)
+
+    def test_etag(self):
+        self.get("/functions.json")
+        etag = bottle.response.get_header("ETag")
+        self.assertEqual(self.get("/functions.json", if_none_match=etag), b"")
+        self.assertEqual(bottle.response.status_code, 304)
+        self.assertNotEqual(self.get("/functions.json", if_none_match='"other"'), b"")
+
+    def test_collapsed(self):
+        self.assertEqual(self.get("/collapsed.txt").decode("utf-8").splitlines()[0], "main (foo.py:1) 900")
+        self.assertEqual(bottle.response.content_type, "text/plain")
+
+    def test_gzip(self):
+        body = self.get("/functions.json")
+        gzipped = self.get("/functions.json", accept_encoding="gzip, deflate")
+        self.assertEqual(bottle.response.get_header("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(gzipped)).read(), body)
+
+class TestLogIndex(unittest.TestCase):
+    """tests logindex.LogIndex and logindex.IndexedLog"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evts = EVENT_LISTS["1"] * 3 + [
+            events.event_from_data(TestEventSerialization.events[event_type])
+            for event_type in ("line", "call", "line", "return")
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, log_format):
+        log_path = os.path.join(self.directory, "log." + log_format)
+        event_logger = debugger.open_event_logger(log_path, log_format)
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        return log_path
+
+    def _test_index(self, log_format):
+        log_path = self.write_log(log_format)
+        logindex.LogIndex.build(log_path, checkpoint_interval=5).save(logindex.index_path(log_path))
+        index = logindex.LogIndex.load(logindex.index_path(log_path), log_path)
+        self.assertEqual(len(index), len(self.evts))
+        self.assertEqual(index.match(0), 7)
+        self.assertEqual(index.match(7), 0)
+        self.assertEqual(index.match(2), 3)
+        self.assertEqual(index.match(24), -1)
+        self.assertEqual(list(index.depths[:8]), [1, 2, 3, 3, 2, 2, 2, 1])
+        self.assertEqual(index.next_visit("bar.py", 22, 1), 9)
+        self.assertEqual(index.next_visit("bar.py", 22, 17), None)
+        self.assertEqual(index.previous_visit("bar.py", 22, 9), 1)
+        self.assertEqual(index.next_visit("my_file.py", 7, 0), 24)
+
+        indexed_log = logindex.IndexedLog(log_path, index, cached_blocks=2)
+        self.assertEqual(
+            [indexed_log[i].to_data() for i in reversed(range(len(self.evts)))],
+            [evt.to_data() for evt in reversed(self.evts)],
+        )
+        stepper = replay.Stepper(indexed_log)
+        self.assertTrue(stepper.events is indexed_log)
+        indexed_log.close()
+
+    def test_json(self):
+        self._test_index("json")
+
+    def test_binary(self):
+        self._test_index("binary")
+
+    def test_stale(self):
+        log_path = self.write_log("json")
+        logindex.LogIndex.build(log_path).save(logindex.index_path(log_path))
+        with open(log_path, "a") as log_file:
+            log_file.write("\n")
+        self.assertRaises(ValueError, logindex.LogIndex.load, logindex.index_path(log_path), log_path)
+        self.assertEqual(len(logindex.LogIndex.for_log(log_path)), len(self.evts))
+
+def make_generator_calls(start=0):
+    """main() calling a generator that's suspended and resumed three times, calling leaf() while it runs"""
+    gen = dict(file_name="g.py", line_number=3, function_name="gen")
+    evts = [events.CallEvent(file_name="g.py", line_number=1, function_name="main", timestamp=start)]
+    for step in range(4):
+        time = start + 10 + step * 20
+        opening = events.CallEvent if step == 0 else events.ResumeEvent
+        closing = events.ReturnEvent if step == 3 else events.SuspendEvent
+        evts.append(opening(timestamp=time, **dict(gen, line_number=3 + step)))
+        evts.append(events.CallEvent(file_name="g.py", line_number=9, function_name="leaf", timestamp=time + 2))
+        evts.append(events.ReturnEvent(file_name="g.py", line_number=9, function_name="leaf", timestamp=time + 5))
+        evts.append(closing(timestamp=time + 8, **dict(gen, line_number=4 + step)))
+    evts.append(events.ReturnEvent(file_name="g.py", line_number=1, function_name="main", timestamp=start + 100))
+    return evts
+
+class TestParallel(unittest.TestCase):
+    """tests parallel.profile_stats"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evts = sorted(
+            in_thread(make_generator_calls() + make_recursive_calls(5, start=100), 1)
+            + in_thread(make_wide_tree(5) + make_generator_calls(start=200), 2),
+            key=lambda evt: evt.timestamp,
+        )
+        #a call that never returns
+        self.evts.append(events.CallEvent(file_name="g.py", line_number=20, function_name="hang", timestamp=400))
+        #the last event, which the first pass skips, still ends it
+        self.evts.append(events.LineEvent(file_name="g.py", line_number=21, timestamp=450))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, log_format):
+        log_path = os.path.join(self.directory, "log." + log_format)
+        event_logger = debugger.open_event_logger(log_path, log_format)
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        return log_path
+
+    def assertSameStats(self, profile, expected):
+        self.assertEqual(dict((key, vars(function)) for key, function in profile.functions.items()),
+                         dict((key, vars(function)) for key, function in expected.functions.items()))
+        self.assertEqual(dict((key, vars(edge)) for key, edge in profile.edges.items()),
+                         dict((key, vars(edge)) for key, edge in expected.edges.items()))
+        self.assertEqual(profile.total_time, expected.total_time)
+
+    def test_chunks(self):
+        for log_format in ("json", "binary"):
+            log_path = self.write_log(log_format)
+            logindex.LogIndex.build(log_path, checkpoint_interval=1).save(logindex.index_path(log_path))
+            expected = stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+            self.assertEqual(expected.functions["leaf", "g.py", 9].count, 8)
+            for chunk_count in range(1, len(self.evts) + 1):
+                self.assertSameStats(parallel.profile_stats(log_path, chunk_count=chunk_count), expected)
+
+    def test_compaction(self):
+        compactor = parallel.StackCompactor()
+        compactor.add_events(make_generator_calls()[1:])
+        kept, run_starts, has_samples = compactor.summary()
+        #only main's return is left
+        self.assertEqual([event_type for event_type, _, _ in kept[None, None, None]], ["return"])
+        self.assertEqual((run_starts, has_samples), ({}, False))
+
+    def test_pool(self):
+        log_path = self.write_log("json")
+        expected = stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+        self.assertSameStats(parallel.profile_stats(log_path, jobs=2, chunk_count=5), expected)
+
+    def test_one_job(self):
+        log_path = self.write_log("json")
+        expected = stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+        split_log, min_chunk_bytes = parallel.split_log, parallel.MIN_CHUNK_BYTES
+        chunked = []
+        parallel.split_log = lambda *args: chunked.append(args) or split_log(*args)
+        parallel.MIN_CHUNK_BYTES = 1
+        try:
+            #without a pool to use, the log isn't split
+            self.assertSameStats(parallel.profile_stats(log_path), expected)
+            self.assertEqual(chunked, [])
+            self.assertSameStats(parallel.profile_stats(log_path, jobs=2), expected)
+            self.assertEqual(len(chunked), 1)
+        finally:
+            parallel.split_log, parallel.MIN_CHUNK_BYTES = split_log, min_chunk_bytes
+
+class TestLive(unittest.TestCase):
+    """tests following a log with live.LogTailer, live.LiveLog and webviewer.LiveWebViewer"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bind(self, path, query=""):
+        bottle.request.bind({"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query})
+        bottle.response.bind()
+
+    def _test_tail(self, log_format):
+        evts = make_wide_tree(20) + [events.event_from_data(TestEventSerialization.events["return"])]
+        source_path = os.path.join(self.directory, "source")
+        event_logger = debugger.open_event_logger(source_path, log_format)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        with open(source_path, "rb") as source:
+            data = source.read()
+        log_path = os.path.join(self.directory, "log")
+        tailer = live.LogTailer(log_path)
+        self.assertEqual(tailer.read(), [])
+        read = []
+        #the log is written a few bytes at a time, cutting records in two
+        with open(log_path, "wb") as log_file:
+            for position in range(0, len(data), 7):
+                log_file.write(data[position:position + 7])
+                log_file.flush()
+                read.extend(tailer.read())
+        tailer.close()
+        self.assertEqual([evt.to_data() for evt in read], [evt.to_data() for evt in evts])
+
+    def test_tail_json(self):
+        self._test_tail("json")
+
+    def test_tail_binary(self):
+        self._test_tail("binary")
+
+    def _test_read_bytes(self, log_format):
+        evts = make_wide_tree(200)
+        log_path = os.path.join(self.directory, "log")
+        event_logger = debugger.open_event_logger(log_path, log_format)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        tailer = live.LogTailer(log_path, max_bytes=1000)
+        read = []
+        #a log that's already long is read a bit at a time
+        while True:
+            batch = tailer.read()
+            self.assertTrue(len(batch) < len(evts) // 4)
+            read.extend(batch)
+            if not tailer.behind:
+                break
+        self.assertEqual(tailer.read(), [])
+        tailer.close()
+        self.assertEqual([evt.to_data() for evt in read], [evt.to_data() for evt in evts])
+
+    def test_read_bytes_json(self):
+        self._test_read_bytes("json")
+
+    def test_read_bytes_binary(self):
+        self._test_read_bytes("binary")
+
+    def test_window(self):
+        live_log = live.LiveLog(window=500e-9)
+        evts = make_wide_tree(100)
+        delta = live_log.update(evts[:3])
+        self.assertEqual([call["name"] for call in delta["open"]], ["main", "leaf", "inner"])
+        self.assertEqual(delta["calls"], [])
+        for position in range(3, len(evts) - 1, 50):
+            live_log.update(evts[position:min(position + 50, len(evts) - 1)])
+        delta = live_log.update(evts[-1:])
+        self.assertEqual(delta["open"], [])
+        self.assertEqual([call["name"] for call in delta["calls"]], ["main"])
+        self.assertEqual(delta["window_start"], 500e-9)
+        #the calls that ended in the last 500ns
+        chart = live_log.to_flame_chart()
+        self.assertEqual(len(chart["calls"]), 101)
+        self.assertEqual(len(live_log.calls), 101)
+        #the aggregates cover the whole log
+        self.assertEqual(live_log.profile.functions["leaf", "foo.py", 5].count, 100)
+        self.assertEqual(live_log.profile.total_time, 1000)
+        self.assertEqual(live_log.call_paths.root.child(("main", "foo.py", 1)).count, 1)
+        self.assertEqual(live_log.function_set().get_function("main", "foo.py", 1).calls, set([("leaf", "foo.py", 5)]))
+
+    def test_follow(self):
+        log_path = os.path.join(self.directory, "log.json")
+        event_logger = debugger.open_event_logger(log_path, "json")
+        feed = live.LiveFeed(live.LogTailer(log_path), live.LiveLog(), max_deltas=2)
+        viewer = webviewer.LiveWebViewer(feed)
+        self.assertFalse(feed.poll())
+        for start in (0, 100, 200):
+            for evt in make_wide_tree(3, start=start):
+                event_logger.log_event(evt)
+            event_logger.flush()
+            self.assertTrue(feed.poll())
+            if start == 0:
+                self.bind("/flame.json")
+                chart = json.loads(viewer.get_flame_json().decode("utf-8"))
+                self.assertEqual((chart["sequence"], len(chart["calls"])), (1, 7))
+                self.bind("/events", "after=0")
+                stream = viewer.get_events()
+                self.assertEqual(bottle.response.content_type, "text/event-stream")
+                self.assertTrue(next(stream).startswith(b"id: 1\nevent: delta\ndata: "))
+                self.assertEqual(feed.wait(1, 0), [])
+        event_logger.close()
+        self.assertEqual([sequence for sequence, _ in feed.wait(1)], [2, 3])
+        #delta 1 was dropped
+        self.assertEqual(feed.wait(0), None)
+        self.bind("/events", "after=0")
+        self.assertTrue(next(viewer.get_events()).startswith(b"event: reset"))
+        feed.tailer.close()
+
+def send_events(address, evts):
+    """Send evts to the collector at address, a few records per frame"""
+    event_logger = collector.SocketEventLogger(address, flush_bytes=64)
+    for evt in evts:
+        event_logger.log_event(evt)
+    event_logger.close()
+
+class TestCollector(unittest.TestCase):
+    """tests collector.SocketEventLogger and collector.Collector"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "socket")
+        self.output = os.path.join(self.directory, "log.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_processes(self):
+        log_collector = collector.Collector(self.address, self.output, index=True)
+        stopping = threading.Event()
+        def serve():
+            #until both children have connected and disconnected
+            while not stopping.is_set() or log_collector.connections or len(log_collector.log_paths) < 2:
+                log_collector.serve(0.01)
+        thread = threading.Thread(target=serve)
+        thread.start()
+        children = [
+            multiprocessing.Process(target=send_events, args=(self.address, make_wide_tree(50, start=start)))
+            for start in (0, 1000)
+        ]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+        stopping.set()
+        thread.join()
+        log_collector.close()
+        self.assertFalse(os.path.exists(self.address))
+        self.assertEqual(sorted(log_collector.log_paths), processes.find_shards(self.output))
+        for child, log_path in zip(children, processes.find_shards(self.output)):
+            self.assertEqual(log_path, processes.shard_path(self.output, child.pid))
+            self.assertEqual(len(list(processes.iter_shard_events(log_path))), 202)
+            self.assertEqual(len(logindex.LogIndex.load(logindex.index_path(log_path), log_path)), 202)
+
+    def test_broken_frame(self):
+        log_collector = collector.Collector(self.address, self.output)
+        evts = make_wide_tree(10)
+        event_logger = collector.SocketEventLogger(self.address)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.flush()
+        #a frame that never arrives in full
+        event_logger.log_file.sock.sendall(collector.FRAME_HEADER.pack(100) + b"\x13" * 10)
+        event_logger.close()
+        while not log_collector.log_paths or log_collector.connections:
+            log_collector.serve(1)
+        log_collector.close()
+        self.assertEqual(
+            [evt.to_data() for evt in logreader.iter_log_events(log_collector.log_paths[0])],
+            [evt.to_data() for evt in evts],
+        )
+        #nothing is listening any more
+        self.assertRaises(socket.error, collector.SocketEventLogger, self.address)
+
+    def test_compression(self):
+        log_collector = collector.Collector(self.address, self.output + ".gz", index=True)
+        self.assertEqual(log_collector.compression, "gzip")
+        evts = make_wide_tree(10)
+        event_logger = collector.SocketEventLogger(self.address, flush_bytes=64)
+        for evt in evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        while not log_collector.log_paths or log_collector.connections:
+            log_collector.serve(1)
+        log_collector.close()
+        log_path = log_collector.log_paths[0]
+        self.assertEqual(log_path, processes.shard_path(self.output + ".gz", os.getpid()))
+        with open(log_path, "rb") as log_file:
+            self.assertEqual(compression.detect(log_file.read(24)), "gzip")
+        self.assertEqual(
+            [evt.to_data() for evt in processes.iter_shard_events(log_path)],
+            [dict(evt.to_data(), process_id=os.getpid()) for evt in evts],
+        )
+        self.assertEqual(len(logindex.LogIndex.load(logindex.index_path(log_path), log_path)), len(evts))
+
+class TestCompression(unittest.TestCase):
+    """tests reading and writing logs with the compression module"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evts = make_wide_tree(30) + make_generator_calls(start=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, log_format, codec=None, block_size=256):
+        log_path = os.path.join(self.directory, "log." + log_format + ("." + codec if codec else ""))
+        log_file = open(log_path, "wb" if codec or log_format == "binary" else "w")
+        if codec:
+            log_file = compression.CompressedWriter(log_file, codec, block_size=block_size)
+        #in small batches: blocks end between writes
+        if log_format == "binary":
+            event_logger = debugger.BinaryFileEventLogger(log_file, flush_bytes=64)
+        else:
+            event_logger = debugger.BufferedJsonFileEventLogger(log_file, debugger.FlushPolicy(4, 1.0))
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        return log_path
+
+    def _test_codec(self, codec):
+        for log_format in ("json", "binary"):
+            log_path = self.write_log(log_format, codec)
+            with open(self.write_log(log_format), "rb") as log_file:
+                contents = log_file.read()
+            with open(log_path, "rb") as raw_file:
+                log_file = compression.open_compressed(raw_file)
+                self.assertEqual(log_file.read(), contents)
+                #seeking back into an earlier block
+                log_file.seek(-300, io.SEEK_END)
+                self.assertEqual(log_file.read(10), contents[-300:-290])
+                self.assertTrue(len(log_file.raw.starts) > 3)
+            self.assertEqual(
+                [evt.to_data() for evt in logreader.iter_log_events(log_path)],
+                [evt.to_data() for evt in self.evts],
+            )
+            logindex.LogIndex.build(log_path, checkpoint_interval=4).save(logindex.index_path(log_path))
+            indexed_log = logindex.IndexedLog(log_path, cached_blocks=2)
+            self.assertEqual(
+                [indexed_log[i].to_data() for i in reversed(range(len(self.evts)))],
+                [evt.to_data() for evt in reversed(self.evts)],
+            )
+            indexed_log.close()
+            expected = stats.ProfileStats.from_events(logreader.iter_log_events(log_path))
+            profile = parallel.profile_stats(log_path, chunk_count=5)
+            self.assertEqual(
+                dict((key, vars(function)) for key, function in profile.functions.items()),
+                dict((key, vars(function)) for key, function in expected.functions.items()),
+            )
+            self.assertEqual(len(parallel.split_log(log_path, 5)), 5)
+
+    def test_gzip(self):
+        self._test_codec("gzip")
+        #the blocks are gzip members, which gzip reads as one file
+        with gzip.GzipFile(self.write_log("json", "gzip"), "rb") as log_file:
+            self.assertEqual(len(log_file.read().splitlines()), len(self.evts) + 1)
+
+    def test_truncated(self):
+        for log_format in ("json", "binary"):
+            log_path = self.write_log(log_format, "gzip")
+            with open(log_path, "rb") as log_file:
+                contents = log_file.read()
+            #killed while writing the last block
+            with open(log_path, "wb") as log_file:
+                log_file.write(contents[:-100])
+            evts = list(logreader.iter_log_events(log_path))
+            self.assertTrue(0 < len(evts) < len(self.evts))
+            self.assertEqual([evt.to_data() for evt in evts], [evt.to_data() for evt in self.evts[:len(evts)]])
+
+    def test_zstd(self):
+        try:
+            compression.import_codec("zstd")
+        except ValueError:
+            self.skipTest("no zstandard")
+        self._test_codec("zstd")
+
+    def test_lz4(self):
+        try:
+            compression.import_codec("lz4")
+        except ValueError:
+            self.skipTest("no lz4")
+        self._test_codec("lz4")
+
+    def test_open_event_logger(self):
+        log_path = os.path.join(self.directory, "log.json.gz")
+        event_logger = debugger.open_event_logger(log_path)
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        with open(log_path, "rb") as log_file:
+            self.assertEqual(compression.detect(log_file.read(24)), "gzip")
+            log_file.seek(0)
+            self.assertEqual(len(events.events_from_file(log_file)), len(self.evts))
+        self.assertRaises(ValueError, debugger.open_event_logger, log_path, compression="bz2")
+
+    def test_gzip_stream(self):
+        with open(self.write_log("json"), "rb") as log_file:
+            contents = log_file.read()
+        log_path = os.path.join(self.directory, "plain.json.gz")
+        with gzip.GzipFile(log_path, "wb") as log_file:
+            log_file.write(contents)
+        self.assertEqual(len(list(logreader.iter_log_events(log_path))), len(self.evts))
+        #it can't be split
+        self.assertEqual(parallel.split_log(log_path, 5), None)
+        self.assertEqual(
+            sorted(parallel.profile_stats(log_path, chunk_count=5).functions),
+            sorted(stats.ProfileStats.from_events(self.evts).functions),
+        )
+
+class TestMapped(unittest.TestCase):
+    """tests reading logs through the mapped module"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.evts = make_wide_tree(30)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_blocks(self):
+        log_path = os.path.join(self.directory, "log.json")
+        contents = b"".join(b'{"n": %d}\n' % n for n in range(100)) + b"\n\n" + b'{"n": "%s"}' % (b"x" * 100)
+        with open(log_path, "wb") as log_file:
+            log_file.write(contents)
+        with open(log_path, "rb") as log_file:
+            self.assertTrue(mapped.map_file(log_file) is not None)
+            for source in (log_file, io.BytesIO(contents)):
+                source.seek(9)
+                blocks = list(mapped.iter_blocks(source, block_size=64))
+                self.assertEqual(b"".join(blocks), contents[9:])
+                self.assertTrue(all(block.endswith(b"\n") for block in blocks[:-1]))
+                source.seek(0)
+                blocks = list(mapped.iter_blocks(source, end=90, block_size=32))
+                self.assertEqual(b"".join(blocks), contents[:90])
+                self.assertTrue(all(block.endswith(b"\n") for block in blocks))
+                source.seek(0)
+                values = list(mapped.iter_json(source))
+                self.assertEqual([value["n"] for value in values], list(range(100)) + ["x" * 100])
+        self.assertRaises(ValueError, mapped.parse_lines, b'{"n": 1}\n{"n": \n')
+        self.assertEqual(mapped.parse_lines(b"\n \n"), [])
+
+    def test_binary(self):
+        log_path = os.path.join(self.directory, "log.bin")
+        event_logger = debugger.open_event_logger(log_path, "binary")
+        for evt in self.evts:
+            event_logger.log_event(evt)
+        event_logger.close()
+        with open(log_path, "rb") as log_file:
+            contents = log_file.read()
+            log_file.seek(0)
+            mapped_raws = list(logreader.BinaryFileEventReader(log_file).iter_raw())
+        #read a chunk at a time
+        buffered_raws = list(logreader.BinaryFileEventReader(io.BytesIO(contents), chunk_size=7).iter_raw())
+        self.assertEqual(mapped_raws, buffered_raws)
+        self.assertEqual(len(mapped_raws), len(self.evts))
+        #a record that's cut off
+        with open(log_path, "wb") as log_file:
+            log_file.write(contents[:-1])
+        with open(log_path, "rb") as log_file:
+            self.assertRaises(ValueError, list, logreader.BinaryFileEventReader(log_file).iter_raw())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+"""A low-overhead alternative to debugger.LoggingDebugger
+
+LoggingDebugger is a bdb.Bdb, so every event goes through trace_dispatch,
+breakpoint checks and stop_here before it reaches the user_* hooks.
+LoggingTracer skips all of that:
+* sessions that only log calls and returns use sys.setprofile, which is never
+    called for individual lines
+* sessions that log lines use a slim sys.settrace function
+
+Both feed the same EventRecorder hooks, so the event stream is the same as
+the one LoggingDebugger produces, with one difference: the profile hook
+doesn't see exceptions, so call/return-only sessions don't log
+ExceptionEvents (the return event of the frame the exception propagated out
+of is still logged)."""
+import sys
+
+from pylog.debugger import EventRecorder
+
+class LoggingTracer(EventRecorder):
+    """Drop-in replacement for LoggingDebugger (set_trace, set_quit, run)"""
+
+    def profile_dispatch(self, frame, event, arg):
+        """sys.setprofile hook, used when lines aren't logged"""
+        if event == "call":
+            self.user_call(frame, None)
+        elif event == "return":
+            self.user_return(frame, arg)
+
+    def trace_dispatch(self, frame, event, arg):
+        """global sys.settrace hook. Only ever sees "call" events
+
+        Code that isn't logged gets no local hook, so its lines and returns
+        cost nothing"""
+        decision = self.code_filter.decide(frame)
+        if not decision.trace:
+            return None
+        self.log_call(frame, decision)
+        return self.get_local_dispatch(frame, decision)
+
+    def get_local_dispatch(self, frame, decision):
+        if decision.log_lines:
+            return self.local_dispatch
+        if hasattr(frame, "f_trace_lines"):
+            frame.f_trace_lines = False
+        return self.local_dispatch_no_lines
+
+    def local_dispatch(self, frame, event, arg):
+        """per-frame trace hook for frames that are logged"""
+        if event == "line":
+            self.log_line(frame)
+        elif event == "return":
+            self.log_return(frame, arg)
+        elif event == "exception" and not self.is_protocol_exception(frame, arg):
+            self.log_exception(frame, arg)
+        return self.local_dispatch
+
+    def local_dispatch_no_lines(self, frame, event, arg):
+        if event == "return":
+            self.log_return(frame, arg)
+        elif event == "exception" and not self.is_protocol_exception(frame, arg):
+            self.log_exception(frame, arg)
+        return self.local_dispatch_no_lines
+
+    def start(self):
+        """Install the hook for new frames on the current thread (and the
+        other threads, with the trace_threads option)"""
+        if self.options["log_lines"]:
+            self.start_threads(self.trace_dispatch)
+            sys.settrace(self.trace_dispatch)
+        else:
+            self.start_threads(self.profile_dispatch, profile=True)
+            sys.setprofile(self.profile_dispatch)
+
+    def stop(self):
+        sys.setprofile(None)
+        sys.settrace(None)
+        self.stop_threads()
+
+    def set_trace(self, frame=None):
+        """Start logging from frame (default: the caller's frame)"""
+        if frame is None:
+            frame = sys._getframe().f_back
+        if self.options["log_lines"]:
+            #frames that are already running need a local hook to log their lines
+            while frame:
+                decision = self.code_filter.decide(frame)
+                if decision.trace:
+                    frame.f_trace = self.get_local_dispatch(frame, decision)
+                frame = frame.f_back
+        self.start()
+
+    def set_quit(self):
+        """Stop logging"""
+        self.stop()
+        self.flush_events()
+        frame = sys._getframe().f_back
+        while frame:
+            if frame.f_trace is not None:
+                frame.f_trace = None
+            frame = frame.f_back
+
+    def run(self, cmd, globals=None, locals=None):
+        """Log the execution of cmd, like bdb.Bdb.run"""
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.start()
+        try:
+            exec(cmd, globals, locals)
+        finally:
+            self.stop()
+            self.flush_events()
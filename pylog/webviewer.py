@@ -1,25 +1,110 @@
 """A simple web server provides a web interface with visualizations for a log
 
 Usage:
-  pylog-web <file>
+  pylog-web <file> [--stream | --follow] [--window=SECONDS]
+
+Options:
+  --stream          re-read the log on every request instead of keeping it in memory
+  --follow          keep reading the log while it's recorded, and push what's new to the page
+  --window=SECONDS  --follow: how many seconds of calls to show [default: 60]
 """
+import collections
+import gzip
+import hashlib
+import io
 import json
+from wsgiref.simple_server import WSGIServer
 
 import docopt
 import bottle
 import pkg_resources
+from six.moves import socketserver
+
+from pylog import callpaths, events, flameindex, live, logreader
+
+#how often a page following a log is sent something, so dropped connections are noticed
+KEEPALIVE_SECONDS = 15
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb") as gzip_file:
+        gzip_file.write(data)
+    return out.getvalue()
+
+class CachedResponse(object):
+    """A response body, with its ETag and its gzipped version"""
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        self.gzipped = gzip_bytes(body)
+
+class ResponseCache(object):
+    """The last max_entries responses, in least recently used order"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.responses = collections.OrderedDict()
 
-from pylog import events
+    def get(self, key, build):
+        """The response for key, calling build() to make a CachedResponse if it's not cached"""
+        try:
+            response = self.responses.pop(key)
+        except KeyError:
+            response = build()
+            if len(self.responses) >= self.max_entries:
+                self.responses.popitem(last=False)
+        self.responses[key] = response
+        return response
 
 class WebViewer(bottle.Bottle):
 
-    def __init__(self, evts):
+    def __init__(self, evts, cache_size=64):
+        """evts: the events to show (e.g. an EventStore), or a function that
+            returns a fresh iterator over them for every request
+        cache_size: how many responses to keep. The log doesn't change, so
+            responses are only built once per set of query parameters.
+            Nothing is cached when evts is a function"""
         super(WebViewer, self).__init__()
         self.evts = evts
+        self.response_cache = ResponseCache(cache_size)
+        #name -> structures built from the events the first time they're needed
+        #(bottle.Bottle doesn't allow attributes to be reassigned)
+        self.derived = {}
         self.route("/", callback=self.root)
         self.route("/flame.json", callback=self.get_flame_json)
+        self.route("/functions.json", callback=self.get_functions_json)
+        self.route("/callpaths.json", callback=self.get_call_paths_json)
+        self.route("/collapsed.txt", callback=self.get_collapsed)
         self.route("/static/<filename>", callback=self.static)
 
+    @property
+    def streaming(self):
+        return callable(self.evts)
+
+    def cached(self, build, content_type):
+        """Respond with the body build() returns, from the cache if possible
+
+        Sets an ETag and answers If-None-Match with 304 Not Modified.
+        Clients that accept gzip get the precompressed body."""
+        if self.streaming:
+            response = CachedResponse(build(), content_type)
+        else:
+            key = (bottle.request.path, tuple(sorted(bottle.request.query.allitems())))
+            response = self.response_cache.get(key, lambda: CachedResponse(build(), content_type))
+        bottle.response.content_type = response.content_type
+        bottle.response.set_header("ETag", response.etag)
+        bottle.response.set_header("Vary", "Accept-Encoding")
+        if_none_match = bottle.request.headers.get("If-None-Match", "")
+        if response.etag in [etag.strip() for etag in if_none_match.split(",")]:
+            bottle.response.status = 304
+            return b""
+        if "gzip" in bottle.request.headers.get("Accept-Encoding", ""):
+            bottle.response.set_header("Content-Encoding", "gzip")
+            return response.gzipped
+        return response.body
+
     def root(self):
         return bottle.redirect("/static/flame.html")
 
@@ -27,22 +112,173 @@ class WebViewer(bottle.Bottle):
         if filename not in pkg_resources.resource_listdir("pylog", "static"):
             bottle.abort(404, "File not found")
         else:
+            content_type = "text/html"
             if filename.endswith(".js"):
-                bottle.response.content_type = "text/javascript"
+                content_type = "text/javascript"
             elif filename.endswith(".css"):
-                bottle.response.content_type = "text/css"
-            return pkg_resources.resource_string("pylog", "static/" + filename)
+                content_type = "text/css"
+            return self.cached(lambda: pkg_resources.resource_string("pylog", "static/" + filename), content_type)
+
+
+    def iter_events(self):
+        return self.evts() if self.streaming else iter(self.evts)
+
+    def get_derived(self, name, build):
+        """build(events), built once unless the log is re-read for every request"""
+        if self.streaming:
+            return build(self.iter_events())
+        try:
+            return self.derived[name]
+        except KeyError:
+            result = self.derived[name] = build(self.evts)
+            return result
+
+    def get_flame_index(self):
+        return self.get_derived("flame_index", flameindex.FlameIndex.from_events)
 
+    def get_function_set(self):
+        return self.get_derived("function_set", events.FunctionSet.from_events)
+
+    def get_call_paths(self):
+        return self.get_derived("call_paths", callpaths.CallPathTree.from_events)
+
+    def get_flame_json(self):
+        """Query parameters (all optional):
+        start, end: the time window, in seconds from the start of the log
+        min_depth, max_depth: the depth range
+        width: the chart's width in pixels. Calls narrower than a pixel are merged"""
+        query = bottle.request.query
+        def param(name, convert, default=None):
+            value = query.get(name)
+            if not value:
+                return default
+            try:
+                return convert(value)
+            except ValueError:
+                bottle.abort(400, "Bad value for {0}: {1}".format(name, value))
+        options = dict(
+            start=param("start", float),
+            end=param("end", float),
+            min_depth=param("min_depth", int, 0),
+            max_depth=param("max_depth", int, flameindex.DEFAULT_MAX_DEPTH),
+            width=param("width", int),
+        )
+        return self.cached(
+            lambda: json.dumps(self.get_flame_index().to_flame_chart(**options)).encode("utf-8"),
+            "application/json",
+        )
+
+    def get_functions_json(self):
+        """Every function that was called, with its callers and callees"""
+        return self.cached(
+            lambda: json.dumps(self.get_function_set().to_data()).encode("utf-8"),
+            "application/json",
+        )
+
+    def get_call_paths_json(self):
+        """Calls merged by call path, for a classic flame graph"""
+        return self.cached(
+            lambda: json.dumps(self.get_call_paths().to_data()).encode("utf-8"),
+            "application/json",
+        )
+
+    def get_collapsed(self):
+        """The call paths in collapsed stack format (for flamegraph.pl and similar tools)"""
+        return self.cached(
+            lambda: self.get_call_paths().to_collapsed().encode("utf-8"),
+            "text/plain",
+        )
+
+class LiveWebViewer(WebViewer):
+    """A WebViewer for a log that's still being recorded (`pylog-web --follow`)
+
+    The flame chart shows the calls of a live.LiveLog's window, and the
+    function and call path views its aggregates. The page subscribes to
+    /events and gets the deltas of the live.LiveFeed as Server-Sent Events.
+    Run it with a server that handles requests in threads (ThreadingWSGIServer),
+    as every page keeps a request open"""
+
+    def __init__(self, feed):
+        """feed: a live.LiveFeed, started"""
+        super(LiveWebViewer, self).__init__(None, cache_size=0)
+        self.feed = feed
+        self.route("/events", callback=self.get_events)
+
+    @property
+    def streaming(self):
+        #the log changes, nothing is cached
+        return True
 
     def get_flame_json(self):
-        etree = events.ExecutionTree.from_events(self.evts)
-        return json.dumps(etree.to_flame_chart(100))
+        """Query parameters (optional): start, end: the time window, in seconds from the start of the log.
+        The response's sequence is the number of the last delta it includes"""
+        query = bottle.request.query
+        try:
+            start = float(query["start"]) if query.get("start") else None
+            end = float(query["end"]) if query.get("end") else None
+        except ValueError:
+            bottle.abort(400, "Bad time window")
+        def build():
+            with self.feed.lock:
+                chart = self.feed.live_log.to_flame_chart(start, end)
+                chart["sequence"] = self.feed.sequence
+            return json.dumps(chart).encode("utf-8")
+        return self.cached(build, "application/json")
+
+    def get_function_set(self):
+        with self.feed.lock:
+            return self.feed.live_log.function_set()
+
+    def get_call_paths(self):
+        #the calls that ended so far
+        with self.feed.lock:
+            call_paths = callpaths.CallPathTree()
+            call_paths.merge(self.feed.live_log.call_paths)
+            return call_paths
+
+    def get_events(self):
+        """The deltas after the one numbered `after` (or Last-Event-ID), as Server-Sent Events. A "reset" event
+        means some were dropped and the page has to load /flame.json again"""
+        after = bottle.request.query.get("after") or bottle.request.headers.get("Last-Event-ID")
+        try:
+            after = int(after) if after else self.feed.sequence
+        except ValueError:
+            bottle.abort(400, "Bad value for after: {0}".format(after))
+        bottle.response.content_type = "text/event-stream"
+        bottle.response.set_header("Cache-Control", "no-cache")
+        return self.iter_events_stream(after)
+
+    def iter_events_stream(self, after):
+        while True:
+            deltas = self.feed.wait(after, KEEPALIVE_SECONDS)
+            if deltas is None:
+                yield b"event: reset\ndata: {}\n\n"
+                return
+            if not deltas:
+                yield b": keepalive\n\n"
+            for sequence, delta in deltas:
+                yield "id: {0}\nevent: delta\ndata: {1}\n\n".format(sequence, json.dumps(delta)).encode("utf-8")
+                after = sequence
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """Handles each request in its own thread, so pages following a log don't hold up other requests"""
+    daemon_threads = True
 
 def main():
     options = docopt.docopt(__doc__)
-    with open(options["<file>"], "r") as log_file:
-        evts = events.events_from_file(log_file)
-    
+    if options["--follow"]:
+        feed = live.LiveFeed(live.LogTailer(options["<file>"]), live.LiveLog(float(options["--window"])))
+        feed.poll()
+        feed.start()
+        viewer = LiveWebViewer(feed)
+        viewer.run(host="localhost", port=8080, server_class=ThreadingWSGIServer)
+        return
+    if options["--stream"]:
+        evts = lambda: logreader.iter_log_events(options["<file>"])
+    else:
+        with open(options["<file>"], "rb") as log_file:
+            evts = events.EventStore.from_reader(logreader.get_reader(log_file))
+
     viewer = WebViewer(evts)
     viewer.run(host="localhost", port=8080)
 